@@ -0,0 +1,536 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""asgi implement behaviour that provides service control as asgi
+middleware.
+
+It mirrors the pipeline of :mod:`endpoints_management.control.wsgi`, i.e,
+:class:`ConfigFetchWrapper` -> :class:`EnvironmentMiddleware` ->
+:class:`AuthenticationMiddleware` -> :class:`Middleware`, but uses an
+:class:`endpoints_management.control.async_client.AsyncClient` so that service
+control never blocks the event loop.
+
+The values added to the WSGI environment by the wsgi middleware are added to
+the ASGI scope using the same keys.  Responses are streamed through to the
+server as the wrapped application sends them, and are reported once the final
+body message is sent.
+
+"""
+# pylint: disable=too-many-arguments
+
+from __future__ import absolute_import
+
+import asyncio
+from datetime import datetime
+import functools
+import logging
+import urllib.parse
+import wsgiref.util
+
+from google.api import service_pb2
+from webob.exc import HTTPServiceUnavailable
+
+from ..auth import tokens
+from ..config.service_config import ServiceConfigException
+from . import report_request, service, wsgi
+
+
+_logger = logging.getLogger(__name__)
+
+_HTTP = u'http'
+_RESPONSE_START = u'http.response.start'
+_RESPONSE_BODY = u'http.response.body'
+
+# the prefix of the scope keys set by these middleware
+_CONFIG_KEY_PREFIX = u'google.api.'
+
+
+def add_all(application, project_id, control_client,
+            loader=service.Loaders.FROM_SERVICE_MANAGEMENT,
+            latency_monitor=None):
+    """Adds all endpoints middleware to an asgi application.
+
+    Example:
+
+      >>> app = MyAsgiApp()  # an existing ASGI application
+      >>>
+      >>> from endpoints_management.control import asgi, async_client
+      >>> control_client = async_client.load('my-service-name')
+      >>> wrapped_app = asgi.add_all(app, 'my-project-id', control_client)
+      >>>
+      >>> # now use wrapped_app in place of app
+
+    Args:
+       application: the wrapped asgi application
+       project_id: the project_id thats providing service control support
+       control_client (:class:`endpoints_management.control.async_client.AsyncClient`):
+          the service control client instance
+       loader (:class:`endpoints_management.control.service.Loader`): loads the service
+          instance that configures this instance's behaviour
+       latency_monitor (:class:`endpoints_management.control.latency.Monitor`):
+          if set, the latencies of each request are recorded on it
+    """
+    return ConfigFetchWrapper(application, project_id, control_client, loader,
+                              latency_monitor=latency_monitor)
+
+
+class ConfigFetchWrapper(object):
+    """Loads the service config before wrapping an asgi application.
+
+    If the initial load fails, it is retried on an executor thread when the
+    next request arrives; requests received before the service config is
+    loaded are answered with HTTP 503 Service Unavailable.
+    """
+
+    def __init__(self, application, project_id, control_client,
+                 loader=service.Loaders.FROM_SERVICE_MANAGEMENT,
+                 latency_monitor=None):
+        self.service_config = None
+        self.asgi_backend = None
+        self.application = application
+        self.project_id = project_id
+        self.control_client = control_client
+        self.loader = loader
+        self.latency_monitor = latency_monitor
+        self._pending_load = None
+
+        self.try_loading()
+        self.wrap_app()
+
+    async def __call__(self, scope, receive, send):
+        if self.asgi_backend is not None:
+            await self.asgi_backend(scope, receive, send)
+            return
+        if scope[u'type'] != _HTTP:
+            await self.application(scope, receive, send)
+            return
+
+        self._launch_loading()
+        await _send_wsgi_response(
+            HTTPServiceUnavailable(), _environ_from_scope(scope), send)
+
+    def wrap_app(self):
+        if self.service_config is None:
+            return
+        authenticator = wsgi._create_authenticator(self.service_config)
+
+        wrapped_app = Middleware(self.application, self.project_id,
+                                 self.control_client,
+                                 latency_monitor=self.latency_monitor)
+        if authenticator:
+            wrapped_app = AuthenticationMiddleware(wrapped_app, authenticator)
+        self.asgi_backend = EnvironmentMiddleware(wrapped_app, self.service_config)
+
+    def try_loading(self):
+        try:
+            a_service = self.loader.load()
+            if not a_service:
+                raise ValueError(u'Service config loader returned bad value.')
+        except (ServiceConfigException, ValueError):
+            _logger.exception(u'Failed to load service config.')
+        else:
+            _logger.debug('Loaded service config.')
+            self.service_config = a_service
+
+    def _launch_loading(self):
+        if self._pending_load is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self._pending_load = loop.run_in_executor(None, self.try_loading)
+        self._pending_load.add_done_callback(self._on_loaded)
+
+    def _on_loaded(self, dummy_future):
+        self._pending_load = None
+        self.wrap_app()
+
+
+class EnvironmentMiddleware(object):
+    """An ASGI middleware that adds the service config to the scope.
+
+    It adds the same values as
+    :class:`endpoints_management.control.wsgi.EnvironmentMiddleware`, using the
+    same keys.
+    """
+    # pylint: disable=too-few-public-methods
+
+    SERVICE = wsgi.EnvironmentMiddleware.SERVICE
+    SERVICE_NAME = wsgi.EnvironmentMiddleware.SERVICE_NAME
+    METHOD_REGISTRY = wsgi.EnvironmentMiddleware.METHOD_REGISTRY
+    METHOD_INFO = wsgi.EnvironmentMiddleware.METHOD_INFO
+    REPORTING_RULES = wsgi.EnvironmentMiddleware.REPORTING_RULES
+
+    def __init__(self, application, a_service):
+        """Initializes a new EnvironmentMiddleware instance.
+
+        Args:
+          application: the wrapped asgi application
+          a_service (:class:`google.api.service_pb2.Service`): a service
+            instance
+        """
+        if not isinstance(a_service, service_pb2.Service):
+            raise ValueError(u"service is None or not an instance of Service")
+
+        self._application = application
+        self._service = a_service
+        self._method_registry = service.MethodRegistry(a_service)
+        logs, metric_names, label_names = service.extract_report_spec(a_service)
+        self._reporting_rules = report_request.ReportingRules.from_known_inputs(
+            logs=logs,
+            metric_names=metric_names,
+            label_names=label_names)
+        self._reporting_rules.compile()
+
+    async def __call__(self, scope, receive, send):
+        if scope[u'type'] != _HTTP:
+            await self._application(scope, receive, send)
+            return
+
+        scope = dict(scope)
+        scope[self.SERVICE] = self._service
+        scope[self.SERVICE_NAME] = self._service.name
+        scope[self.METHOD_REGISTRY] = self._method_registry
+        scope[self.REPORTING_RULES] = self._reporting_rules
+        environ = _environ_from_scope(scope)
+        parsed_uri = urllib.parse.urlparse(wsgiref.util.request_uri(environ))
+        http_method = wsgi._request_method(environ)
+        method_info = self._method_registry.lookup(http_method, parsed_uri.path)
+        if method_info:
+            scope[self.METHOD_INFO] = method_info
+
+        await self._application(scope, receive, send)
+
+
+class Middleware(wsgi.Middleware):
+    """An ASGI middleware implementation that provides service control.
+
+    It builds its check, quota and report requests in the same way as
+    :class:`endpoints_management.control.wsgi.Middleware`, but sends them
+    using an :class:`endpoints_management.control.async_client.AsyncClient`.
+
+    Example:
+
+      >>> from endpoints_management.control import asgi, async_client, service
+      >>> control_client = async_client.load('my-service-name')
+      >>> with_control = asgi.Middleware(app, 'my-project-id', control_client)
+      >>> env_app = asgi.EnvironmentMiddleware(with_control,
+      ...                                      service.Loaders.FROM_SERVICE_MANAGEMENT.load())
+      >>>
+      >>> # now use env_app in place of app
+
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self,
+                 application,
+                 project_id,
+                 control_client,
+                 next_operation_id=wsgi._next_operation_uuid,
+                 timer=datetime.utcnow,
+                 latency_monitor=None):
+        """Initializes a new Middleware instance.
+
+        Args:
+           application: the wrapped asgi application
+           project_id: the project_id thats providing service control support
+           control_client (:class:`endpoints_management.control.async_client.AsyncClient`):
+             the service control client instance
+           next_operation_id (func): produces the next operation
+           timer (func[[datetime.datetime]]): a func that obtains the current time
+           latency_monitor (:class:`endpoints_management.control.latency.Monitor`):
+             if set, the latencies of each request are recorded on it
+           """
+        super(Middleware, self).__init__(application,
+                                         project_id,
+                                         control_client,
+                                         next_operation_id=next_operation_id,
+                                         timer=timer,
+                                         latency_monitor=latency_monitor)
+
+    async def __call__(self, scope, receive, send):
+        # pylint: disable=too-many-locals
+        method_info = scope.get(EnvironmentMiddleware.METHOD_INFO)
+        if scope[u'type'] != _HTTP or not method_info:
+            # just allow the wrapped application to handle the request
+            _logger.debug(u'method_info not present in the asgi scope'
+                          u', no service control')
+            await self._application(scope, receive, send)
+            return
+
+        latency_timer = wsgi._LatencyTimer(self._timer)
+        latency_timer.start()
+
+        # Determine if the request can proceed
+        environ = _environ_from_scope(scope)
+        http_method = wsgi._request_method(environ)
+        parsed_uri = urllib.parse.urlparse(wsgiref.util.request_uri(environ))
+        app_info = wsgi._AppInfo()
+        try:
+            app_info.request_size = int(environ.get(u'CONTENT_LENGTH',
+                                                    report_request.NOT_SET))
+        except ValueError:
+            _logger.warn(u'ignored bad content-length: %s', environ.get(u'CONTENT_LENGTH'))
+
+        app_info.http_method = http_method
+        app_info.url = parsed_uri
+
+        error_response = _StartResponse()
+        check_info = self._create_check_info(method_info, parsed_uri, environ)
+        error_msg, consumer_project_number = await self._check_and_allocate(
+            method_info, check_info, parsed_uri, environ, app_info,
+            error_response)
+
+        rules = scope.get(EnvironmentMiddleware.REPORTING_RULES)
+        if error_msg:
+            # send the error, then a report request that indicates that the
+            # request failed
+            latency_timer.end()
+            await error_response.send(error_msg, send)
+            await self._send_report(method_info,
+                                    check_info,
+                                    app_info,
+                                    latency_timer,
+                                    rules,
+                                    consumer_project_number)
+            return
+
+        await self._serve_application(scope, receive, send,
+                                      method_info,
+                                      check_info,
+                                      app_info,
+                                      latency_timer,
+                                      rules,
+                                      consumer_project_number)
+
+    async def _check_and_allocate(self,
+                                  method_info,
+                                  check_info,
+                                  parsed_uri,
+                                  environ,
+                                  app_info,
+                                  error_response):
+        """Checks the request and allocates its quota.
+
+        Returns:
+          tuple: the error message to send, or ``None`` if the request can
+            proceed, and the consumer project number
+        """
+        # pylint: disable=too-many-arguments
+        # Default to 0 for consumer project number to disable per-consumer
+        # metric reporting if the check request doesn't return one.
+        consumer_project_number = 0
+        if not check_info.api_key and not method_info.allow_unregistered_calls:
+            _logger.debug(u"skipping %s, no api key was provided", parsed_uri)
+            error_msg = self._handle_missing_api_key(app_info, error_response)
+            return error_msg, consumer_project_number
+
+        # the client only makes a CheckRequest if it is not cached
+        _logger.debug(u'checking %s with %s', method_info, check_info)
+        check_resp = await self._control_client.check(check_info)
+        error_msg = self._handle_check_response(app_info, check_resp, error_response)
+        consumer_project_number = wsgi._consumer_project_number(
+            check_resp, consumer_project_number)
+        if error_msg is None:
+            quota_info = self._create_quota_info(method_info, parsed_uri, environ)
+            if not quota_info.quota_info:
+                _logger.debug(u'no metric costs for this method')
+            else:
+                quota_response = await self._control_client.allocate_quota(quota_info)
+                error_msg = self._handle_quota_response(
+                    app_info, quota_response, error_response)
+        return error_msg, consumer_project_number
+
+    async def _serve_application(self, scope, receive, send,
+                                 method_info,
+                                 check_info,
+                                 app_info,
+                                 latency_timer,
+                                 rules,
+                                 consumer_project_number):
+        """Runs the application, reporting once its response is sent."""
+        # pylint: disable=too-many-arguments
+        latency_timer.app_start()
+        reported = []
+
+        async def send_report():
+            if reported:
+                return
+            reported.append(True)
+            latency_timer.end()
+            await self._send_report(method_info,
+                                    check_info,
+                                    app_info,
+                                    latency_timer,
+                                    rules,
+                                    consumer_project_number)
+
+        # pass the response through as it is sent, recording its status and
+        # size on app_info
+        response_size = [0]
+
+        async def inner_send(message):
+            message_type = message[u'type']
+            if message_type == _RESPONSE_START:
+                app_info.response_code = message[u'status']
+            elif message_type == _RESPONSE_BODY:
+                response_size[0] += len(message.get(u'body', b''))
+                app_info.response_size = response_size[0]
+            await send(message)
+            if message_type == _RESPONSE_BODY and not message.get(u'more_body'):
+                await send_report()
+
+        try:
+            await self._application(scope, receive, inner_send)
+        finally:
+            await send_report()
+
+    async def _send_report(self,
+                           method_info,
+                           check_info,
+                           app_info,
+                           latency_timer,
+                           reporting_rules,
+                           consumer_project_number):
+        self._record_latencies(method_info, latency_timer)
+        report_req = self._create_report_request(method_info,
+                                                 check_info,
+                                                 app_info,
+                                                 latency_timer,
+                                                 reporting_rules,
+                                                 consumer_project_number)
+        _logger.debug(u'sending report_request %s', report_req)
+        await self._control_client.report(report_req)
+
+
+class AuthenticationMiddleware(object):
+    """An ASGI middleware that does authentication checks for incoming
+    requests.
+
+    The authentication result is added to the scope as ``USER_INFO``.  Tokens
+    are verified on an executor thread, as fetching the signing keys may block.
+    """
+    # pylint: disable=too-few-public-methods
+
+    USER_INFO = wsgi.AuthenticationMiddleware.USER_INFO
+
+    def __init__(self, application, authenticator):
+        """Initializes an authentication middleware instance.
+
+        Args:
+          application: an ASGI application to be wrapped
+          authenticator (:class:`google.auth.tokens.Authenticator`): an
+            authenticator that authenticates incoming requests
+        """
+        if not isinstance(authenticator, tokens.Authenticator):
+            raise ValueError(u"Invalid authenticator")
+
+        self._application = application
+        self._authenticator = authenticator
+
+    async def __call__(self, scope, receive, send):
+        method_info = scope.get(EnvironmentMiddleware.METHOD_INFO)
+        if scope[u'type'] != _HTTP or not method_info or not method_info.auth_info:
+            # No authentication configuration for this method
+            _logger.debug(u"authentication is not configured")
+            await self._application(scope, receive, send)
+            return
+
+        auth_token = wsgi._extract_auth_token(_environ_from_scope(scope))
+        user_info = None
+        if not auth_token:
+            _logger.debug(u"No auth token is attached to the request")
+        else:
+            try:
+                service_name = scope.get(EnvironmentMiddleware.SERVICE_NAME)
+                authenticate = functools.partial(self._authenticator.authenticate,
+                                                 auth_token,
+                                                 method_info.auth_info,
+                                                 service_name)
+                user_info = await asyncio.get_running_loop().run_in_executor(
+                    None, authenticate)
+            except Exception:  # pylint: disable=broad-except
+                _logger.debug(u"Cannot decode and verify the auth token. The backend "
+                              u"will not be able to retrieve user info", exc_info=True)
+
+        scope = dict(scope)
+        scope[self.USER_INFO] = user_info
+        await self._application(scope, receive, send)
+
+
+class _StartResponse(object):
+    """A wsgi ``start_response`` that records a response for sending via asgi."""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self.status = None
+        self.headers = []
+
+    def __call__(self, status, response_headers, exc_info=None):
+        self.status = int(status.partition(u' ')[0])
+        self.headers = [(name.lower().encode(u'latin-1'), value.encode(u'latin-1'))
+                        for name, value in response_headers]
+
+    async def send(self, body, send):
+        await send({
+            u'type': _RESPONSE_START,
+            u'status': self.status,
+            u'headers': self.headers,
+        })
+        await send({
+            u'type': _RESPONSE_BODY,
+            u'body': b''.join(body),
+        })
+
+
+async def _send_wsgi_response(wsgi_app, environ, send):
+    start_response = _StartResponse()
+    body = wsgi_app(environ, start_response)
+    await start_response.send(body, send)
+
+
+def _environ_from_scope(scope):
+    """Creates a WSGI-style environ from an asgi http ``scope``.
+
+    This allows the request-inspection code shared with
+    :mod:`endpoints_management.control.wsgi` to be used unchanged.
+    """
+    scheme = scope.get(u'scheme', _HTTP)
+    server = scope.get(u'server') or (u'localhost', None)
+    client = scope.get(u'client') or (u'', 0)
+    port = server[1]
+    if port is None:
+        port = 443 if scheme == u'https' else 80
+
+    environ = {
+        u'REQUEST_METHOD': scope[u'method'],
+        # WSGI servers decode the path as latin-1
+        u'SCRIPT_NAME': scope.get(u'root_path', u'').encode(u'utf-8').decode(u'latin-1'),
+        u'PATH_INFO': scope[u'path'].encode(u'utf-8').decode(u'latin-1'),
+        u'QUERY_STRING': scope.get(u'query_string', b'').decode(u'latin-1'),
+        u'SERVER_NAME': server[0],
+        u'SERVER_PORT': str(port),
+        u'REMOTE_ADDR': client[0],
+        u'wsgi.url_scheme': scheme,
+    }
+    for raw_name, raw_value in scope.get(u'headers', ()):
+        name = raw_name.decode(u'latin-1').upper().replace(u'-', u'_')
+        value = raw_value.decode(u'latin-1')
+        if name not in (u'CONTENT_LENGTH', u'CONTENT_TYPE'):
+            name = u'HTTP_' + name
+        if name in environ:
+            value = environ[name] + u',' + value
+        environ[name] = value
+    for key, value in scope.items():
+        if key.startswith(_CONFIG_KEY_PREFIX):
+            environ[key] = value
+    return environ
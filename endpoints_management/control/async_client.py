@@ -0,0 +1,318 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""async_client provides a service control client for use with asyncio.
+
+:class:`AsyncClient` is the asyncio equivalent of
+:class:`endpoints_management.control.client.Client`.  It uses the same
+aggregators, but its methods are coroutines, and its caches are flushed by
+asyncio tasks rather than by a scheduler thread.
+
+Example:
+
+  >>> from endpoints_management.control import async_client, client
+  >>>
+  >>> # within a coroutine running on the event loop
+  >>> service_name = 'my-service-name'
+  >>> control_client = async_client.load(service_name, client.Loaders.DEFAULT)
+  >>> control_client.start()
+  >>> check_resp = await control_client.check(check_req)
+
+"""
+
+from __future__ import absolute_import
+
+import asyncio
+import logging
+from datetime import datetime
+
+from apitools.base.py import exceptions
+from google.api_core import exceptions as api_core_exceptions
+from google.cloud import servicecontrol
+
+from . import check_request, client, quota_request, report_request
+
+
+_logger = logging.getLogger(__name__)
+
+
+# the transport errors that are logged and sunk rather than raised
+_TRANSPORT_ERRORS = (exceptions.Error, api_core_exceptions.GoogleAPIError)
+
+
+class _AsyncServices(object):
+    """Adapts the generated async clients to the transport used by this module.
+
+    Like the transports used by :class:`client.Client`, it is accessed via
+    ``transport.services``, but its methods are coroutines.
+    """
+
+    def __init__(self):
+        self._service_controller = servicecontrol.ServiceControllerAsyncClient()
+        self._quota_controller = servicecontrol.QuotaControllerAsyncClient()
+
+    @property
+    def services(self):
+        return self
+
+    async def Check(self, req):  # pylint: disable=invalid-name
+        return await self._service_controller.check(request=req)
+
+    async def AllocateQuota(self, req):  # pylint: disable=invalid-name
+        return await self._quota_controller.allocate_quota(request=req)
+
+    async def Report(self, req):  # pylint: disable=invalid-name
+        return await self._service_controller.report(request=req)
+
+
+def load(service_name, loader=client.Loaders.DEFAULT, **kw):
+    """Creates an :class:`AsyncClient` configured by a client loader.
+
+    Args:
+      service_name (str): the name of the service to be controlled
+      loader (:class:`endpoints_management.control.client.Loaders`): loads
+        the check, quota and report options
+      **kw: other keyword args accepted by :class:`AsyncClient`
+    """
+    check_opts, quota_opts, report_opts = loader.load_options()
+    return AsyncClient(service_name, check_opts, quota_opts, report_opts, **kw)
+
+
+class AsyncClient(object):
+    """AsyncClient encapsulates all service control functionality for asyncio.
+
+    All methods must be called from a coroutine or callback running on the
+    event loop that the instance is used with.
+
+    """
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+
+    def __init__(self,
+                 service_name,
+                 check_options,
+                 quota_options,
+                 report_options,
+                 timer=datetime.utcnow,
+                 create_transport=_AsyncServices):
+        """
+
+        Args:
+            service_name (str): the name of the service to be controlled
+            check_options (:class:`endpoints_management.control.caches.CheckOptions`):
+              configures checking
+            quota_options (:class:`endpoints_management.control.caches.QuotaOptions`):
+              configures quota allocation
+            report_options (:class:`endpoints_management.control.caches.ReportOptions`):
+              configures reporting
+            timer (:func[[datetime.datetime]]: used to obtain the current time.
+            create_transport (:func): creates the transport; its services'
+              methods must return awaitables
+        """
+        self._check_aggregator = check_request.Aggregator(service_name,
+                                                          check_options,
+                                                          timer=timer)
+        self._quota_aggregator = quota_request.Aggregator(service_name,
+                                                          quota_options,
+                                                          timer=timer)
+        self._report_aggregator = report_request.Aggregator(service_name,
+                                                            report_options,
+                                                            timer=timer)
+        self._create_transport = create_transport
+        self._transport = None
+        self._flush_tasks = []
+        self._running = False
+
+    def start(self):
+        """Starts processing.
+
+        Calling this method starts the tasks that regularly flush all enabled
+        caches on the running event loop.
+        """
+        if self._running:
+            return
+
+        self._running = True
+        flushes = (
+            (self._check_aggregator.flush_interval, self._flush_check_aggregator),
+            (self._quota_aggregator.flush_interval, self._flush_quota_aggregator),
+            (self._report_aggregator.flush_interval, self._flush_report_aggregator),
+        )
+        for flush_interval, flush in flushes:
+            if not flush_interval or flush_interval.total_seconds() < 0:
+                _logger.debug(u'did not schedule %s: caching is disabled', flush)
+                continue
+            self._flush_tasks.append(asyncio.ensure_future(
+                self._run_flushes(flush_interval.total_seconds(), flush)))
+
+    async def stop(self):
+        """Halts processing
+
+        This cancels the flush tasks, then sends any aggregated reports and
+        clears the caches.
+        """
+        if not self._running:
+            _logger.debug(u'%s is already stopped', self)
+            return
+
+        self._running = False
+        tasks, self._flush_tasks = self._flush_tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        all_requests = self._report_aggregator.as_report_requests(
+            self._report_aggregator.clear())
+        _logger.debug(u'flushing all reports (count=%d)', len(all_requests))
+        await asyncio.gather(*[self._send_flushed_report(req)
+                               for req in all_requests])
+        self._check_aggregator.clear()
+        self._quota_aggregator.clear()
+
+    async def check(self, check_req):
+        """Process a check_request.
+
+        The req is first passed to the check_aggregator.  If there is a valid
+        cached response, that is returned, otherwise a response is obtained from
+        the transport.
+
+        If ``check_req`` is a :class:`check_request.Info`, the CheckRequest
+        is only made from it if it needs to be sent.
+
+        Args:
+          check_req (``CheckRequest`` or :class:`check_request.Info`): to be
+            sent to the service control service
+
+        Returns:
+           ``CheckResponse``: either the cached response if one is applicable
+            or a response from making a transport request, or None if
+            if the request to the transport fails
+
+        """
+        self.start()
+        res = self._check_aggregator.check(check_req)
+        if res:
+            _logger.debug(u'using cached check response for %s: %s',
+                          check_req, res)
+            return res
+
+        if isinstance(check_req, check_request.Info):
+            check_req = check_req.as_check_request()
+
+        # Application code should not fail because check request's don't
+        # complete, They should fail open, so here simply log the error and
+        # return None to indicate that no response was obtained
+        try:
+            resp = await self._get_transport().services.Check(check_req)
+            self._check_aggregator.add_response(check_req, resp)
+            return resp
+        except _TRANSPORT_ERRORS:
+            _logger.error(u'direct send of check request failed %s',
+                          check_req, exc_info=True)
+            return None
+
+    async def allocate_quota(self, allocate_quota_req):
+        """Process an allocate_quota_request.
+
+        If ``allocate_quota_req`` is a :class:`quota_request.Info`, the
+        AllocateQuotaRequest is only made from it if it needs to be sent.
+
+        Returns:
+           ``AllocateQuotaResponse``: the cached response, a response from
+           making a transport request, or an empty response if the request to
+           the transport fails
+        """
+        self.start()
+        res = self._quota_aggregator.allocate_quota(allocate_quota_req)
+        if res:
+            _logger.debug(u'using cached quota response for %s: %s',
+                          allocate_quota_req, res)
+            return res
+
+        if isinstance(allocate_quota_req, quota_request.Info):
+            allocate_quota_req = allocate_quota_req.as_allocate_quota_request()
+
+        # no cache, making direct request
+        try:
+            resp = await self._get_transport().services.AllocateQuota(
+                allocate_quota_req)
+            self._quota_aggregator.add_response(allocate_quota_req, resp)
+            return resp
+        except _TRANSPORT_ERRORS:
+            _logger.error(u'direct send of quota request failed %s',
+                          allocate_quota_req, exc_info=True)
+            # fail open
+            dummy_resp = servicecontrol.AllocateQuotaResponse()
+            self._quota_aggregator.add_response(allocate_quota_req, dummy_resp)
+            return dummy_resp
+
+    async def report(self, report_req):
+        """Processes a report request.
+
+        It will aggregate it with prior report_requests to be send later
+        or it will send it immediately if that's appropriate.
+        """
+        self.start()
+        if not self._report_aggregator.report(report_req):
+            _logger.debug(u'need to send a report request directly')
+            await self._send_flushed_report(report_req)
+
+    def _get_transport(self):
+        if self._transport is None:
+            self._transport = self._create_transport()
+        return self._transport
+
+    async def _run_flushes(self, interval_secs, flush):
+        while True:
+            await asyncio.sleep(interval_secs)
+            try:
+                await flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # pylint: disable=broad-except
+                _logger.error(u'%s failed', flush, exc_info=True)
+
+    async def _flush_check_aggregator(self):
+        _logger.debug(u'flushing the check aggregator')
+        await asyncio.gather(*[self._send_flushed_check(req)
+                               for req in self._check_aggregator.flush()])
+
+    async def _flush_quota_aggregator(self):
+        reqs = self._quota_aggregator.flush()
+        _logger.debug(u'flushing %d quota from the quota aggregator', len(reqs))
+        await asyncio.gather(*[self._send_flushed_quota(req) for req in reqs])
+
+    async def _flush_report_aggregator(self):
+        reqs = self._report_aggregator.flush()
+        _logger.debug(u"will flush %d report requests", len(reqs))
+        await asyncio.gather(*[self._send_flushed_report(req) for req in reqs])
+
+    async def _send_flushed_check(self, req):
+        try:
+            resp = await self._get_transport().services.Check(req)
+            self._check_aggregator.add_response(req, resp)
+        except Exception:  # pylint: disable=broad-except
+            _logger.error(u'failed to flush check_req %s', req, exc_info=True)
+
+    async def _send_flushed_quota(self, req):
+        try:
+            resp = await self._get_transport().services.AllocateQuota(req)
+            self._quota_aggregator.add_response(req, resp)
+        except Exception:  # pylint: disable=broad-except
+            _logger.error(u'failed to flush quota_req %s', req, exc_info=True)
+
+    async def _send_flushed_report(self, req):
+        try:
+            await self._get_transport().services.Report(req)
+        except _TRANSPORT_ERRORS:
+            _logger.error(u'failed to flush report_req %s', req, exc_info=True)
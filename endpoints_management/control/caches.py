@@ -21,6 +21,9 @@ cachetools open-source library.
 :class:`endpoints_management.control.CheckAggregationOptions` or a
 :class:`endpoints_management.control.ReportAggregationOptions`
 
+:func:`create_shared` creates a :class:`SharedMemoryCache`, through which the
+processes on a host share the responses they cache
+
 """
 
 from __future__ import absolute_import
@@ -36,10 +39,19 @@ from __future__ import absolute_import
 from builtins import object
 import collections
 import logging
+import mmap
+import os
+import struct
 import threading
 from datetime import datetime, timedelta
 
 import cachetools
+from enum import Enum
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
 
 _logger = logging.getLogger(__name__)
 
@@ -49,7 +61,10 @@ class CheckOptions(
             u'CheckOptions',
             [u'num_entries',
              u'flush_interval',
-             u'expiration'])):
+             u'expiration',
+             u'max_staleness',
+             u'num_shards',
+             u'shared_cache_path'])):
     """Holds values used to control report check behavior.
 
     Attributes:
@@ -63,6 +78,16 @@ class CheckOptions(
           check response should be deleted.  This value should be larger than
           ``flush_interval``, otherwise it will be ignored, and instead a value
           equivalent to flush_interval + 1ms will be used.
+        max_staleness (:class:`datetime.timedelta`): if set, a cached positive
+          check response continues to be used for up to this long after
+          ``flush_interval`` while it is refreshed in the background.  It is
+          never used once it has expired, so ``expiration`` should allow for
+          at least one more ``flush_interval`` than this.
+        num_shards (int): the number of separately locked partitions the
+          cache is split into; see :class:`ShardedCache`
+        shared_cache_path (string): if set, the path of the file holding a
+          :class:`SharedMemoryCache`, through which the processes using it
+          share their check responses
     """
     # pylint: disable=too-few-public-methods
     DEFAULT_NUM_ENTRIES = 200
@@ -72,18 +97,27 @@ class CheckOptions(
     def __new__(cls,
                 num_entries=DEFAULT_NUM_ENTRIES,
                 flush_interval=DEFAULT_FLUSH_INTERVAL,
-                expiration=DEFAULT_EXPIRATION):
+                expiration=DEFAULT_EXPIRATION,
+                max_staleness=None,
+                num_shards=1,
+                shared_cache_path=None):
         """Invokes the base constructor with default values."""
         assert isinstance(num_entries, int), u'should be an int'
+        assert isinstance(num_shards, int), u'should be an int'
         assert isinstance(flush_interval, timedelta), u'should be a timedelta'
         assert isinstance(expiration, timedelta), u'should be a timedelta'
+        assert max_staleness is None or isinstance(max_staleness, timedelta), (
+            u'should be a timedelta')
         if expiration <= flush_interval:
             expiration = flush_interval + timedelta(milliseconds=1)
         return super(cls, CheckOptions).__new__(
             cls,
             num_entries,
             flush_interval,
-            expiration)
+            expiration,
+            max_staleness,
+            num_shards,
+            shared_cache_path)
 
 
 class QuotaOptions(
@@ -91,7 +125,9 @@ class QuotaOptions(
             u'QuotaOptions',
             [u'num_entries',
              u'flush_interval',
-             u'expiration'])):
+             u'expiration',
+             u'num_shards',
+             u'shared_cache_path'])):
     """Holds values used to control report quota behavior.
 
     Attributes:
@@ -105,6 +141,11 @@ class QuotaOptions(
           quota response should be deleted.  This value should be larger than
           ``flush_interval``, otherwise it will be ignored, and instead a value
           equivalent to flush_interval + 1ms will be used.
+        num_shards (int): the number of separately locked partitions the
+          cache is split into; see :class:`ShardedCache`
+        shared_cache_path (string): if set, the path of the file holding a
+          :class:`SharedMemoryCache`, through which the processes using it
+          share their quota responses
     """
     # pylint: disable=too-few-public-methods
     DEFAULT_NUM_ENTRIES = 1000
@@ -114,9 +155,12 @@ class QuotaOptions(
     def __new__(cls,
                 num_entries=DEFAULT_NUM_ENTRIES,
                 flush_interval=DEFAULT_FLUSH_INTERVAL,
-                expiration=DEFAULT_EXPIRATION):
+                expiration=DEFAULT_EXPIRATION,
+                num_shards=1,
+                shared_cache_path=None):
         """Invokes the base constructor with default values."""
         assert isinstance(num_entries, int), u'should be an int'
+        assert isinstance(num_shards, int), u'should be an int'
         assert isinstance(flush_interval, timedelta), u'should be a timedelta'
         assert isinstance(expiration, timedelta), u'should be a timedelta'
         if expiration <= flush_interval:
@@ -125,14 +169,37 @@ class QuotaOptions(
             cls,
             num_entries,
             flush_interval,
-            expiration)
+            expiration,
+            num_shards,
+            shared_cache_path)
+
+
+class OverflowPolicy(Enum):
+    """Enumerates what is done with reports once aggregation is over budget."""
+    DROP_NEWEST = u'drop-newest'
+    """New operations are dropped until the next flush."""
+
+    DROP_OLDEST = u'drop-oldest'
+    """The operations waiting longest for the flush are dropped."""
+
+    COLLAPSE = u'collapse'
+    """New operations are aggregated without their high-cardinality labels.
+
+    The collapsed operations are kept apart from the pending ones, and up to
+    ``max_pending`` of them are kept; beyond that, new operations that do not
+    merge into one of them are dropped, as by :attr:`DROP_NEWEST`.
+    """
 
 
 class ReportOptions(
         collections.namedtuple(
             u'ReportOptions',
             [u'num_entries',
-             u'flush_interval'])):
+             u'flush_interval',
+             u'num_shards',
+             u'latency_sketch_accuracy',
+             u'max_pending',
+             u'overflow_policy'])):
     """Holds values used to control report aggregation behavior.
 
     Attributes:
@@ -143,6 +210,22 @@ class ReportOptions(
         flush_interval (:class:`datetime.timedelta`): the maximum delta before
           aggregated report requests are flushed to the server.  The cache
           entry is deleted after the flush
+
+        num_shards (int): the number of separately locked partitions the
+          cache is split into; see :class:`ShardedCache`
+
+        latency_sketch_accuracy (float): if set, latency distributions are
+          aggregated in a
+          :class:`endpoints_management.control.distribution.Sketch` with
+          this relative accuracy, and only projected onto their buckets when
+          they are flushed
+
+        max_pending (int): if set, at least 1; once the cache is full, the
+          maximum number of aggregated operations that are kept until the
+          next flush; like ``num_entries``, it is divided between the shards
+
+        overflow_policy (:class:`OverflowPolicy`): what is done with new
+          operations once ``max_pending`` is reached
     """
     # pylint: disable=too-few-public-methods
     DEFAULT_NUM_ENTRIES = 200
@@ -150,15 +233,32 @@ class ReportOptions(
 
     def __new__(cls,
                 num_entries=DEFAULT_NUM_ENTRIES,
-                flush_interval=DEFAULT_FLUSH_INTERVAL):
+                flush_interval=DEFAULT_FLUSH_INTERVAL,
+                num_shards=1,
+                latency_sketch_accuracy=None,
+                max_pending=None,
+                overflow_policy=OverflowPolicy.DROP_OLDEST):
         """Invokes the base constructor with default values."""
         assert isinstance(num_entries, int), u'should be an int'
         assert isinstance(flush_interval, timedelta), u'should be a timedelta'
+        assert isinstance(num_shards, int), u'should be an int'
+        assert (latency_sketch_accuracy is None or
+                isinstance(latency_sketch_accuracy, float)), u'should be a float'
+        assert (max_pending is None or
+                isinstance(max_pending, int)), u'should be an int'
+        assert max_pending is None or max_pending >= 1, (
+            u'should be at least 1')
+        assert isinstance(overflow_policy,
+                          OverflowPolicy), u'should be an OverflowPolicy'
 
         return super(cls, ReportOptions).__new__(
             cls,
             num_entries,
-            flush_interval)
+            flush_interval,
+            num_shards,
+            latency_sketch_accuracy,
+            max_pending,
+            overflow_policy)
 
 
 ZERO_INTERVAL = timedelta()
@@ -172,12 +272,14 @@ def create(options, timer=None, use_deque=True):
     :class:`endpoints_management.control.caches.ReportOptions`
 
     The returned cache is wrapped in a :class:`LockedObject`, requiring it to
-    be accessed in a with statement that gives synchronized access
+    be accessed in a with statement that gives synchronized access.  If
+    ``options.num_shards`` is more than 1, a :class:`ShardedCache` is
+    returned instead; each of its shards is a :class:`LockedObject`.
 
     Example:
       >>> options = CheckOptions()
       >>> synced_cache = make_cache(options)
-      >>> with synced_cache as cache:  #  acquire the lock
+      >>> with synced_cache.shard('a_key') as cache:  #  acquire the lock
       ...    cache['a_key'] = 'a_value'
 
     Args:
@@ -203,25 +305,71 @@ def create(options, timer=None, use_deque=True):
         return None
 
     _logger.debug(u"creating a cache from %s", options)
+    if options.num_shards <= 1:
+        return LockedObject(
+            _create_unlocked(options, options.num_entries, timer, use_deque))
+
+    # the shards share the entries between them
+    num_shards = min(options.num_shards, options.num_entries)
+    shard_size = -(-options.num_entries // num_shards)
+    return ShardedCache([
+        LockedObject(_create_unlocked(options, shard_size, timer, use_deque))
+        for _ in range(num_shards)])
+
+
+def create_shared(options, timer=None):
+    """Create the shared cache specified by ``options``
+
+    ``options`` is an instance of either
+    :class:`endpoints_management.control.caches.CheckOptions` or
+    :class:`endpoints_management.control.caches.QuotaOptions`.  The shared
+    cache has a slot for each of its ``num_entries``, and keeps each response
+    until its ``expiration``.
+
+    Args:
+      options (object): an instance of either of the options classes
+      timer (function([[datetime]]): a function that returns the current
+        as a time as a datetime instance
+
+    Returns:
+      :class:`SharedMemoryCache`: the cache specified by options, or None: if
+        options is ``None``, it has no ``shared_cache_path`` or if
+        options.num_entries < 0
+
+    """
+    path = getattr(options, u'shared_cache_path', None)
+    if path is None or options.num_entries <= 0:
+        return None
+
+    _logger.debug(u"creating a shared cache from %s", options)
+    return SharedMemoryCache(path,
+                             options.num_entries,
+                             options.expiration,
+                             timer=timer)
+
+
+def _create_unlocked(options, num_entries, timer, use_deque):
     if (options.flush_interval > ZERO_INTERVAL):
         # options always has a flush_interval, but may have an expiration
         # field. If the expiration is present, use that instead of the
         # flush_interval for the ttl
         ttl = getattr(options, u'expiration', options.flush_interval)
         cache_cls = DequeOutTTLCache if use_deque else cachetools.TTLCache
-        return LockedObject(
-            cache_cls(
-                options.num_entries,
-                ttl=ttl.total_seconds(),
-                timer=to_cache_timer(timer)
-            ))
+        return cache_cls(
+            num_entries,
+            ttl=ttl.total_seconds(),
+            timer=to_cache_timer(timer))
 
     cache_cls = DequeOutLRUCache if use_deque else cachetools.LRUCache
-    return LockedObject(cache_cls(options.num_entries))
+    return cache_cls(num_entries)
 
 
 class DequeOutTTLCache(cachetools.TTLCache):
-    """Extends ``TTLCache`` so that expired items are placed in a ``deque``."""
+    """Extends ``TTLCache`` so that expired items are placed in a ``deque``.
+
+    Items are added to the deque as they are evicted or expire, so reading
+    :attr:`out_deque` only costs as much as the number of items that expired.
+    """
 
     def __init__(self, maxsize, ttl, out_deque=None, **kw):
         """Constructor.
@@ -244,25 +392,48 @@ class DequeOutTTLCache(cachetools.TTLCache):
         elif not isinstance(out_deque, collections.deque):
             raise ValueError(u'out_deque should be a collections.deque')
         self._out_deque = out_deque
-        self._tracking = {}
+        # (value, expiry time) for each key, ordered by expiry; the ttl is
+        # fixed, so this is the order in which the keys were last set
+        self._tracking = collections.OrderedDict()
 
     def __setitem__(self, key, value, **kw):
         super(DequeOutTTLCache, self).__setitem__(key, value, **kw)
-        self._tracking[key] = value
+        self._tracking.pop(key, None)
+        self._tracking[key] = (value, self.timer() + self.ttl)
+
+    def __delitem__(self, key, **kw):
+        # TTLCache evicts items via pop(), so this also sees evictions
+        super(DequeOutTTLCache, self).__delitem__(key, **kw)
+        tracked = self._tracking.pop(key, None)
+        if tracked is not None:
+            self._out_deque.append(tracked[0])
+
+    def expire(self, time=None):
+        """Removes expired items, adding them to :attr:`out_deque`."""
+        if time is None:
+            time = self.timer()
+        result = super(DequeOutTTLCache, self).expire(time)
+        tracking = self._tracking
+        while tracking:
+            key, (value, expires) = next(iter(tracking.items()))
+            if time < expires:
+                break
+            del tracking[key]
+            self._out_deque.append(value)
+        return result
 
     @property
     def out_deque(self):
         """The :class:`collections.deque` to which expired items are added."""
         self.expire()
-        expired = {k: v for (k, v) in list(self._tracking.items()) if self.get(k) is None}
-        for k, v in list(expired.items()):
-            del self._tracking[k]
-            self._out_deque.append(v)
         return self._out_deque
 
 
 class DequeOutLRUCache(cachetools.LRUCache):
-    """Extends ``LRUCache`` so that expired items are placed in a ``deque``."""
+    """Extends ``LRUCache`` so that expired items are placed in a ``deque``.
+
+    Items are added to the deque as they are evicted.
+    """
 
     def __init__(self, maxsize, out_deque=None, **kw):
         """Constructor.
@@ -284,19 +455,16 @@ class DequeOutLRUCache(cachetools.LRUCache):
         elif not isinstance(out_deque, collections.deque):
             raise ValueError(u'out_deque should be collections.deque')
         self._out_deque = out_deque
-        self._tracking = {}
 
-    def __setitem__(self, key, value, **kw):
-        super(DequeOutLRUCache, self).__setitem__(key, value, **kw)
-        self._tracking[key] = value
+    def __delitem__(self, key, **kw):
+        # LRUCache evicts items via pop(), so this also sees evictions
+        value = cachetools.Cache.__getitem__(self, key)
+        super(DequeOutLRUCache, self).__delitem__(key, **kw)
+        self._out_deque.append(value)
 
     @property
     def out_deque(self):
         """The :class:`collections.deque` to which expired items are added."""
-        expired = {k: v for (k, v) in list(self._tracking.items()) if self.get(k) is None}
-        for k, v in list(expired.items()):
-            del self._tracking[k]
-            self._out_deque.append(v)
         return self._out_deque
 
 
@@ -304,6 +472,10 @@ class LockedObject(object):
     """LockedObject protects an object with a re-entrant lock.
 
     The lock is required by the context manager protocol.
+
+    It also provides the interface of :class:`ShardedCache`, acting as its
+    own only shard, so code using the caches made by :func:`create` need not
+    distinguish between them.
     """
     # pylint: disable=too-few-public-methods
 
@@ -318,6 +490,299 @@ class LockedObject(object):
     def __exit__(self, _exc_type, _exc_val, _exc_tb):
         self._lock.release()
 
+    @property
+    def shards(self):
+        """All the shards; this instance is the only one."""
+        return (self,)
+
+    def shard(self, dummy_key):
+        """The shard that holds a key; this instance is the only one."""
+        return self
+
+
+# the number of leading bytes of a key used to choose its shard
+_SHARD_PREFIX_SIZE = 4
+
+
+class ShardedCache(object):
+    """ShardedCache partitions cache entries between separately locked shards.
+
+    Each entry is assigned to a shard using a prefix of its key, so callers
+    only contend with others using keys in the same shard.  The keys are
+    expected to be signatures, i.e, bytes that are evenly distributed.
+
+    Example:
+      >>> with sharded_cache.shard(signature) as cache:
+      ...     item = cache.get(signature)
+      >>>
+      >>> for a_shard in sharded_cache.shards:  # e.g, when flushing
+      ...     with a_shard as cache:
+      ...         expired = list(cache.out_deque)
+
+    """
+
+    def __init__(self, shards):
+        """Constructor.
+
+        Args:
+          shards (list[:class:`LockedObject`]): the locked caches used as
+            shards
+        """
+        self._shards = tuple(shards)
+
+    @property
+    def shards(self):
+        """All the shards, as :class:`LockedObject` instances."""
+        return self._shards
+
+    def shard(self, key):
+        """The shard that holds ``key``.
+
+        Args:
+          key (bytes): the key of an entry in the cache
+
+        Returns:
+          :class:`LockedObject`: the shard
+        """
+        if isinstance(key, bytes):
+            index = int.from_bytes(key[:_SHARD_PREFIX_SIZE], u'big')
+        else:
+            index = hash(key)
+        return self._shards[index % len(self._shards)]
+
+
+# identifies the layout of the file used by a SharedMemoryCache
+_SHARED_MAGIC = b'ESPSHM01'
+
+# magic, number of slots, value size
+_SHARED_HEADER = struct.Struct(u'<8sII')
+_SHARED_HEADER_SIZE = 64
+
+# sequence number, time stored, expiry time, key length, value length
+_SLOT_HEADER = struct.Struct(u'<QddHI')
+_SLOT_HEADER_SIZE = 32
+_SEQUENCE = struct.Struct(u'<Q')
+
+_EPOCH = datetime(1970, 1, 1)
+
+# serializes the reopening of shared caches in a forked process; it is
+# replaced in the child, as it may be held by another thread at the fork
+_reopen_lock = threading.Lock()
+
+
+def _reset_reopen_lock():
+    global _reopen_lock  # pylint: disable=global-statement
+    _reopen_lock = threading.Lock()
+
+
+if hasattr(os, u'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_reopen_lock)
+
+
+class SharedMemoryCache(object):
+    """SharedMemoryCache is a fixed-size hash table in a memory-mapped file.
+
+    It maps keys to serialized responses, so that the processes on a host,
+    e.g, the workers of a pre-fork server, can use the responses each of them
+    receives.  Each key has a single slot, chosen using a prefix of the key;
+    the keys are expected to be signatures, i.e, bytes that are evenly
+    distributed.  A key replaces whatever is in its slot, and values that do
+    not fit in a slot are not cached.
+
+    Writes are serialized by a lock on the file.  Reads take no lock; each
+    slot has a sequence number that is odd while the slot is written, and a
+    read that sees it change is treated as a miss.  A cache may be created
+    before a server forks its workers: the first write in a new process
+    reopens the file, as locks on the file opened by the parent would be
+    shared with it.
+
+    Thread safe.
+
+    Example:
+      >>> shared = SharedMemoryCache('/dev/shm/a_service', 200,
+      ...                            timedelta(seconds=1))
+      >>> shared.set(signature, resp_bytes)
+      >>> found = shared.get(signature)  # in this or another process
+      >>> if found is not None:
+      ...     resp_bytes, stored_time = found
+
+    """
+
+    KEY_SIZE = 64
+    """The maximum size of a key."""
+
+    DEFAULT_VALUE_SIZE = 4096
+    """The default maximum size of a value."""
+
+    def __init__(self, path, num_slots, ttl,
+                 value_size=DEFAULT_VALUE_SIZE, timer=None):
+        """Constructor.
+
+        The file is created if needed, and is reset if its layout differs
+        from the one given here, so all the processes sharing it should use
+        the same layout.
+
+        Args:
+          path (string): the path of the file holding the cache
+          num_slots (int): the number of slots in the cache
+          ttl (:class:`datetime.timedelta`): how long a value is kept
+          value_size (int): the maximum size of a value
+          timer (function([[datetime]]): a function that returns the current
+            as a time as a datetime instance
+
+        Raises:
+          ValueError: if num_slots or value_size are not positive, or if
+            files cannot be locked on this platform
+
+        """
+        if fcntl is None:
+            raise ValueError(u'shared caches are not supported here')
+        if num_slots <= 0 or value_size <= 0:
+            raise ValueError(u'num_slots and value_size should be > 0')
+        self._num_slots = num_slots
+        self._value_size = value_size
+        self._slot_size = (
+            _SLOT_HEADER_SIZE + self.KEY_SIZE + value_size + 7) // 8 * 8
+        self._ttl = ttl.total_seconds()
+        self._timer = to_cache_timer(timer)
+        self._path = path
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        size = _SHARED_HEADER_SIZE + num_slots * self._slot_size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            with self._write_lock():
+                self._map = self._open_map(size)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def _open_map(self, size):
+        header = _SHARED_HEADER.pack(_SHARED_MAGIC, self._num_slots,
+                                     self._value_size)
+        existing = os.fstat(self._fd).st_size
+        if existing == size:
+            the_map = mmap.mmap(self._fd, size)
+            if the_map[:_SHARED_HEADER.size] == header:
+                return the_map
+            the_map.close()
+        _logger.debug(u'resetting the shared cache in fd %d', self._fd)
+        os.ftruncate(self._fd, 0)
+        os.ftruncate(self._fd, size)
+        the_map = mmap.mmap(self._fd, size)
+        the_map[:_SHARED_HEADER.size] = header
+        return the_map
+
+    def _write_lock(self):
+        self._reopen_if_forked()
+        return _FileLock(self._lock, self._fd)
+
+    def _reopen_if_forked(self):
+        # a forked process shares the open file, and so its flock, with its
+        # parent, and its copy of the thread lock may never be released
+        if self._pid == os.getpid():
+            return
+        with _reopen_lock:
+            if self._pid == os.getpid():
+                return
+            inherited_fd = self._fd
+            self._fd = os.open(self._path, os.O_RDWR)
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+            os.close(inherited_fd)  # the parent's lock on it is unaffected
+
+    def _slot_offset(self, key):
+        if not isinstance(key, bytes):
+            raise ValueError(u'shared cache keys should be bytes')
+        index = int.from_bytes(key[:8], u'big') % self._num_slots
+        return _SHARED_HEADER_SIZE + index * self._slot_size
+
+    def get(self, key):
+        """Obtains the value of ``key``, if it is cached and has not expired.
+
+        Args:
+          key (bytes): the key
+
+        Returns:
+          tuple(bytes, :class:`datetime.datetime`): the value and the time it
+            was stored, or None if there is no current value
+
+        """
+        offset = self._slot_offset(key)
+        the_map = self._map
+        sequence, stored, expires, key_len, value_len = (
+            _SLOT_HEADER.unpack_from(the_map, offset))
+        if sequence % 2 or key_len != len(key):
+            return None
+        key_start = offset + _SLOT_HEADER_SIZE
+        if the_map[key_start:key_start + key_len] != key:
+            return None
+        value_start = key_start + self.KEY_SIZE
+        value = the_map[value_start:value_start + value_len]
+        if _SEQUENCE.unpack_from(the_map, offset)[0] != sequence:
+            return None  # the slot changed while it was read
+        if self._timer() >= expires:
+            return None
+        return value, _EPOCH + timedelta(seconds=stored)
+
+    def set(self, key, value):
+        """Stores ``value`` as the value of ``key``.
+
+        Args:
+          key (bytes): the key
+          value (bytes): the value
+
+        Returns:
+          bool: ``True`` if the value was stored, ``False`` if the key or
+            value are too large
+
+        """
+        offset = self._slot_offset(key)
+        if len(key) > self.KEY_SIZE or len(value) > self._value_size:
+            _logger.debug(u'did not add %r to the shared cache, it is too '
+                          u'large', key)
+            return False
+        now = self._timer()
+        the_map = self._map
+        key_start = offset + _SLOT_HEADER_SIZE
+        value_start = key_start + self.KEY_SIZE
+        with self._write_lock():
+            sequence = _SEQUENCE.unpack_from(the_map, offset)[0]
+            _SLOT_HEADER.pack_into(the_map, offset, sequence + 1, now,
+                                   now + self._ttl, len(key), len(value))
+            the_map[key_start:key_start + len(key)] = key
+            the_map[value_start:value_start + len(value)] = value
+            _SEQUENCE.pack_into(the_map, offset, sequence + 2)
+        return True
+
+    def close(self):
+        """Releases the memory map and the file; the file is not removed."""
+        self._map.close()
+        os.close(self._fd)
+
+
+class _FileLock(object):
+    """Locks a file against other processes, and a lock against threads."""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, lock, fd):
+        self._lock = lock
+        self._fd = fd
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except Exception:
+            self._lock.release()
+            raise
+
+    def __exit__(self, _exc_type, _exc_val, _exc_tb):
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+
 
 def to_cache_timer(datetime_func):
     """Converts a datetime_func to a timestamp_func.
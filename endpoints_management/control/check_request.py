@@ -31,7 +31,6 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import object
 import collections
-import hashlib
 import http.client
 import logging
 from datetime import datetime
@@ -39,8 +38,7 @@ from datetime import datetime
 import google.cloud.servicecontrol as sc_messages
 from google.protobuf.json_format import MessageToDict
 
-from . import (caches, label_descriptor, metric_value, operation,
-               signing)
+from . import caches, label_descriptor, operation, signing
 from .. import USER_AGENT, SERVICE_AGENT
 
 _logger = logging.getLogger(__name__)
@@ -166,25 +164,26 @@ def sign(check_request):
     if not op or not op.operation_name or not op.consumer_id:
         logging.error(u'Bad %s: not initialized => not signed', check_request)
         raise ValueError(u'check request must be initialized with an operation')
-    md5 = hashlib.md5()
-    md5.update(op.operation_name.encode('utf-8'))
-    md5.update(b'\x00')
-    md5.update(op.consumer_id.encode('utf-8'))
-    if op.labels:
-        sorted_labels = {k: op.labels[k] for k in sorted(op.labels)}
-        signing.add_dict_to_hash(md5, sorted_labels)
+    parts = signing.operation_parts(
+        op.operation_name, op.consumer_id, op.labels)
     for value_set in op.metric_value_sets:
-        md5.update(b'\x00')
-        md5.update(value_set.metric_name.encode('utf-8'))
+        parts.append(value_set.metric_name)
         for mv in value_set.metric_values:
-            metric_value.update_hash(md5, mv)
+            signing.add_labels(parts, mv.labels)
 
-    md5.update(b'\x00')
-    return md5.digest()
+    parts.append(u'')
+    return signing.sign(parts)
 
 
 _KNOWN_LABELS = label_descriptor.KnownLabels
 
+# Forcibly add system label reporting to all requests, as the base service
+# config does not specify it as a label.
+_SYSTEM_LABELS = {
+    _KNOWN_LABELS.SCC_SERVICE_AGENT.label_name: SERVICE_AGENT,
+    _KNOWN_LABELS.SCC_USER_AGENT.label_name: USER_AGENT,
+}
+
 
 class Info(collections.namedtuple(u'Info',
                                   (u'client_ip',) + operation.Info._fields),
@@ -220,7 +219,37 @@ class Info(collections.namedtuple(u'Info',
         if not self.operation_name:
             raise ValueError(u'the operation name must be set')
         op = super(Info, self).as_operation(timer=timer)
-        labels = {}
+        op.labels = self._labels()
+        check_request = sc_messages.CheckRequest(
+            service_name=self.service_name,
+            operation=op,
+        )
+        return check_request
+
+    def signature(self):
+        """Obtains the signature of the `CheckRequest` made from this instance.
+
+        This is the same as ``sign(self.as_check_request())``, but it is
+        obtained without making the request.
+
+        Returns:
+           string: a secure hash generated from the fields of this instance
+
+        Raises:
+          ValueError: if the fields in this instance are insufficient to
+            to sign a ``CheckRequest``
+
+        """
+        consumer_id = self.consumer_id
+        if not self.operation_name or not consumer_id:
+            raise ValueError(u'check info must have an operation and consumer')
+        parts = signing.operation_parts(
+            self.operation_name, consumer_id, self._labels())
+        parts.append(u'')
+        return signing.sign(parts)
+
+    def _labels(self):
+        labels = dict(_SYSTEM_LABELS)
         if self.android_cert_fingerprint:
             labels[_KNOWN_LABELS.SCC_ANDROID_CERT_FINGERPRINT.label_name] = self.android_cert_fingerprint
 
@@ -236,17 +265,7 @@ class Info(collections.namedtuple(u'Info',
         if self.referer:
             labels[_KNOWN_LABELS.SCC_REFERER.label_name] = self.referer
 
-        # Forcibly add system label reporting here, as the base service
-        # config does not specify it as a label.
-        labels[_KNOWN_LABELS.SCC_SERVICE_AGENT.label_name] = SERVICE_AGENT
-        labels[_KNOWN_LABELS.SCC_USER_AGENT.label_name] = USER_AGENT
-
-        op.labels = labels
-        check_request = sc_messages.CheckRequest(
-            service_name=self.service_name,
-            operation=op,
-        )
-        return check_request
+        return labels
 
 
 class Aggregator(object):
@@ -319,8 +338,13 @@ class Aggregator(object):
         self._service_name = service_name
         self._options = options
         self._cache = caches.create(options, timer=timer)
+        self._shared_cache = (None if self._cache is None else
+                              caches.create_shared(options, timer=timer))
         self._kinds = {} if kinds is None else dict(kinds)
         self._timer = timer
+        # (signature, item) for the stale items being served while they are
+        # refreshed; a deque, as they are added under different shard locks
+        self._stale_items = collections.deque()
 
     @property
     def service_name(self):
@@ -336,7 +360,13 @@ class Aggregator(object):
            cache is set
 
         """
-        return None if self._cache is None else self._options.expiration
+        if self._cache is None:
+            return None
+        if self._options.max_staleness is not None:
+            # stale responses are refreshed by flushing, so flush often enough
+            # to refresh them before they expire
+            return self._options.flush_interval
+        return self._options.expiration
 
     def flush(self):
         """Flushes this instance's cache.
@@ -351,19 +381,28 @@ class Aggregator(object):
         """
         if self._cache is None:
             return []
-        with self._cache as c:
-            flushed_items = list(c.out_deque)
-            c.out_deque.clear()
-            cached_reqs = [item.extract_request() for item in flushed_items]
-            cached_reqs = [req for req in cached_reqs if req is not None]
-            return cached_reqs
+        cached_reqs = []
+        for shard in self._cache.shards:
+            with shard as c:
+                out_deque = c.out_deque
+                cached_reqs.extend(item.extract_request() for item in out_deque)
+                out_deque.clear()
+        # stale items being served while they are refreshed
+        stale_items = self._stale_items
+        while stale_items:
+            signature, item = stale_items.popleft()
+            with self._cache.shard(signature):
+                cached_reqs.append(item.extract_request())
+        return [req for req in cached_reqs if req is not None]
 
     def clear(self):
         """Clears this instance's cache."""
         if self._cache is not None:
-            with self._cache as c:
-                c.clear()
-                c.out_deque.clear()
+            for shard in self._cache.shards:
+                with shard as c:
+                    c.clear()
+                    c.out_deque.clear()
+            self._stale_items.clear()
 
     def add_response(self, req, resp):
         """Adds the response from sending to `req` to this instance's cache.
@@ -375,7 +414,7 @@ class Aggregator(object):
         if self._cache is None:
             return
         signature = sign(req)
-        with self._cache as c:
+        with self._cache.shard(signature) as c:
             now = self._timer()
             quota_scale = 0  # WIP
             item = c.get(signature)
@@ -389,6 +428,9 @@ class Aggregator(object):
                 item.quota_scale = quota_scale
                 item.is_flushing = False
                 c[signature] = item
+        if self._shared_cache is not None:
+            self._shared_cache.set(signature,
+                                   sc_messages.CheckResponse.serialize(resp))
 
     def check(self, req):
         """Determine if ``req`` is in this instances cache.
@@ -416,9 +458,21 @@ class Aggregator(object):
         info updated to the same as requested.  The requested tokens are
         aggregated until flushed.
 
+        Cache behaviour - stale response passed
+
+        If the options set ``max_staleness``, a CheckResponse with no errors
+        that is past the flush interval by less than ``max_staleness`` is
+        still returned.  The first such call queues the aggregated request to
+        be sent by the next :meth:`flush`, whose response refreshes it.
+
+        If ``req`` is an :class:`Info`, its signature is obtained without
+        making a CheckRequest, and a cache hit does not make one either; if
+        None is returned, the caller should make the request from it and send
+        that.
+
         Args:
-          req (``ServicecontrolServicesCheckRequest``): to be sent to
-            the service control service
+          req (``ServicecontrolServicesCheckRequest`` or :class:`Info`): to
+            be sent to the service control service
 
         Raises:
            ValueError: if the ``req`` service_name is not the same as
@@ -432,31 +486,50 @@ class Aggregator(object):
         """
         if self._cache is None:
             return None  # no cache, send request now
-        if not isinstance(req, sc_messages.CheckRequest):
+        if not isinstance(req, (sc_messages.CheckRequest, Info)):
             raise ValueError(u'Invalid request')
         if req.service_name != self.service_name:
             _logger.error(u'bad check(): service_name %s does not match ours %s',
                           req.service_name, self.service_name)
             raise ValueError(u'Service name mismatch')
-        check_request = req
-        op = check_request.operation
-        if op is None:
-            _logger.error(u'bad check(): no operation in %s', req)
-            raise ValueError(u'Expected operation not set')
-        if op.importance != sc_messages.Operation.Importance.LOW:
-            return None  # op is important, send request now
-
-        signature = sign(check_request)
-        with self._cache as cache:
+        if isinstance(req, Info):
+            # the operations made from an Info are never important
+            signature = req.signature()
+        else:
+            check_request = req
+            op = check_request.operation
+            if op is None:
+                _logger.error(u'bad check(): no operation in %s', req)
+                raise ValueError(u'Expected operation not set')
+            if op.importance != sc_messages.Operation.Importance.LOW:
+                return None  # op is important, send request now
+            signature = sign(check_request)
+
+        with self._cache.shard(signature) as cache:
             _logger.debug(u'checking the cache for %r\n%s', signature, cache)
             item = cache.get(signature)
             if item is None:
-                return None  # signal to caller to send req
-            else:
-                return self._handle_cached_response(req, item)
-
-    def _handle_cached_response(self, req, item):
-        with self._cache:  # defensive, this re-entrant lock should be held
+                item = self._from_shared_cache(signature)
+                if item is None:
+                    return None  # signal to caller to send req
+                cache[signature] = item
+            return self._handle_cached_response(req, signature, item)
+
+    def _from_shared_cache(self, signature):
+        # uses a response added by another process sharing the cache
+        if self._shared_cache is None:
+            return None
+        found = self._shared_cache.get(signature)
+        if found is None:
+            return None
+        data, last_check_time = found
+        _logger.debug(u'using the shared response for %r', signature)
+        return CachedItem(sc_messages.CheckResponse.deserialize(data),
+                          self.service_name, last_check_time, 0)
+
+    def _handle_cached_response(self, req, signature, item):
+        # defensive, this re-entrant lock should be held
+        with self._cache.shard(signature):
             if len(item.response.check_errors) > 0:
                 if self._is_current(item):
                     return item.response
@@ -465,10 +538,21 @@ class Aggregator(object):
                 item.last_check_time = self._timer()
                 return None  # signal caller to send req
             else:
-                item.update_request(req, self._kinds)
+                if isinstance(req, Info):
+                    item.update_info(req, self._timer())
+                else:
+                    item.update_request(req, self._kinds)
                 if self._is_current(item):
                     return item.response
 
+                if self._may_serve_stale(item):
+                    if not item.is_flushing:
+                        # the next flush sends the aggregated request, and its
+                        # response refreshes the item
+                        item.is_flushing = True
+                        self._stale_items.append((signature, item))
+                    return item.response
+
                 if (item.is_flushing):
                     _logger.warn(u'last refresh request did not complete')
 
@@ -480,6 +564,13 @@ class Aggregator(object):
         age = self._timer() - item.last_check_time
         return age < self._options.flush_interval
 
+    def _may_serve_stale(self, item):
+        max_staleness = self._options.max_staleness
+        if max_staleness is None:
+            return False
+        age = self._timer() - item.last_check_time
+        return age < self._options.flush_interval + max_staleness
+
 
 class CachedItem(object):
     """CachedItem holds items cached along with a ``CheckRequest``.
@@ -503,6 +594,11 @@ class CachedItem(object):
         self.response = resp
         self._service_name = service_name
         self._op_aggregator = None
+        # the first Info aggregated since the last extraction, and the times
+        # of the first and last of them; their operations are made on
+        # extraction, as those made from an Info differ only in their times
+        self._info = None
+        self._info_times = None
 
     def update_request(self, req, kinds):
         agg = self._op_aggregator
@@ -512,7 +608,20 @@ class CachedItem(object):
         else:
             agg.add(req.operation)
 
+    def update_info(self, info, when):
+        if self._info is None:
+            self._info = info
+            self._info_times = (when, when)
+        else:
+            self._info_times = (self._info_times[0], when)
+
     def extract_request(self):
+        if self._info is not None:
+            info, times = self._info, self._info_times
+            self._info = self._info_times = None
+            for when in sorted(set(times)):
+                self.update_request(
+                    info.as_check_request(timer=lambda: when), None)
         if self._op_aggregator is None:
             return None
 
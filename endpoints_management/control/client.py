@@ -41,11 +41,13 @@ from __future__ import absolute_import
 
 from builtins import object
 from apitools.base.py import exceptions
+from concurrent import futures
 from datetime import datetime, timedelta
 from enum import Enum
 import json
 import logging
 import os
+import queue
 import threading
 import time
 
@@ -53,7 +55,8 @@ from google.cloud import servicecontrol
 
 from . import check_request, quota_request, report_request
 from .. import USER_AGENT
-from .caches import CheckOptions, QuotaOptions, ReportOptions, to_cache_timer
+from .caches import (CheckOptions, OverflowPolicy, QuotaOptions,
+                     ReportOptions, to_cache_timer)
 from .vendor.py3 import sched
 
 
@@ -62,6 +65,9 @@ _logger = logging.getLogger(__name__)
 
 CONFIG_VAR = u'ENDPOINTS_SERVER_CONFIG_FILE'
 MAX_IDLE_TIME_SECONDS = 120
+DEFAULT_CHECK_COALESCE_TIMEOUT = timedelta(seconds=1)
+SPOOL_REPLAY_INTERVAL = timedelta(seconds=1)
+MAX_SPOOL_REPLAY_INTERVAL = timedelta(minutes=5)
 
 
 def _load_from_well_known_env():
@@ -83,17 +89,20 @@ def _load_from_well_known_env():
                 expiration=timedelta(
                     milliseconds=check_json[u'responseExpirationMs']),
                 flush_interval=timedelta(
-                    milliseconds=check_json[u'flushIntervalMs']))
+                    milliseconds=check_json[u'flushIntervalMs']),
+                **_optional_check_options(check_json))
             quota_options = QuotaOptions(
                 num_entries=quota_json[u'cacheEntries'],
                 expiration=timedelta(
                     milliseconds=quota_json[u'expirationMs']),
                 flush_interval=timedelta(
-                    milliseconds=quota_json[u'flushIntervalMs']))
+                    milliseconds=quota_json[u'flushIntervalMs']),
+                **_optional_shared_cache_options(quota_json))
             report_options = ReportOptions(
                 num_entries=report_json[u'cacheEntries'],
                 flush_interval=timedelta(
-                    milliseconds=report_json[u'flushIntervalMs']))
+                    milliseconds=report_json[u'flushIntervalMs']),
+                **_optional_report_options(report_json))
             return check_options, quota_options, report_options
     except (KeyError, ValueError):
         _logger.warn(u'did not load service; bad json config file %s',
@@ -102,6 +111,41 @@ def _load_from_well_known_env():
         return _load_default()
 
 
+def _optional_options(json_dict):
+    # only the settings that are present are used, so the others default
+    kw = {}
+    if u'cacheShards' in json_dict:
+        kw[u'num_shards'] = json_dict[u'cacheShards']
+    return kw
+
+
+def _optional_shared_cache_options(json_dict):
+    kw = _optional_options(json_dict)
+    if u'sharedCachePath' in json_dict:
+        kw[u'shared_cache_path'] = json_dict[u'sharedCachePath']
+    return kw
+
+
+def _optional_check_options(check_json):
+    kw = _optional_shared_cache_options(check_json)
+    if u'maxStalenessMs' in check_json:
+        kw[u'max_staleness'] = timedelta(
+            milliseconds=check_json[u'maxStalenessMs'])
+    return kw
+
+
+def _optional_report_options(report_json):
+    kw = _optional_options(report_json)
+    if u'latencySketchAccuracy' in report_json:
+        kw[u'latency_sketch_accuracy'] = float(
+            report_json[u'latencySketchAccuracy'])
+    if u'maxPendingEntries' in report_json:
+        kw[u'max_pending'] = report_json[u'maxPendingEntries']
+    if u'overflowPolicy' in report_json:
+        kw[u'overflow_policy'] = OverflowPolicy(report_json[u'overflowPolicy'])
+    return kw
+
+
 def _load_default():
     return CheckOptions(), QuotaOptions(), ReportOptions()
 
@@ -126,8 +170,12 @@ class Loaders(Enum):
         """
         self._load_func = load_func
 
+    def load_options(self):
+        """Loads the check, quota and report options used to create clients."""
+        return self._load_func()
+
     def load(self, service_name, **kw):
-        check_opts, quota_opts, report_opts = self._load_func()
+        check_opts, quota_opts, report_opts = self.load_options()
         return Client(service_name, check_opts, quota_opts, report_opts, **kw)
 
 
@@ -187,7 +235,11 @@ class Client(object):
                  quota_options,
                  report_options,
                  timer=datetime.utcnow,
-                 create_transport=_CREATE_THREAD_LOCAL_TRANSPORT):
+                 create_transport=_CREATE_THREAD_LOCAL_TRANSPORT,
+                 report_queue_size=0,
+                 flush_workers=0,
+                 check_coalesce_timeout=DEFAULT_CHECK_COALESCE_TIMEOUT,
+                 report_spool=None):
         """
 
         Args:
@@ -199,6 +251,20 @@ class Client(object):
             report_options (:class:`endpoints_management.control.caches.ReportOptions`):
               configures reporting
             timer (:func[[datetime.datetime]]: used to obtain the current time.
+            report_queue_size (int): if > 0, :func:`report_info` queues up to
+              this many infos for a background thread to convert into report
+              requests; otherwise they are converted on the calling thread
+            flush_workers (int): if > 0, requests obtained by flushing the
+              check, quota and report aggregators are sent concurrently, by
+              up to this many threads for each kind of request; otherwise
+              they are sent one at a time on the scheduler thread
+            check_coalesce_timeout (:class:`datetime.timedelta`): how long a
+              check that has the same signature as one already being sent
+              waits for that one's response before failing open; if
+              ``None``, every cache miss is sent
+            report_spool (:class:`endpoints_management.control.spool.Spool`):
+              if set, report requests that fail to send are kept in it, and
+              are replayed by a background thread
         """
         self._check_aggregator = check_request.Aggregator(service_name,
                                                           check_options,
@@ -217,6 +283,53 @@ class Client(object):
         self._create_transport = create_transport
         self._lock = threading.RLock()
         self._idle_timer_started_at = None
+        self._report_queue = None
+        if report_queue_size > 0:
+            self._report_queue = queue.Queue(report_queue_size)
+        self._report_queue_drops = 0
+        self._report_queue_drops_lock = threading.Lock()
+        self._report_thread = None
+        self._flush_workers = flush_workers
+        self._flush_executors = {}
+        self._check_flights = None
+        self._check_coalesce_timeout = None
+        if check_coalesce_timeout is not None:
+            self._check_flights = _SingleFlight()
+            self._check_coalesce_timeout = check_coalesce_timeout.total_seconds()
+        self._report_spool = report_spool
+        self._spool_thread = None
+        self._spool_stopping = None
+
+    @property
+    def report_queue_depth(self):
+        """The number of infos waiting to be converted to report requests."""
+        if self._report_queue is None:
+            return 0
+        return self._report_queue.qsize()
+
+    @property
+    def report_queue_drops(self):
+        """The number of infos dropped because the report queue was full."""
+        return self._report_queue_drops
+
+    @property
+    def report_overflows(self):
+        """The number of operations dropped or collapsed by each overflow policy."""
+        return self._report_aggregator.overflows
+
+    @property
+    def check_coalesced_waiters(self):
+        """The number of checks that waited for a concurrent identical check."""
+        if self._check_flights is None:
+            return 0
+        return self._check_flights.waiters
+
+    @property
+    def check_coalesce_timeouts(self):
+        """The number of coalesced checks that failed open after waiting."""
+        if self._check_flights is None:
+            return 0
+        return self._check_flights.timeouts
 
     def _start_idle_timer(self):
         self._idle_timer_started_at = self._timer()
@@ -251,6 +364,67 @@ class Client(object):
                     exc_info=True)
                 self._thread = None
                 self._initialize_flushing()
+            self._start_report_thread()
+            self._start_flush_executors()
+            self._start_spool_thread()
+
+    def _start_flush_executors(self):
+        if self._flush_workers <= 0 or self._flush_executors:
+            return
+        # each kind has its own executor, so that slow report requests never
+        # delay check and quota refreshes
+        for kind in _FLUSH_KINDS:
+            self._flush_executors[kind] = futures.ThreadPoolExecutor(
+                max_workers=self._flush_workers,
+                thread_name_prefix=u'%s-flush' % (kind,))
+
+    def _stop_flush_executors(self):
+        executors = self._flush_executors
+        self._flush_executors = {}
+        for executor in executors.values():
+            executor.shutdown(wait=False)
+
+    def _submit_flush(self, kind, send_func, req):
+        executor = self._flush_executors.get(kind)
+        if executor is not None:
+            try:
+                return executor.submit(send_func, req)
+            except RuntimeError:  # the executor was shutdown by stop()
+                _logger.debug(u'flush executor is shutdown, sending %s directly', kind)
+        send_func(req)
+        return None
+
+    def _start_report_thread(self):
+        if self._report_queue is None or self._report_thread is not None:
+            return
+        self._report_thread = create_thread(target=self._process_report_queue)
+        try:
+            self._report_thread.start()
+        except Exception:  # pylint: disable=broad-except
+            _logger.warn(
+                u'no report thread, report_info(...) will build reports directly',
+                exc_info=True)
+            self._report_thread = None
+
+    def _start_spool_thread(self):
+        if self._report_spool is None or self._spool_thread is not None:
+            return
+        self._spool_stopping = threading.Event()
+        self._spool_thread = create_thread(target=self._replay_report_spool)
+        try:
+            self._spool_thread.start()
+        except Exception:  # pylint: disable=broad-except
+            _logger.warn(u'no spool thread, spooled reports will not be sent',
+                         exc_info=True)
+            self._spool_thread = None
+
+    def _stop_report_spool(self):
+        if self._spool_thread is not None:
+            self._spool_stopping.set()
+            self._spool_thread.join()
+            self._spool_thread = None
+        if self._report_spool is not None:
+            self._report_spool.close()  # syncs the newest segment
 
     def stop(self):
         """Halts processing
@@ -264,7 +438,10 @@ class Client(object):
                 _logger.debug(u'%s is already stopped', self)
                 return
 
+            self._stop_report_thread()
             self._flush_all_reports()
+            self._stop_flush_executors()
+            self._stop_report_spool()
             self._stopped = True
             if self._run_scheduler_directly:
                 self._cleanup_if_stopped()
@@ -284,9 +461,13 @@ class Client(object):
         cached response, that is returned, otherwise a response is obtained from
         the transport.
 
+        If ``check_req`` is a :class:`check_request.Info`, the CheckRequest
+        is only made from it if it needs to be sent.
+
         Args:
-          check_req (``ServicecontrolServicesCheckRequest``): to be sent to
-            the service control service
+          check_req (``ServicecontrolServicesCheckRequest`` or
+            :class:`check_request.Info`): to be sent to the service control
+            service
 
         Returns:
            ``CheckResponse``: either the cached response if one is applicable
@@ -302,6 +483,32 @@ class Client(object):
                           check_request, res)
             return res
 
+        if isinstance(check_req, check_request.Info):
+            check_req = check_req.as_check_request()
+
+        if not self._should_coalesce(check_req):
+            return self._send_check(check_req)
+
+        # concurrent misses for the same signature share a single request
+        signature = check_request.sign(check_req)
+        resp, is_waiter = self._check_flights.do(
+            signature,
+            lambda: self._send_check(check_req),
+            self._check_coalesce_timeout)
+        if is_waiter:
+            # aggregate this request's operation into the refreshed cache entry
+            res = self._check_aggregator.check(check_req)
+            if res:
+                return res
+        return resp
+
+    def _should_coalesce(self, check_req):
+        return (self._check_flights is not None and
+                self._check_aggregator.flush_interval is not None and
+                check_req.operation.importance ==
+                servicecontrol.Operation.Importance.LOW)
+
+    def _send_check(self, check_req):
         # Application code should not fail because check request's don't
         # complete, They should fail open, so here simply log the error and
         # return None to indicate that no response was obtained
@@ -316,6 +523,16 @@ class Client(object):
             return None
 
     def allocate_quota(self, allocate_quota_req):
+        """Process an allocate_quota_request.
+
+        If ``allocate_quota_req`` is a :class:`quota_request.Info`, the
+        AllocateQuotaRequest is only made from it if it needs to be sent.
+
+        Returns:
+           ``AllocateQuotaResponse``: the cached response, a response from
+           making a transport request, or an empty response if the request to
+           the transport fails
+        """
         self.start()
         res = self._quota_aggregator.allocate_quota(allocate_quota_req)
         if res:
@@ -323,6 +540,9 @@ class Client(object):
                           allocate_quota_req, res)
             return res
 
+        if isinstance(allocate_quota_req, quota_request.Info):
+            allocate_quota_req = allocate_quota_req.as_allocate_quota_request()
+
         # no cache, making direct request
         try:
             transport = self._create_transport()
@@ -350,6 +570,82 @@ class Client(object):
         if self._run_scheduler_directly:
             self._scheduler.run(blocking=False)
 
+        self._aggregate_report(report_req)
+
+    def report_info(self, info, rules, now):
+        """Processes the report described by ``info``.
+
+        If a report queue is configured, converting ``info`` to a report
+        request is left to a background thread, otherwise it's done before
+        this returns.  If the queue is full, ``info`` is dropped.
+
+        Args:
+          info (:class:`endpoints_management.control.report_request.Info`):
+            describes the report
+          rules (:class:`endpoints_management.control.report_request.ReportingRules`):
+            determines what is included in the report request
+          now (:class:`datetime.datetime`): the time of the report
+        """
+        self.start()
+        if self._report_thread is None:
+            self.report(_as_report_request(info, rules, now))
+            return
+
+        try:
+            self._report_queue.put_nowait((info, rules, now))
+        except queue.Full:
+            with self._report_queue_drops_lock:
+                self._report_queue_drops += 1
+            _logger.debug(u'dropped report info %s: the report queue is full',
+                          info)
+
+    def _process_report_queue(self):
+        # the method expects to be run in the thread created in start()
+        report_queue = self._report_queue
+        while True:
+            item = report_queue.get()
+            if item is _STOP_REPORT_THREAD:
+                break
+            self._build_and_aggregate_report(*item)
+        _logger.debug(u'report queue processing completed, %s will exit',
+                      threading.current_thread())
+
+    def _stop_report_thread(self):
+        if self._report_thread is None:
+            return
+        # signal the report thread, building queued reports here while the
+        # queue is too full to take the signal
+        while True:
+            try:
+                self._report_queue.put_nowait(_STOP_REPORT_THREAD)
+                break
+            except queue.Full:
+                self._build_next_queued_report()
+
+        # once the thread exits, every report it took is aggregated; build
+        # the ones queued since, so they're included in the final flush
+        self._report_thread.join()
+        self._report_thread = None
+        while self._build_next_queued_report():
+            pass
+
+    def _build_next_queued_report(self):
+        try:
+            item = self._report_queue.get_nowait()
+        except queue.Empty:
+            return False
+        if item is not _STOP_REPORT_THREAD:
+            self._build_and_aggregate_report(*item)
+        return True
+
+    def _build_and_aggregate_report(self, info, rules, now):
+        try:
+            self._aggregate_report(_as_report_request(info, rules, now))
+        except Exception:  # pylint: disable=broad-except
+            _logger.error(u'failed to build a report request from %s', info,
+                          exc_info=True)
+
+    def _aggregate_report(self, report_req):
         if not self._report_aggregator.report(report_req):
             _logger.debug(u'need to send a report request directly')
             try:
@@ -358,6 +654,7 @@ class Client(object):
             except exceptions.Error:  # only sink apitools errors
                 _logger.error(u'direct send for report request failed',
                               exc_info=True)
+                self._spool_report(report_req)
 
     @property
     def _run_scheduler_directly(self):
@@ -402,13 +699,8 @@ class Client(object):
             return
 
         _logger.debug(u'flushing the check aggregator')
-        transport = self._create_transport()
         for req in self._check_aggregator.flush():
-            try:
-                resp = transport.services.Check(req)
-                self._check_aggregator.add_response(req, resp)
-            except Exception:  # pylint: disable=broad-except
-                _logger.error(u'failed to flush check_req %s', req, exc_info=True)
+            self._submit_flush(_CHECK, self._send_flushed_check, req)
 
         # schedule a repeat of this method
         self._scheduler.enter(
@@ -433,15 +725,10 @@ class Client(object):
             return
 
         _logger.debug(u'flushing the quota aggregator')
-        transport = self._create_transport()
         reqs = self._quota_aggregator.flush()
         _logger.debug(u'flushing %d quota from the quota aggregator', len(reqs))
         for req in reqs:
-            try:
-                resp = transport.services.AllocateQuota(req)
-                self._quota_aggregator.add_response(req, resp)
-            except Exception:  # pylint: disable=broad-except
-                _logger.error(u'failed to flush quota_req %s', req, exc_info=True)
+            self._submit_flush(_QUOTA, self._send_flushed_quota, req)
 
         # schedule a repeat of this method
         self._scheduler.enter(
@@ -462,14 +749,10 @@ class Client(object):
             return
 
         # flush reports and schedule a repeat of this method
-        transport = self._create_transport()
         reqs = self._report_aggregator.flush()
         _logger.debug(u"will flush %d report requests", len(reqs))
         for req in reqs:
-            try:
-                transport.services.Report(req)
-            except exceptions.Error:  # only sink apitools errors
-                _logger.error(u'failed to flush report_req %s', req, exc_info=True)
+            self._submit_flush(_REPORT, self._send_flushed_report, req)
 
         if len(reqs) > 0:
             self._start_idle_timer()
@@ -487,14 +770,138 @@ class Client(object):
         )
 
     def _flush_all_reports(self):
-        all_requests = self._report_aggregator.clear()
+        all_requests = self._report_aggregator.as_report_requests(
+            self._report_aggregator.clear())
         _logger.debug(u'flushing all reports (count=%d)', len(all_requests))
-        transport = self._create_transport()
-        for req in all_requests:
+        pending = [self._submit_flush(_REPORT, self._send_flushed_report, req)
+                   for req in all_requests]
+        pending = [f for f in pending if f is not None]
+        if pending:
+            futures.wait(pending)
+
+    def _send_flushed_check(self, req):
+        try:
+            resp = self._create_transport().services.Check(req)
+            self._check_aggregator.add_response(req, resp)
+        except Exception:  # pylint: disable=broad-except
+            _logger.error(u'failed to flush check_req %s', req, exc_info=True)
+
+    def _send_flushed_quota(self, req):
+        try:
+            resp = self._create_transport().services.AllocateQuota(req)
+            self._quota_aggregator.add_response(req, resp)
+        except Exception:  # pylint: disable=broad-except
+            _logger.error(u'failed to flush quota_req %s', req, exc_info=True)
+
+    def _send_flushed_report(self, req):
+        try:
+            self._create_transport().services.Report(req)
+        except Exception:  # pylint: disable=broad-except
+            _logger.error(u'failed to flush report_req %s', req, exc_info=True)
+            self._spool_report(req)
+
+    def _spool_report(self, req):
+        if self._report_spool is None:
+            return
+        try:
+            payload = servicecontrol.ReportRequest.serialize(req)
+            self._report_spool.append(payload)
+        except Exception:  # pylint: disable=broad-except
+            _logger.error(u'failed to spool report_req %s', req, exc_info=True)
+
+    def _send_spooled_report(self, payload):
+        req = servicecontrol.ReportRequest.deserialize(payload)
+        self._create_transport().services.Report(req)
+
+    def _replay_report_spool(self):
+        # the method expects to be run in the thread created in start(); the
+        # delay between replays doubles while they fail, up to a limit
+        report_spool = self._report_spool
+        stopping = self._spool_stopping
+        interval = SPOOL_REPLAY_INTERVAL.total_seconds()
+        max_interval = MAX_SPOOL_REPLAY_INTERVAL.total_seconds()
+        delay = interval
+        while not stopping.wait(delay):
             try:
-                transport.services.Report(req)
-            except exceptions.Error:  # only sink apitools errors
-                _logger.error(u'failed to flush report_req %s', req, exc_info=True)
+                drained = report_spool.replay(self._send_spooled_report)
+            except (IOError, OSError):
+                _logger.error(u'failed to replay the report spool',
+                              exc_info=True)
+                drained = False
+            delay = interval if drained else min(delay * 2, max_interval)
+        _logger.debug(u'report spool replay completed, %s will exit',
+                      threading.current_thread())
+
+
+_STOP_REPORT_THREAD = object()  # signals the report thread to exit
+
+_CHECK = u'check'
+_QUOTA = u'quota'
+_REPORT = u'report'
+_FLUSH_KINDS = (_CHECK, _QUOTA, _REPORT)
+
+
+class _SingleFlight(object):
+    """Shares the result of a call between concurrent callers using the same key.
+
+    The first caller for a key makes the call; callers that arrive while it
+    is in progress wait for its result instead of making their own.
+
+    Thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.waiters = 0
+        self.timeouts = 0
+
+    def do(self, key, func, timeout):
+        """Obtains the result of ``func``, sharing it with concurrent callers.
+
+        Args:
+          key (object): identifies calls that are equivalent
+          func (func): makes the call
+          timeout (float): the seconds that a waiting caller waits for the
+            result before giving up
+
+        Returns:
+          tuple: (result, is_waiter); result is ``None`` if a waiting caller
+            times out
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_waiter = call is not None
+            if is_waiter:
+                self.waiters += 1
+            else:
+                call = self._calls[key] = _Call()
+        if is_waiter:
+            if call.done.wait(timeout):
+                return call.result, True
+            with self._lock:
+                self.timeouts += 1
+            return None, True
+
+        try:
+            call.result = func()
+            return call.result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class _Call(object):
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+def _as_report_request(info, rules, now):
+    return info.as_report_request(rules, timer=lambda: now)
 
 
 def use_default_thread():
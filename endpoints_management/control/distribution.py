@@ -24,15 +24,31 @@ in the correct state.
 
 :func:`merge` merges two distribution instances
 
+:func:`quantiles` estimates quantiles of the samples in a distribution instance
+
+:func:`bucket_layout` obtains the :class:`BucketLayout` of a distribution
+instance, and :func:`exponential_layout`, :func:`linear_layout` and
+:func:`explicit_layout` obtain layouts from bucket parameters
+
+:class:`Accumulator` adds samples and distributions to arrays of bucket counts,
+and only makes a distribution instance when :func:`Accumulator.to_proto` is
+called
+
+:class:`Sketch` accumulates samples with a bounded relative error, and projects
+them onto the buckets of a distribution instance when it is made
+
 """
 
 from __future__ import absolute_import
 from __future__ import division
 
-from builtins import zip
+from array import array
+from builtins import object, range, zip
 import bisect
+import collections
 import logging
 import math
+import threading
 
 from google.cloud import servicecontrol as sc_messages
 
@@ -163,7 +179,9 @@ def merge(prior, latest):
       ValueError: if the bucket counts of `prior` and `latest` do not match
 
     """
-    if not _buckets_nearly_equal(prior, latest):
+    prior_layout = bucket_layout(prior)
+    if ((prior_layout is None or prior_layout is not bucket_layout(latest)) and
+            not _buckets_nearly_equal(prior, latest)):
         _logger.error(u'Bucket options do not match. From %s To: %s',
                       prior,
                       latest)
@@ -176,25 +194,291 @@ def merge(prior, latest):
     if prior.count <= 0:
         return
 
-    old_count = latest.count
-    old_mean = latest.mean
-    old_summed_variance = latest.sum_of_squared_deviation
     bucket_counts = latest.bucket_counts
-
-    # Update the latest
-    latest.count += prior.count
-    latest.maximum = max(prior.maximum, latest.maximum)
-    latest.minimum = min(prior.minimum, latest.minimum)
-    latest.mean = ((old_count * old_mean + prior.count * prior.mean) /
-                   latest.count)
-    latest.sum_of_squared_deviation = (
-        old_summed_variance + prior.sum_of_squared_deviation +
-        old_count * (latest.mean - old_mean) ** 2 +
-        prior.count * (latest.mean - prior.mean) ** 2)
+    _merge_statistics(prior, latest)
     for i, (x, y) in enumerate(zip(prior.bucket_counts, bucket_counts)):
         bucket_counts[i] = x + y
 
 
+_BAD_QUANTILE = u'quantiles should be between 0 and 1'
+
+
+def quantiles(dist, qs):
+    """Estimates the quantiles `qs` of the samples added to `dist`.
+
+    Each quantile is interpolated linearly within the bucket that holds it.
+    The distribution's minimum and maximum bound the underflow and overflow
+    buckets, and narrow the others where they can.
+
+    Args:
+      dist (:class:`Accumulator`|:class:`Sketch`|:class:`endpoints_management.gen.servicecontrol_v1_messages.Distribution`):
+        an instance
+      qs (iterable[float]): the quantiles to estimate, e.g, ``(0.5, 0.99)``
+
+    Return:
+      list[float]: the estimated value of each quantile, or ``None`` for each
+        of them if no samples have been added to `dist`
+
+    Raises:
+      ValueError: if `dist` does not have known bucket options defined
+      ValueError: if any of `qs` is not between 0 and 1
+    """
+    qs = _checked_quantiles(qs)
+    if isinstance(dist, Sketch):
+        return dist.quantiles(qs)
+    elif isinstance(dist, Accumulator):
+        layout = dist.layout
+    else:
+        layout = bucket_layout(dist)
+    if layout is None:
+        raise ValueError(u'Unknown bucket option type')
+    bucket_counts = list(dist.bucket_counts)
+    total = sum(bucket_counts)
+    if total <= 0:
+        return [None] * len(qs)
+
+    bounds = layout.bounds
+    minimum = dist.minimum
+    maximum = dist.maximum
+    result = []
+    for q in qs:
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(bucket_counts):
+            if count and cumulative + count >= rank:
+                break
+            cumulative += count
+        lower = bounds[index - 1] if index else minimum
+        upper = bounds[index] if index < len(bounds) else maximum
+        lower = min(max(lower, minimum), maximum)
+        upper = max(min(upper, maximum), lower)
+        result.append(lower + (upper - lower) * (rank - cumulative) / count)
+    return result
+
+
+def _checked_quantiles(qs):
+    qs = list(qs)
+    for q in qs:
+        if not 0.0 <= q <= 1.0:
+            raise ValueError(_BAD_QUANTILE)
+    return qs
+
+
+_EXPONENTIAL = u'exponential_buckets'
+_LINEAR = u'linear_buckets'
+_EXPLICIT = u'explicit_buckets'
+
+
+class BucketLayout(
+        collections.namedtuple(
+            u'BucketLayout', [
+                u'dist_type',
+                u'params',
+                u'bounds',
+            ])):
+    """Describes the buckets of a distribution.
+
+    Layouts are cached, there is only ever one instance for each set of bucket
+    parameters, so layouts can be compared using ``is``.  Obtain them using
+    :func:`bucket_layout`, :func:`exponential_layout`, :func:`linear_layout`
+    or :func:`explicit_layout`.
+
+    Attributes:
+        dist_type (string): the name of the bucket option field of the
+          distribution
+        params (tuple): the parameters of the bucket option
+        bounds (tuple[float]): the lower bounds of the finite buckets and of
+          the overflow bucket, used to find the bucket of a sample
+
+    """
+
+    @property
+    def num_buckets(self):
+        """The number of bucket counts in a distribution with this layout."""
+        return len(self.bounds) + 1
+
+    def bucket_index(self, a_float):
+        """Finds the bucket of `a_float`.
+
+        Args:
+           a_float (float): a sample
+
+        Returns:
+           int: the index of the bucket count that `a_float` is added to
+        """
+        bounds = self.bounds
+        if self.dist_type == _EXPONENTIAL and a_float <= bounds[0]:
+            return 0
+        return bisect.bisect(bounds, a_float)
+
+    def bucket_option(self):
+        """Makes the bucket option of distributions with this layout.
+
+        Returns:
+           tuple(string, object): the bucket option's field name and value
+        """
+        if self.dist_type == _EXPONENTIAL:
+            num_finite_buckets, growth_factor, scale = self.params
+            return self.dist_type, sc_messages.Distribution.ExponentialBuckets(
+                num_finite_buckets=num_finite_buckets,
+                growth_factor=growth_factor,
+                scale=scale)
+        elif self.dist_type == _LINEAR:
+            num_finite_buckets, width, offset = self.params
+            return self.dist_type, sc_messages.Distribution.LinearBuckets(
+                num_finite_buckets=num_finite_buckets,
+                width=width,
+                offset=offset)
+        else:
+            return self.dist_type, sc_messages.Distribution.ExplicitBuckets(
+                bounds=self.bounds)
+
+
+def _exponential_bounds(num_finite_buckets, growth_factor, scale):
+    return tuple(scale * growth_factor ** i
+                 for i in range(num_finite_buckets + 1))
+
+
+def _linear_bounds(num_finite_buckets, width, offset):
+    return tuple(offset + width * i for i in range(num_finite_buckets + 1))
+
+
+def _explicit_bounds(*bounds):
+    return bounds
+
+
+_BOUNDS_FUNCS = {
+    _EXPONENTIAL: _exponential_bounds,
+    _LINEAR: _linear_bounds,
+    _EXPLICIT: _explicit_bounds,
+}
+_layouts = {}
+_layouts_lock = threading.Lock()
+
+
+def _cached_layout(dist_type, params):
+    key = (dist_type, params)
+    layout = _layouts.get(key)
+    if layout is None:
+        with _layouts_lock:
+            layout = _layouts.get(key)
+            if layout is None:
+                bounds = _BOUNDS_FUNCS[dist_type](*params)
+                layout = BucketLayout(dist_type, params, bounds)
+                _layouts[key] = layout
+    return layout
+
+
+def exponential_layout(num_finite_buckets, growth_factor, scale):
+    """Obtains the layout of distributions with exponential buckets.
+
+    Args:
+       num_finite_buckets (int): the number of finite buckets
+       growth_factor (float): the growth factor
+       scale (float): the scale
+
+    Return:
+       :class:`BucketLayout`: the layout
+
+    Raises:
+       ValueError: if the args are invalid for creating a distribution
+    """
+    if num_finite_buckets <= 0:
+        raise ValueError(_BAD_NUM_FINITE_BUCKETS)
+    if growth_factor <= 1.0:
+        raise ValueError(_BAD_FLOAT_ARG % (u'growth factor', 1.0))
+    if scale <= 0.0:
+        raise ValueError(_BAD_FLOAT_ARG % (u'scale', 0.0))
+    return _cached_layout(_EXPONENTIAL,
+                          (num_finite_buckets, growth_factor, scale))
+
+
+def linear_layout(num_finite_buckets, width, offset):
+    """Obtains the layout of distributions with linear buckets.
+
+    Args:
+       num_finite_buckets (int): the number of finite buckets
+       width (float): the width of each bucket
+       offset (float): the offset
+
+    Return:
+       :class:`BucketLayout`: the layout
+
+    Raises:
+       ValueError: if the args are invalid for creating a distribution
+    """
+    if num_finite_buckets <= 0:
+        raise ValueError(_BAD_NUM_FINITE_BUCKETS)
+    if width <= 0.0:
+        raise ValueError(_BAD_FLOAT_ARG % (u'width', 0.0))
+    return _cached_layout(_LINEAR, (num_finite_buckets, width, offset))
+
+
+def explicit_layout(bounds):
+    """Obtains the layout of distributions with explicit buckets.
+
+    Args:
+       bounds (iterable[float]): the bounds
+
+    Return:
+       :class:`BucketLayout`: the layout
+
+    Raises:
+       ValueError: if the args are invalid for creating a distribution
+    """
+    safe_bounds = tuple(sorted(float(x) for x in bounds))
+    if len(safe_bounds) != len(set(safe_bounds)):
+        raise ValueError(u'Detected two elements of bounds that are the same')
+    return _cached_layout(_EXPLICIT, safe_bounds)
+
+
+def bucket_layout(dist):
+    """Obtains the layout of the buckets of `dist`.
+
+    Args:
+      dist (:class:`endpoints_management.gen.servicecontrol_v1_messages.Distribution`):
+        an instance
+
+    Return:
+      :class:`BucketLayout`: the layout, or ``None`` if `dist` does not have
+        known bucket options defined
+
+    """
+    dist_type, buckets = _detect_bucket_option(dist)
+    if dist_type == _EXPONENTIAL:
+        return _cached_layout(dist_type, (buckets.num_finite_buckets,
+                                          buckets.growth_factor,
+                                          buckets.scale))
+    elif dist_type == _LINEAR:
+        return _cached_layout(dist_type, (buckets.num_finite_buckets,
+                                          buckets.width,
+                                          buckets.offset))
+    elif dist_type == _EXPLICIT:
+        return _cached_layout(dist_type, tuple(buckets.bounds))
+    else:
+        return None
+
+
+def create_from_layout(layout):
+    """Creates a new instance of distribution with the buckets in `layout`.
+
+    Args:
+       layout (:class:`BucketLayout`): the layout
+
+    Return:
+       :class:`endpoints_management.gen.servicecontrol_v1_messages.Distribution`
+
+    Raises:
+       ValueError: if `layout` is not a :class:`BucketLayout`
+    """
+    if not isinstance(layout, BucketLayout):
+        raise ValueError(u'Unknown bucket option type')
+    dist_type, buckets = layout.bucket_option()
+    kw = {dist_type: buckets}
+    return sc_messages.Distribution(bucket_counts=[0] * layout.num_buckets,
+                                    **kw)
+
+
 _EPSILON = 1e-5
 
 
@@ -293,6 +577,65 @@ def _update_general_statistics(a_float, dist):
         dist.sum_of_squared_deviation += delta_sum_squares
 
 
+def _add_to_statistics(stats, floats):
+    """Adds `floats` to the statistics fields of `stats`.
+
+    `stats` may be a `Distribution`, or anything else with the same
+    statistics fields, e.g, an :class:`Accumulator`.
+
+    Returns:
+      tuple[float]: the floats that were added
+    """
+    floats = tuple(floats)
+    count = stats.count
+    mean = stats.mean
+    minimum = stats.minimum
+    maximum = stats.maximum
+    sum_of_squared_deviation = stats.sum_of_squared_deviation
+    for a_float in floats:
+        if not count:
+            count = 1
+            maximum = a_float
+            minimum = a_float
+            mean = a_float
+            sum_of_squared_deviation = 0
+        else:
+            new_mean = ((count * mean) + a_float) / (count + 1)
+            sum_of_squared_deviation += (
+                (a_float - mean) * (a_float - new_mean))
+            count += 1
+            mean = new_mean
+            maximum = max(a_float, maximum)
+            minimum = min(a_float, minimum)
+    stats.count = count
+    stats.mean = mean
+    stats.minimum = minimum
+    stats.maximum = maximum
+    stats.sum_of_squared_deviation = sum_of_squared_deviation
+    return floats
+
+
+def _merge_statistics(prior, latest):
+    """Merges the statistics fields of `prior` into those of `latest`."""
+    old_count = latest.count
+    old_mean = latest.mean
+    old_summed_variance = latest.sum_of_squared_deviation
+
+    latest.count += prior.count
+    if old_count > 0:
+        latest.maximum = max(prior.maximum, latest.maximum)
+        latest.minimum = min(prior.minimum, latest.minimum)
+    else:
+        latest.maximum = prior.maximum
+        latest.minimum = prior.minimum
+    latest.mean = ((old_count * old_mean + prior.count * prior.mean) /
+                   latest.count)
+    latest.sum_of_squared_deviation = (
+        old_summed_variance + prior.sum_of_squared_deviation +
+        old_count * (latest.mean - old_mean) ** 2 +
+        prior.count * (latest.mean - prior.mean) ** 2)
+
+
 _BAD_UNSET_BUCKETS = u'cannot update a distribution with unset %s'
 _BAD_LOW_BUCKET_COUNT = u'cannot update a distribution with a low bucket count'
 
@@ -318,11 +661,8 @@ def _update_exponential_bucket_count(a_float, dist):
         raise ValueError(_BAD_LOW_BUCKET_COUNT)
     scale = buckets.scale
     factor = buckets.growth_factor
-    if (a_float <= scale):
-        index = 0
-    else:
-        index = 1 + int((math.log(a_float / scale) / math.log(factor)))
-        index = min(index, num_finite_buckets + 1)
+    index = _cached_layout(
+        _EXPONENTIAL, (num_finite_buckets, factor, scale)).bucket_index(a_float)
     bucket_counts[index] += 1
     _logger.debug(u'scale:%f, factor:%f, sample:%f, index:%d',
                   scale, factor, a_float, index)
@@ -350,12 +690,8 @@ def _update_linear_bucket_count(a_float, dist):
     width = buckets.width
     lower = buckets.offset
     upper = lower + (num_finite_buckets * width)
-    if a_float < lower:
-        index = 0
-    elif a_float >= upper:
-        index = num_finite_buckets + 1
-    else:
-        index = 1 + int(((a_float - lower) / width))
+    index = _cached_layout(
+        _LINEAR, (num_finite_buckets, width, lower)).bucket_index(a_float)
     bucket_counts[index] += 1
     _logger.debug(u'upper:%f, lower:%f, width:%f, sample:%f, index:%d',
                   upper, lower, width, a_float, index)
@@ -381,3 +717,360 @@ def _update_explicit_bucket_count(a_float, dist):
     if len(bucket_counts) < len(bounds) + 1:
         raise ValueError(_BAD_LOW_BUCKET_COUNT)
     bucket_counts[bisect.bisect(bounds, a_float)] += 1
+
+
+class Accumulator(object):
+    """Accumulates samples and distributions in an array of bucket counts.
+
+    It has the same fields as a `Distribution`, but they are plain python
+    values rather than protobuf fields, so many samples can be added cheaply.
+    :func:`to_proto` makes a `Distribution` from the accumulated values.
+
+    Thread compatible.
+    """
+
+    def __init__(self, layout):
+        """Constructor.
+
+        Args:
+           layout (:class:`BucketLayout`): the bucket layout
+
+        Raises:
+           ValueError: if `layout` is not a :class:`BucketLayout`
+        """
+        if not isinstance(layout, BucketLayout):
+            raise ValueError(u'Unknown bucket option type')
+        self.layout = layout
+        self.count = 0
+        self.mean = 0.0
+        self.minimum = 0.0
+        self.maximum = 0.0
+        self.sum_of_squared_deviation = 0.0
+        self.bucket_counts = array(u'q', [0]) * layout.num_buckets
+
+    @classmethod
+    def from_proto(cls, dist):
+        """Creates an instance holding the values in `dist`.
+
+        Args:
+          dist (:class:`endpoints_management.gen.servicecontrol_v1_messages.Distribution`):
+            an instance
+
+        Raises:
+          ValueError: if `dist` does not have known bucket options defined
+          ValueError: if there are not enough bucket count fields in `dist`
+        """
+        result = cls(bucket_layout(dist))
+        if len(dist.bucket_counts) != len(result.bucket_counts):
+            raise ValueError(_BAD_LOW_BUCKET_COUNT)
+        result.count = dist.count
+        result.mean = dist.mean
+        result.minimum = dist.minimum
+        result.maximum = dist.maximum
+        result.sum_of_squared_deviation = dist.sum_of_squared_deviation
+        result.bucket_counts = array(u'q', dist.bucket_counts)
+        return result
+
+    def add_sample(self, a_float):
+        """Adds `a_float`, as :func:`add_sample` would.
+
+        Args:
+          a_float (float): a new value
+        """
+        self.add_samples((a_float,))
+
+    def add_samples(self, floats):
+        """Adds each of `floats`, as :func:`add_sample` would.
+
+        Args:
+          floats (iterable[float]): the new values
+        """
+        floats = _add_to_statistics(self, floats)
+        bucket_index = self.layout.bucket_index
+        bucket_counts = self.bucket_counts
+        for a_float in floats:
+            bucket_counts[bucket_index(a_float)] += 1
+
+    def merge(self, prior):
+        """Merges `prior` into this instance, as :func:`merge` would.
+
+        Args:
+          prior (:class:`Accumulator`|:class:`endpoints_management.gen.servicecontrol_v1_messages.Distribution`):
+            an instance
+
+        Raises:
+          ValueError: if the bucket options of `prior` and this instance do
+            not match
+          ValueError: if the bucket counts of `prior` and this instance do
+            not match
+        """
+        if isinstance(prior, Accumulator):
+            layout = prior.layout
+        else:
+            layout = bucket_layout(prior)
+        if layout is not self.layout:
+            _logger.error(u'Bucket options do not match. From %s To: %s',
+                          layout,
+                          self.layout)
+            raise ValueError(u'Bucket options do not match')
+        bucket_counts = self.bucket_counts
+        prior_bucket_counts = prior.bucket_counts
+        if len(prior_bucket_counts) != len(bucket_counts):
+            _logger.error(u'Bucket count sizes do not match. From %s To: %s',
+                          len(prior_bucket_counts),
+                          len(bucket_counts))
+            raise ValueError(u'Bucket count sizes do not match')
+        if prior.count <= 0:
+            return
+
+        _merge_statistics(prior, self)
+        for i, x in enumerate(prior_bucket_counts):
+            bucket_counts[i] += x
+
+    def to_proto(self):
+        """Makes a `Distribution` holding the accumulated values.
+
+        Return:
+           :class:`endpoints_management.gen.servicecontrol_v1_messages.Distribution`
+        """
+        dist_type, buckets = self.layout.bucket_option()
+        kw = {dist_type: buckets}
+        return sc_messages.Distribution(
+            count=self.count,
+            mean=self.mean,
+            minimum=self.minimum,
+            maximum=self.maximum,
+            sum_of_squared_deviation=self.sum_of_squared_deviation,
+            bucket_counts=list(self.bucket_counts),
+            **kw)
+
+
+class Sketch(object):
+    """Accumulates samples in buckets with a bounded relative error.
+
+    It follows DDSketch: a positive sample ``x`` is counted in the bucket
+    with index ``ceil(log(x, gamma))``, where ``gamma`` is derived from the
+    relative accuracy, so any quantile it estimates is within that relative
+    accuracy of a sample's value.  Only buckets holding samples are kept, and
+    once there are more than ``max_num_buckets`` the lowest are collapsed
+    together, bounding its memory.  Samples that are not positive are counted
+    as zero.
+
+    The statistics fields are exact, as in an :class:`Accumulator`, and
+    :func:`to_proto` projects the buckets onto those of `layout`.
+
+    Thread compatible.
+    """
+
+    DEFAULT_RELATIVE_ACCURACY = 0.01
+    """The default relative accuracy of the estimated quantiles."""
+
+    DEFAULT_MAX_NUM_BUCKETS = 2048
+    """The default maximum number of buckets that are kept."""
+
+    def __init__(self,
+                 layout,
+                 relative_accuracy=DEFAULT_RELATIVE_ACCURACY,
+                 max_num_buckets=DEFAULT_MAX_NUM_BUCKETS):
+        """Constructor.
+
+        Args:
+           layout (:class:`BucketLayout`): the bucket layout of the
+             distributions this instance is merged with and projected onto
+           relative_accuracy (float): the relative accuracy of the estimated
+             quantiles
+           max_num_buckets (int): the maximum number of buckets to keep
+
+        Raises:
+           ValueError: if `layout` is not a :class:`BucketLayout`
+           ValueError: if the other args are invalid
+        """
+        if not isinstance(layout, BucketLayout):
+            raise ValueError(u'Unknown bucket option type')
+        if not 0.0 < relative_accuracy < 1.0:
+            raise ValueError(u'relative accuracy should be between 0 and 1')
+        if max_num_buckets <= 0:
+            raise ValueError(u'maximum number of buckets should be > 0')
+        self.layout = layout
+        self.relative_accuracy = relative_accuracy
+        self.max_num_buckets = max_num_buckets
+        self.count = 0
+        self.mean = 0.0
+        self.minimum = 0.0
+        self.maximum = 0.0
+        self.sum_of_squared_deviation = 0.0
+        self.zero_count = 0
+        self.bins = {}
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+
+    def add_sample(self, a_float):
+        """Adds `a_float`.
+
+        Args:
+          a_float (float): a new value
+        """
+        self.add_samples((a_float,))
+
+    def add_samples(self, floats):
+        """Adds each of `floats`.
+
+        Args:
+          floats (iterable[float]): the new values
+        """
+        floats = _add_to_statistics(self, floats)
+        self._add_to_bins(floats)
+        self._collapse()
+
+    def merge(self, prior):
+        """Merges `prior` into this instance.
+
+        `prior` may also be an :class:`Accumulator` or a `Distribution`.  If
+        it holds a single sample, that sample is added exactly, otherwise the
+        samples in each of its buckets are added at the bucket's midpoint.
+
+        Args:
+          prior (:class:`Sketch`|:class:`Accumulator`|:class:`endpoints_management.gen.servicecontrol_v1_messages.Distribution`):
+            an instance
+
+        Raises:
+          ValueError: if the bucket options of `prior` and this instance do
+            not match
+          ValueError: if `prior` is a sketch with a different relative
+            accuracy
+        """
+        if isinstance(prior, (Sketch, Accumulator)):
+            layout = prior.layout
+        else:
+            layout = bucket_layout(prior)
+        if layout is not self.layout:
+            _logger.error(u'Bucket options do not match. From %s To: %s',
+                          layout,
+                          self.layout)
+            raise ValueError(u'Bucket options do not match')
+        if isinstance(prior, Sketch):
+            if prior.relative_accuracy != self.relative_accuracy:
+                raise ValueError(u'Relative accuracies do not match')
+            if prior.count <= 0:
+                return
+            bins = self.bins
+            for index, count in prior.bins.items():
+                bins[index] = bins.get(index, 0) + count
+            self.zero_count += prior.zero_count
+        elif prior.count <= 0:
+            return
+        elif prior.count == 1:
+            self._add_to_bins((prior.mean,))
+        else:
+            self._add_buckets_to_bins(prior)
+        _merge_statistics(prior, self)
+        self._collapse()
+
+    def quantiles(self, qs):
+        """Estimates the quantiles `qs` of the samples that were added.
+
+        Args:
+          qs (iterable[float]): the quantiles to estimate
+
+        Return:
+          list[float]: the estimated value of each quantile, or ``None`` for
+            each of them if no samples have been added
+
+        Raises:
+          ValueError: if any of `qs` is not between 0 and 1
+        """
+        qs = _checked_quantiles(qs)
+        if self.count <= 0:
+            return [None] * len(qs)
+        total = self.zero_count + sum(self.bins.values())
+        indices = sorted(self.bins)
+        result = []
+        for q in qs:
+            rank = q * (total - 1)
+            if rank < self.zero_count:
+                value = 0.0
+            else:
+                cumulative = self.zero_count
+                for index in indices:
+                    cumulative += self.bins[index]
+                    if cumulative > rank:
+                        break
+                value = self._value(index)
+            result.append(min(max(value, self.minimum), self.maximum))
+        return result
+
+    def to_accumulator(self):
+        """Makes an :class:`Accumulator` by projecting onto its buckets.
+
+        Return:
+           :class:`Accumulator`: with the statistics of this instance, and
+             each of its buckets' samples in the bucket holding its value
+        """
+        result = Accumulator(self.layout)
+        result.count = self.count
+        result.mean = self.mean
+        result.minimum = self.minimum
+        result.maximum = self.maximum
+        result.sum_of_squared_deviation = self.sum_of_squared_deviation
+        bucket_index = self.layout.bucket_index
+        bucket_counts = result.bucket_counts
+        minimum = self.minimum
+        maximum = self.maximum
+        if self.zero_count:
+            bucket_counts[bucket_index(min(max(0.0, minimum), maximum))] += (
+                self.zero_count)
+        for index, count in self.bins.items():
+            value = min(max(self._value(index), minimum), maximum)
+            bucket_counts[bucket_index(value)] += count
+        return result
+
+    def to_proto(self):
+        """Makes a `Distribution` with the buckets of this instance's layout.
+
+        Return:
+           :class:`endpoints_management.gen.servicecontrol_v1_messages.Distribution`
+        """
+        return self.to_accumulator().to_proto()
+
+    def _value(self, index):
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+    def _add_to_bins(self, floats):
+        bins = self.bins
+        log_gamma = self._log_gamma
+        for a_float in floats:
+            if a_float > 0:
+                index = int(math.ceil(math.log(a_float) / log_gamma))
+                bins[index] = bins.get(index, 0) + 1
+            else:
+                self.zero_count += 1
+
+    def _add_buckets_to_bins(self, dist):
+        bounds = self.layout.bounds
+        minimum = dist.minimum
+        maximum = dist.maximum
+        bins = self.bins
+        log_gamma = self._log_gamma
+        for i, count in enumerate(dist.bucket_counts):
+            if not count:
+                continue
+            lower = bounds[i - 1] if i else minimum
+            upper = bounds[i] if i < len(bounds) else maximum
+            lower = min(max(lower, minimum), maximum)
+            upper = max(min(upper, maximum), lower)
+            midpoint = (lower + upper) / 2
+            if midpoint > 0:
+                index = int(math.ceil(math.log(midpoint) / log_gamma))
+                bins[index] = bins.get(index, 0) + count
+            else:
+                self.zero_count += count
+
+    def _collapse(self):
+        bins = self.bins
+        excess = len(bins) - self.max_num_buckets
+        if excess <= 0:
+            return
+        indices = sorted(bins)
+        lowest_kept = indices[excess]
+        for index in indices[:excess]:
+            bins[lowest_kept] += bins.pop(index)
@@ -0,0 +1,210 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""latency provides in-process monitoring of the latency of api methods.
+
+:class:`Monitor` keeps rolling histograms of the total and backend latencies
+of each api method, using the same buckets as the library's
+``PRODUCER_TOTAL_LATENCIES`` and ``PRODUCER_BACKEND_LATENCIES`` metrics.  The
+middleware records each request on a monitor it is given, and
+:func:`Monitor.snapshot` summarizes the recent latencies of each method,
+without waiting on the metrics to reach Cloud Monitoring.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+from builtins import object
+import collections
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from . import distribution, metric_descriptor
+
+_logger = logging.getLogger(__name__)
+
+
+class Summary(
+        collections.namedtuple(
+            u'Summary', [
+                u'count',
+                u'mean',
+                u'minimum',
+                u'maximum',
+                u'quantiles',
+            ])):
+    """Summarizes the latencies of an api method.
+
+    Attributes:
+        count (int): the number of latencies
+        mean (float): their mean, in seconds
+        minimum (float): the smallest latency, in seconds
+        maximum (float): the largest latency, in seconds
+        quantiles (dict[float, float]): the estimated latency at each of the
+          monitor's quantiles, in seconds
+
+    """
+    # pylint: disable=too-few-public-methods
+
+
+class MethodLatencies(
+        collections.namedtuple(
+            u'MethodLatencies', [
+                u'total',
+                u'backend',
+            ])):
+    """Holds the latency summaries of an api method.
+
+    Attributes:
+        total (:class:`Summary`): the summary of the total latencies
+        backend (:class:`Summary`): the summary of the backend latencies
+
+    """
+    # pylint: disable=too-few-public-methods
+
+
+class Monitor(object):
+    """Keeps rolling histograms of the latencies of each api method.
+
+    The samples added over the last `window` are kept, in `num_slots`
+    slots that are discarded as they age.
+
+    Thread safe.
+    """
+
+    DEFAULT_QUANTILES = (0.5, 0.95, 0.99)
+    """The quantiles estimated by :func:`snapshot` by default."""
+
+    def __init__(self,
+                 window=timedelta(minutes=1),
+                 num_slots=6,
+                 quantiles=DEFAULT_QUANTILES,
+                 layout=None,
+                 relative_accuracy=None,
+                 timer=datetime.utcnow):
+        """Constructor.
+
+        Args:
+          window (:class:`datetime.timedelta`): the period whose latencies
+            are summarized
+          num_slots (int): the number of slots the window is divided into
+          quantiles (iterable[float]): the quantiles to estimate
+          layout (:class:`endpoints_management.control.distribution.BucketLayout`):
+            the buckets of the histograms; by default, those of the
+            library's latency metrics
+          relative_accuracy (float): if set, the histograms are
+            :class:`endpoints_management.control.distribution.Sketch`
+            instances with this relative accuracy, giving more precise
+            quantiles than the buckets of `layout`
+          timer (function([[datetime]]): a function that returns the current
+            as a time as a datetime instance
+
+        """
+        if num_slots <= 0:
+            raise ValueError(u'number of slots should be > 0')
+        if layout is None:
+            layout = metric_descriptor.TIME_DISTRIBUTION_LAYOUT
+        self._window = window
+        self._slot_width = window / num_slots
+        self._num_slots = num_slots
+        self._quantiles = tuple(quantiles)
+        self._layout = layout
+        self._relative_accuracy = relative_accuracy
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def record(self, selector, request_time, backend_time):
+        """Records the latencies of a request.
+
+        Args:
+          selector (string): the selector of the api method
+          request_time (:class:`datetime.timedelta`): the total latency, or
+            ``None`` if it is not known
+          backend_time (:class:`datetime.timedelta`): the backend latency,
+            or ``None`` if it is not known
+
+        """
+        now = self._timer()
+        with self._lock:
+            histograms = self._histograms.get(selector)
+            if histograms is None:
+                histograms = MethodLatencies(
+                    total=self._new_histogram(),
+                    backend=self._new_histogram())
+                self._histograms[selector] = histograms
+            if request_time is not None:
+                histograms.total.add_sample(now, request_time.total_seconds())
+            if backend_time is not None:
+                histograms.backend.add_sample(now, backend_time.total_seconds())
+
+    def snapshot(self):
+        """Summarizes the recent latencies of each api method.
+
+        Returns:
+          dict[string, :class:`MethodLatencies`]: the summaries, keyed by
+            method selector
+
+        """
+        now = self._timer()
+        with self._lock:
+            accumulators = dict(
+                (selector, MethodLatencies(*[h.accumulate(now) for h in hs]))
+                for selector, hs in self._histograms.items())
+        return dict(
+            (selector, MethodLatencies(*[self._summarize(acc) for acc in accs]))
+            for selector, accs in accumulators.items())
+
+    def _new_histogram(self):
+        return _RollingHistogram(self._new_accumulator, self._window,
+                                 self._slot_width, self._num_slots)
+
+    def _new_accumulator(self):
+        if self._relative_accuracy is None:
+            return distribution.Accumulator(self._layout)
+        return distribution.Sketch(self._layout,
+                                   relative_accuracy=self._relative_accuracy)
+
+    def _summarize(self, acc):
+        values = distribution.quantiles(acc, self._quantiles)
+        return Summary(count=acc.count,
+                       mean=acc.mean,
+                       minimum=acc.minimum,
+                       maximum=acc.maximum,
+                       quantiles=dict(zip(self._quantiles, values)))
+
+
+class _RollingHistogram(object):
+    """Holds an accumulator for each slot of a rolling window."""
+
+    def __init__(self, new_accumulator, window, slot_width, num_slots):
+        self._new_accumulator = new_accumulator
+        self._window = window
+        self._slot_width = slot_width
+        self._slots = collections.deque(maxlen=num_slots)
+
+    def add_sample(self, now, a_float):
+        slots = self._slots
+        if not slots or now - slots[-1][0] >= self._slot_width:
+            slots.append((now, self._new_accumulator()))
+        slots[-1][1].add_sample(a_float)
+
+    def accumulate(self, now):
+        result = self._new_accumulator()
+        for start, acc in self._slots:
+            if now - start < self._window:
+                result.merge(acc)
+        return result
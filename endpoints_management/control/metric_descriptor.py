@@ -52,47 +52,52 @@ def _set_int64_metric_to_constant_1_if_http_error(name, info, op):
         _add_int64_metric_value(name, 1, op)
 
 
-def _add_distribution_metric_value(name, value, an_op, distribution_args):
-    d = distribution.create_exponential(*distribution_args)
-    distribution.add_sample(value, d)
+def _add_distribution_metric_value(name, value, an_op, distribution_layout):
+    acc = distribution.Accumulator(distribution_layout)
+    acc.add_sample(value)
     _add_metric_value(
-        name, metric_value.create(distribution_value=d), an_op)
+        name, metric_value.create(distribution_value=acc.to_proto()), an_op)
 
 
 _SIZE_DISTRIBUTION_ARGS = (8, 10.0, 1.0)
+_SIZE_DISTRIBUTION_LAYOUT = distribution.exponential_layout(
+    *_SIZE_DISTRIBUTION_ARGS)
 
 
 def _set_distribution_metric_to_request_size(name, info, an_op):
     if info.request_size >= 0:
         _add_distribution_metric_value(name, info.request_size, an_op,
-                                       _SIZE_DISTRIBUTION_ARGS)
+                                       _SIZE_DISTRIBUTION_LAYOUT)
 
 
 def _set_distribution_metric_to_response_size(name, info, an_op):
     if info.response_size >= 0:
         _add_distribution_metric_value(name, info.response_size, an_op,
-                                       _SIZE_DISTRIBUTION_ARGS)
+                                       _SIZE_DISTRIBUTION_LAYOUT)
 
 
 _TIME_DISTRIBUTION_ARGS = (8, 10.0, 1e-6)
+TIME_DISTRIBUTION_LAYOUT = distribution.exponential_layout(
+    *_TIME_DISTRIBUTION_ARGS)
+"""The bucket layout of the latency distributions of the known metrics."""
 
 
 def _set_distribution_metric_to_request_time(name, info, an_op):
     if info.request_time:
         _add_distribution_metric_value(name, info.request_time.total_seconds(),
-                                       an_op, _TIME_DISTRIBUTION_ARGS)
+                                       an_op, TIME_DISTRIBUTION_LAYOUT)
 
 
 def _set_distribution_metric_to_backend_time(name, info, an_op):
     if info.backend_time:
         _add_distribution_metric_value(name, info.backend_time.total_seconds(),
-                                       an_op, _TIME_DISTRIBUTION_ARGS)
+                                       an_op, TIME_DISTRIBUTION_LAYOUT)
 
 
 def _set_distribution_metric_to_overhead_time(name, info, an_op):
     if info.overhead_time:
         _add_distribution_metric_value(name, info.overhead_time.total_seconds(),
-                                       an_op, _TIME_DISTRIBUTION_ARGS)
+                                       an_op, TIME_DISTRIBUTION_LAYOUT)
 
 
 class Mark(Enum):
@@ -265,6 +270,9 @@ class KnownMetrics(Enum):
         """
         self.kind = kind
         self.metric_name = metric_name
+        # update_op_func, without the check on the consumer added for
+        # CONSUMER and PRODUCER_BY_CONSUMER metrics
+        self.base_update_op_func = update_op_func
         if mark is Mark.CONSUMER:
             self.update_op_func = self._consumer_metric(update_op_func)
         elif mark is Mark.PRODUCER_BY_CONSUMER:
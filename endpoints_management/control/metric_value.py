@@ -16,13 +16,12 @@
 
 :func:`merge` merges two `MetricValue` instances.
 :func:`update_hash` adds a `MetricValue` to a secure hash
-:func:`sign` generates a signature for a `MetricValue` using a secure hash
+:func:`sign` generates a signature for a `MetricValue` using the current signer
 
 """
 
 from __future__ import absolute_import
 
-import hashlib
 import logging
 
 from google.cloud.servicecontrol import MetricValue
@@ -110,13 +109,16 @@ def sign(mv):
     Returns:
        string: a unique signature for that operation
     """
-    md5 = hashlib.md5()
-    update_hash(md5, mv)
-    return md5.digest()
+    if not mv.labels:
+        return signing.empty_signature()
+    parts = [u'']
+    signing.add_labels(parts, mv.labels)
+    return signing.sign(parts)
 
 
 def _merge_cumulative_or_gauge_metrics(prior, latest):
-    if timestamp.compare(prior.end_time, latest.end_time) == -1:
+    if timestamp.compare(MetricValue.pb(prior).end_time,
+                         MetricValue.pb(latest).end_time) == -1:
         return latest
     else:
         return prior
@@ -150,16 +152,19 @@ def _detect_value(metric_value):
 
 
 def _merge_delta_timestamps(prior, latest):
-    # Update the start time and end time in the latest metric value
-    if (prior.start_time and
-        (latest.start_time is None or
-         timestamp.compare(prior.start_time, latest.start_time) == -1)):
-        latest.start_time = prior.start_time
-
-    if (prior.end_time and
-        (latest.end_time is None or timestamp.compare(
-            latest.end_time, prior.end_time) == -1)):
-        latest.end_time = prior.end_time
+    # Update the start time and end time in the latest metric value, comparing
+    # the underlying Timestamp messages
+    prior_pb = MetricValue.pb(prior)
+    latest_pb = MetricValue.pb(latest)
+    if (prior_pb.HasField(u'start_time') and
+        (not latest_pb.HasField(u'start_time') or
+         timestamp.compare(prior_pb.start_time, latest_pb.start_time) == -1)):
+        latest_pb.start_time.CopyFrom(prior_pb.start_time)
+
+    if (prior_pb.HasField(u'end_time') and
+        (not latest_pb.HasField(u'end_time') or timestamp.compare(
+            latest_pb.end_time, prior_pb.end_time) == -1)):
+        latest_pb.end_time.CopyFrom(prior_pb.end_time)
 
     return latest
 
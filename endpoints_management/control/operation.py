@@ -19,21 +19,24 @@ information regarding an operation, and is a key constituent of
 :class:`~endpoints_management.gen.servicecontrol_v1_message.CheckRequest` and
 :class:`~endpoints_management.gen.servicecontrol_v1_message.ReportRequests.
 
-The :class:`.Aggregator` support this.
+The :class:`.Aggregator` support this, as does :class:`.ColumnarAggregator`,
+which holds the aggregated metric values in arrays rather than as protos.
 
 """
 
 from __future__ import absolute_import
+from __future__ import division
 
+from array import array
 from builtins import object
 import collections
 import logging
 from datetime import datetime
 
 import google.cloud.servicecontrol as sc_messages
-from google.protobuf import timestamp_pb2
 
-from . import metric_value, timestamp, MetricKind
+from . import distribution, metric_descriptor, metric_value, timestamp
+from . import MetricKind
 
 _logger = logging.getLogger(__name__)
 
@@ -106,6 +109,15 @@ class Info(
             referer,
             service_name)
 
+    @property
+    def consumer_id(self):
+        """The consumer id of operations made from this instance."""
+        if self.api_key and self.api_key_valid:
+            return u'api_key:' + self.api_key
+        elif self.consumer_project_id:
+            return u'project:' + self.consumer_project_id
+        return u''
+
     def as_operation(self, timer=datetime.utcnow):
         """Makes an ``Operation`` from this instance.
 
@@ -114,7 +126,7 @@ class Info(
 
         """
         now = timer()
-        now_time_pb = timestamp_pb2.Timestamp().FromJsonString(timestamp.to_rfc3339(now))
+        now_time_pb = timestamp.stamp(now)
         op = sc_messages.Operation(
             end_time=now_time_pb,
             start_time=now_time_pb,
@@ -123,10 +135,9 @@ class Info(
             op.operation_id= self.operation_id
         if self.operation_name:
             op.operation_name = self.operation_name
-        if self.api_key and self.api_key_valid:
-            op.consumer_id = u'api_key:' + self.api_key
-        elif self.consumer_project_id:
-            op.consumer_id = u'project:' + self.consumer_project_id
+        consumer_id = self.consumer_id
+        if consumer_id:
+            op.consumer_id = consumer_id
         return op
 
 
@@ -210,13 +221,264 @@ class Aggregator(object):
                 by_signature[signature] = mv
 
     def _merge_timestamps(self, other_op):
-        # Update the start time and end time in self._op  as needed
-        if (other_op.start_time and
-            (self._op.start_time is None or
-             timestamp.compare(other_op.start_time, self._op.startTime) == -1)):
-            self._op.start_time = other_op.startTime
-
-        if (other_op.end_time and
-            (self._op.end_time is None or timestamp.compare(
-                self._op.end_time, other_op.end_time) == -1)):
-            self._op.end_time = other_op.end_time
+        # Update the start time and end time in self._op  as needed, comparing
+        # the underlying Timestamp messages
+        op_pb = sc_messages.Operation.pb(self._op)
+        other_pb = sc_messages.Operation.pb(other_op)
+        if (other_pb.HasField(u'start_time') and
+            (not op_pb.HasField(u'start_time') or
+             timestamp.compare(other_pb.start_time, op_pb.start_time) == -1)):
+            op_pb.start_time.CopyFrom(other_pb.start_time)
+
+        if (other_pb.HasField(u'end_time') and
+            (not op_pb.HasField(u'end_time') or timestamp.compare(
+                op_pb.end_time, other_pb.end_time) == -1)):
+            op_pb.end_time.CopyFrom(other_pb.end_time)
+
+
+class ColumnarAggregator(object):
+    """Container that implements operation aggregation using arrays.
+
+    It behaves like :class:`Aggregator`, but rather than holding on to the
+    ``MetricValue`` protos it receives, the values of DELTA int64, double and
+    distribution metrics are added into arrays kept per metric name, with a
+    row for each distinct metric value signature. Protos are only made
+    again by :func:`as_operation`.
+
+    Metric values of other kinds or types are merged as protos using
+    :func:`metric_value.merge`.
+
+    Latency distributions may instead be merged into a
+    :class:`endpoints_management.control.distribution.Sketch`, which keeps
+    their samples far more precisely than their buckets do.
+
+    Thread compatible.
+    """
+    DEFAULT_KIND = MetricKind.DELTA
+    """Used when kinds are not specified, or are missing a metric name"""
+
+    def __init__(self, initial_op, kinds=None, latency_sketch_accuracy=None):
+        """Constructor.
+
+        If kinds is not specifed, all operations will be merged assuming
+        they are of Kind ``DEFAULT_KIND``
+
+        Args:
+           initial_op (
+             :class:`endpoints_management.gen.servicecontrol_v1_messages.Operation`): the
+               initial version of the operation
+           kinds (dict[string,[string]]): specifies the metric kind for
+              each metric name
+           latency_sketch_accuracy (float): if set, the relative accuracy of
+              the sketches that latency distributions are merged into
+
+        """
+        assert isinstance(initial_op, sc_messages.Operation)
+        if kinds is None:
+            kinds = {}
+        self._kinds = kinds
+        self._latency_sketch_accuracy = latency_sketch_accuracy
+        self._consumer_id = initial_op.consumer_id
+        self._operation_id = initial_op.operation_id
+        self._operation_name = initial_op.operation_name
+        self._importance = initial_op.importance
+        self._labels = dict(initial_op.labels)
+        self._extensions = list(initial_op.extensions)
+        self._start_time = initial_op.start_time
+        self._end_time = initial_op.end_time
+        self._log_entries = list(initial_op.log_entries)
+        self._columns_by_name_then_type = collections.defaultdict(dict)
+        self._merge_metric_values(initial_op)
+
+    def as_operation(self):
+        """Obtains a single `Operation` representing this instances contents.
+
+        Returns:
+           :class:`endpoints_management.gen.servicecontrol_v1_messages.Operation`
+        """
+        result = sc_messages.Operation(
+            consumer_id=self._consumer_id,
+            operation_id=self._operation_id,
+            operation_name=self._operation_name,
+            importance=self._importance,
+            labels=self._labels,
+            extensions=self._extensions,
+            log_entries=self._log_entries)
+        if self._start_time is not None:
+            result.start_time = self._start_time
+        if self._end_time is not None:
+            result.end_time = self._end_time
+        names = sorted(self._columns_by_name_then_type.keys())
+        for name in names:
+            mvs = []
+            for column in self._columns_by_name_then_type[name].values():
+                mvs.extend(column.as_metric_values())
+            result.metric_value_sets.append(
+                sc_messages.MetricValueSet(metric_name=name, metric_values=mvs))
+        return result
+
+    def add(self, other_op):
+        """Combines `other_op` with the operation held by this aggregator.
+
+        N.B. It merges the operations log entries and metric values, but makes
+        the assumption the operation is consistent.  It's the callers
+        responsibility to ensure consistency
+
+        Args:
+           other_op (
+             class:`endpoints_management.gen.servicecontrol_v1_messages.Operation`):
+             an operation merge into this one
+
+        """
+        self._log_entries.extend(other_op.log_entries)
+        self._start_time = _earliest(self._start_time, other_op.start_time)
+        self._end_time = _latest(self._end_time, other_op.end_time)
+        self._merge_metric_values(other_op)
+
+    def _merge_metric_values(self, other_op):
+        for value_set in other_op.metric_value_sets:
+            name = value_set.metric_name
+            kind = self._kinds.get(name, self.DEFAULT_KIND)
+            columns = self._columns_by_name_then_type[name]
+            for mv in value_set.metric_values:
+                value_type = sc_messages.MetricValue.pb(mv).WhichOneof(u'value')
+                if kind != MetricKind.DELTA or value_type not in _COLUMN_TYPES:
+                    value_type = None
+                column = columns.get(value_type)
+                if column is None:
+                    column = _new_column(value_type, kind,
+                                         self._latency_sketch_accuracy)
+                    columns[value_type] = column
+                column.add(metric_value.sign(mv), mv)
+
+
+def _earliest(a, b):
+    if a is None or (b is not None and b < a):
+        return b
+    return a
+
+
+def _latest(a, b):
+    if a is None or (b is not None and a < b):
+        return b
+    return a
+
+
+class _Column(object):
+    """Holds the labels and times of the metric values in a column."""
+
+    def __init__(self):
+        self._rows_by_signature = {}
+        self._labels = []
+        self._start_times = []
+        self._end_times = []
+
+    def _row(self, signature, mv):
+        """Updates the labels and times of the row for `mv`.
+
+        A row is added if there is none yet, so subclasses should add their
+        values before calling this.
+        """
+        index = self._rows_by_signature.get(signature)
+        if index is None:
+            self._rows_by_signature[signature] = len(self._labels)
+            self._labels.append(dict(mv.labels))
+            self._start_times.append(mv.start_time)
+            self._end_times.append(mv.end_time)
+            return
+        self._start_times[index] = _earliest(self._start_times[index],
+                                             mv.start_time)
+        self._end_times[index] = _latest(self._end_times[index], mv.end_time)
+
+    def _new_metric_value(self, index, **kw):
+        result = metric_value.create(labels=self._labels[index], **kw)
+        if self._start_times[index] is not None:
+            result.start_time = self._start_times[index]
+        if self._end_times[index] is not None:
+            result.end_time = self._end_times[index]
+        return result
+
+
+class _NumberColumn(_Column):
+    """A column that sums int64 or double metric values."""
+
+    def __init__(self, value_type):
+        super(_NumberColumn, self).__init__()
+        self._value_type = value_type
+        self._values = array(u'q' if value_type == _INT64 else u'd')
+
+    def add(self, signature, mv):
+        value = getattr(mv, self._value_type)
+        index = self._rows_by_signature.get(signature)
+        if index is None:
+            self._values.append(value)
+        else:
+            self._values[index] += value
+        self._row(signature, mv)
+
+    def as_metric_values(self):
+        return [self._new_metric_value(i, **{self._value_type: v})
+                for i, v in enumerate(self._values)]
+
+
+class _DistributionColumn(_Column):
+    """A column that merges distribution metric values."""
+
+    def __init__(self, latency_sketch_accuracy=None):
+        super(_DistributionColumn, self).__init__()
+        self._latency_sketch_accuracy = latency_sketch_accuracy
+        self._accumulators = []
+
+    def add(self, signature, mv):
+        dist = mv.distribution_value
+        index = self._rows_by_signature.get(signature)
+        if index is None:
+            self._accumulators.append(self._new_accumulator(dist))
+        else:
+            self._accumulators[index].merge(dist)
+        self._row(signature, mv)
+
+    def _new_accumulator(self, dist):
+        accuracy = self._latency_sketch_accuracy
+        if accuracy is not None:
+            layout = distribution.bucket_layout(dist)
+            if layout is metric_descriptor.TIME_DISTRIBUTION_LAYOUT:
+                sketch = distribution.Sketch(layout, relative_accuracy=accuracy)
+                sketch.merge(dist)
+                return sketch
+        return distribution.Accumulator.from_proto(dist)
+
+    def as_metric_values(self):
+        return [self._new_metric_value(i, distribution_value=acc.to_proto())
+                for i, acc in enumerate(self._accumulators)]
+
+
+class _ProtoColumn(object):
+    """A column that merges metric values as protos."""
+
+    def __init__(self, kind):
+        self._kind = kind
+        self._values_by_signature = {}
+
+    def add(self, signature, mv):
+        prior = self._values_by_signature.get(signature)
+        if prior is not None:
+            mv = metric_value.merge(self._kind, prior, mv)
+        self._values_by_signature[signature] = mv
+
+    def as_metric_values(self):
+        return list(self._values_by_signature.values())
+
+
+_INT64 = u'int64_value'
+_DOUBLE = u'double_value'
+_DISTRIBUTION = u'distribution_value'
+_COLUMN_TYPES = (_INT64, _DOUBLE, _DISTRIBUTION)
+
+
+def _new_column(value_type, kind, latency_sketch_accuracy):
+    if value_type == _DISTRIBUTION:
+        return _DistributionColumn(latency_sketch_accuracy)
+    elif value_type in (_INT64, _DOUBLE):
+        return _NumberColumn(value_type)
+    return _ProtoColumn(kind)
@@ -0,0 +1,207 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""path_trie provides a segment trie used to match url paths to templates.
+
+:class:`PathTrie` stores values against path templates like those accepted by
+:func:`endpoints_management.control.path_regex.compile_path_pattern`, e.g,
+``shelves/{shelf}/books`` or ``shelves/{shelf}:lock``.  Looking up a path
+costs time proportional to the number of segments in the path rather than the
+number of templates registered.
+
+Matching follows the approach used by ESP:
+
+- literal segments are preferred over ``{variable}`` segments
+- a ``:verb`` suffix on the final segment of a template is matched against
+  the final segment of a path
+- when several templates match equally, the first one inserted wins
+
+Templates that cannot be represented in the trie (e.g, those using regex
+syntax in their literal segments) are rejected by :meth:`PathTrie.insert` so
+that callers can fall back to matching them with a regex.
+
+"""
+
+from __future__ import absolute_import
+
+from builtins import object
+import re
+
+from .path_regex import _PATH_VARIABLE_PATTERN
+
+_VARIABLE_SEGMENT = re.compile(r'^{(%s)}$' % (_PATH_VARIABLE_PATTERN,))
+
+# Literal segments containing any of these would be treated as regex syntax
+# by path_regex, so templates containing them are not added to the trie
+_REGEX_CHARS = frozenset(u'.^$*+?()[]{}|\\')
+
+# Characters that path_regex does not allow a variable's value to contain
+_BAD_VALUE_CHARS = re.compile(r'[?#\[\]{}]')
+
+_NO_VERB = u''
+
+
+class PathTrie(object):
+    """Matches url paths against templates using a trie of path segments.
+
+    Thread compatible; safe for concurrent lookups once all inserts are done.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def insert(self, template, value):
+        """Adds ``template`` to this instance, associating it with ``value``.
+
+        Args:
+          template (string): a path template, without a leading '/'
+          value (object): the value returned by :meth:`lookup` for paths that
+            match template
+
+        Returns:
+          bool: ``True`` if the template was added, or ``False`` if it cannot
+            be represented by this instance
+        """
+        parsed = _parse_template(template)
+        if parsed is None:
+            return False
+        segments, verb = parsed
+        node = self._root
+        for is_variable, segment in segments:
+            node = node.child(is_variable, segment)
+        if verb not in node.values:  # the earliest insert takes precedence
+            node.values[verb] = value
+        self._size += 1
+        return True
+
+    def lookup(self, path):
+        """Finds the value of the template that matches ``path``.
+
+        Args:
+          path (string): a url path, without a leading '/'
+
+        Returns:
+          object: the value of the matching template, or ``None`` if no
+            template matches
+        """
+        segments = path.split(u'/')
+        result = _match(self._root, segments, 0)
+        if result is None and len(segments) > 1 and not segments[-1]:
+            # templates also match paths with a single trailing '/'
+            result = _match(self._root, segments[:-1], 0)
+        return result
+
+
+class _Node(object):
+    # pylint: disable=too-few-public-methods
+    __slots__ = (u'literals', u'variable', u'values')
+
+    def __init__(self):
+        self.literals = {}
+        self.variable = None
+        self.values = {}
+
+    def child(self, is_variable, segment):
+        if is_variable:
+            if self.variable is None:
+                self.variable = _Node()
+            return self.variable
+        node = self.literals.get(segment)
+        if node is None:
+            node = self.literals[segment] = _Node()
+        return node
+
+
+def _parse_segment(segment):
+    if _VARIABLE_SEGMENT.match(segment):
+        return True, None
+    if _REGEX_CHARS.intersection(segment):
+        return None
+    return False, segment
+
+
+def _parse_template(template):
+    """Splits ``template`` into its segments and verb.
+
+    Returns:
+      tuple: (list[tuple(bool, string)], string) the segments as
+        (is_variable, literal) pairs followed by the verb, or None if the
+        template cannot be represented in the trie
+    """
+    raw_segments = template.split(u'/')
+    last, _, verb = raw_segments[-1].partition(u':')
+    if u':' in verb:
+        return None
+    raw_segments[-1] = last
+    segments = []
+    for raw in raw_segments:
+        parsed = _parse_segment(raw)
+        if parsed is None:
+            return None
+        segments.append(parsed)
+    return segments, verb
+
+
+def _verb_splits(segment):
+    """Yields the ways the final ``segment`` of a path could carry a verb.
+
+    The splits with a verb come first, so that a template with a verb is
+    preferred to one without it whatever order they were inserted in.
+    """
+    colon = segment.find(u':')
+    while colon != -1:
+        yield segment[:colon], segment[colon + 1:]
+        colon = segment.find(u':', colon + 1)
+    yield segment, _NO_VERB
+
+
+def _is_variable_value(value):
+    return _BAD_VALUE_CHARS.search(value) is None
+
+
+def _match(node, segments, index):
+    segment = segments[index]
+    if index == len(segments) - 1:
+        return _match_final(node, segment)
+
+    literal = node.literals.get(segment)
+    if literal is not None:
+        result = _match(literal, segments, index + 1)
+        if result is not None:
+            return result
+
+    variable = node.variable
+    if variable is not None and _is_variable_value(segment):
+        return _match(variable, segments, index + 1)
+    return None
+
+
+def _match_final(node, segment):
+    splits = list(_verb_splits(segment))
+    for name, verb in splits:
+        literal = node.literals.get(name)
+        if literal is not None and verb in literal.values:
+            return literal.values[verb]
+
+    variable = node.variable
+    if variable is None or not variable.values:
+        return None
+    for value, verb in splits:
+        if verb in variable.values and _is_variable_value(value):
+            return variable.values[verb]
+    return None
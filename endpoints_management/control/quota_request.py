@@ -31,7 +31,6 @@ standard_library.install_aliases()
 from builtins import object
 import collections
 import copy
-import hashlib
 import http.client
 import logging
 from datetime import datetime
@@ -122,21 +121,15 @@ def sign(allocate_quota_request):
     if not op or not op.method_name or not op.consumer_id:
         logging.error(u'Bad %s: not initialized => not signed', allocate_quota_request)
         raise ValueError(u'allocate_quota request must be initialized with an operation')
-    md5 = hashlib.md5()
-    md5.update(op.method_name.encode('utf-8'))
-    md5.update(b'\x00')
-    md5.update(op.consumer_id.encode('utf-8'))
-    if op.labels:
-        sorted_labels = {k: op.labels[k] for k in sorted(op.labels)}
-        signing.add_dict_to_hash(md5, sorted_labels)
+    parts = signing.operation_parts(
+        op.method_name, op.consumer_id, op.labels)
     for value_set in op.quota_metrics:
-        md5.update(b'\x00')
-        md5.update(value_set.metric_name.encode('utf-8'))
+        parts.append(value_set.metric_name)
         for mv in value_set.metric_values:
-            metric_value.update_hash(md5, mv)
+            signing.add_labels(parts, mv.labels)
 
-    md5.update(b'\x00')
-    return md5.digest()
+    parts.append(u'')
+    return signing.sign(parts)
 
 
 _KNOWN_LABELS = label_descriptor.KnownLabels
@@ -177,21 +170,14 @@ class Info(collections.namedtuple(u'Info', _INFO_FIELDS), operation.Info):
             raise ValueError(u'the operation id must be set')
         if not self.operation_name:
             raise ValueError(u'the operation name must be set')
-        op = super(Info, self).as_operation(timer=timer)
-        labels = {}
-        if self.client_ip:
-            labels[_KNOWN_LABELS.SCC_CALLER_IP.label_name] = self.client_ip
-
-        if self.referer:
-            labels[_KNOWN_LABELS.SCC_REFERER.label_name] = self.referer
-
+        # quota operations have no times, so an Operation is not needed
         qop = sc_messages.QuotaOperation(
-            operation_id=op.operation_id,
-            method_name=op.operation_name,
-            consumer_id=op.consumer_id,
+            operation_id=self.operation_id,
+            method_name=self.operation_name,
+            consumer_id=self.consumer_id,
             quota_mode=sc_messages.QuotaOperation.QuotaMode.BEST_EFFORT,
         )
-        qop.labels = labels
+        qop.labels = self._labels()
 
         quota_info = self.quota_info if self.quota_info else {}
         qop.quota_metrics= [
@@ -205,6 +191,40 @@ class Info(collections.namedtuple(u'Info', _INFO_FIELDS), operation.Info):
             allocate_quota_request.service_config_id = self.config_id
         return allocate_quota_request
 
+    def signature(self):
+        """Obtains the signature of the `AllocateQuotaRequest` made from this instance.
+
+        This is the same as ``sign(self.as_allocate_quota_request())``, but it
+        is obtained without making the request.
+
+        Returns:
+           string: a secure hash generated from the fields of this instance
+
+        Raises:
+          ValueError: if the fields in this instance are insufficient to
+            to sign an ``AllocateQuotaRequest``
+
+        """
+        consumer_id = self.consumer_id
+        if not self.operation_name or not consumer_id:
+            raise ValueError(u'quota info must have an operation and consumer')
+        parts = signing.operation_parts(
+            self.operation_name, consumer_id, self._labels())
+        # the metric values have no labels, so only the names are signed
+        parts.extend(self.quota_info or ())
+        parts.append(u'')
+        return signing.sign(parts)
+
+    def _labels(self):
+        labels = {}
+        if self.client_ip:
+            labels[_KNOWN_LABELS.SCC_CALLER_IP.label_name] = self.client_ip
+
+        if self.referer:
+            labels[_KNOWN_LABELS.SCC_REFERER.label_name] = self.referer
+
+        return labels
+
 
 class Aggregator(object):
     """Caches and aggregates ``AllocateQuotaRequests``.
@@ -230,6 +250,8 @@ class Aggregator(object):
         self._service_name = service_name
         self._options = options
         self._cache = caches.create(options, timer=timer, use_deque=False)
+        self._shared_cache = (None if self._cache is None else
+                              caches.create_shared(options, timer=timer))
         # When using the result of `with self._out as out`, you must disable no-member
         # in pyflakes. Known issue with no fix ETA:
         # https://github.com/PyCQA/astroid/issues/347
@@ -268,15 +290,17 @@ class Aggregator(object):
         """
         if self._cache is None:
             return []
-        with self._cache as c, self._out as out:
-            c.expire()
-            now = self._timer()
-            for item in list(c.values()):
-                if (not self._in_flush_all) and (not self._should_expire(item)):
-                    if (not item.is_in_flight) and item._op_aggregator is not None:
-                        item.is_in_flight = True
-                        item.last_refresh_timestamp = now
-                        out.append(item.extract_request())  # pylint: disable=no-member
+        for shard in self._cache.shards:
+            with shard as c, self._out as out:
+                c.expire()
+                now = self._timer()
+                for item in list(c.values()):
+                    if (not self._in_flush_all) and (not self._should_expire(item)):
+                        if (not item.is_in_flight) and item.has_aggregated():
+                            item.is_in_flight = True
+                            item.last_refresh_timestamp = now
+                            out.append(item.extract_request())  # pylint: disable=no-member
+        with self._out as out:
             flushed_items = list(out)
             out.clear()  # pylint: disable=no-member
             for req in flushed_items:
@@ -286,11 +310,13 @@ class Aggregator(object):
     def clear(self):
         """Clears this instance's cache."""
         if self._cache is not None:
-            with self._cache as c, self._out as out:
-                self.in_flush_all = True
-                c.clear()
+            self.in_flush_all = True
+            for shard in self._cache.shards:
+                with shard as c:
+                    c.clear()
+            with self._out as out:
                 out.clear()  # pylint: disable=no-member
-                self.in_flush_all = False
+            self.in_flush_all = False
 
     def add_response(self, req, resp):
         """Adds the response from sending to `req` to this instance's cache.
@@ -302,7 +328,7 @@ class Aggregator(object):
         if self._cache is None:
             return
         signature = sign(req)
-        with self._cache as c:
+        with self._cache.shard(signature) as c:
             now = self._timer()
             item = c.get(signature)
             if item is None:
@@ -314,31 +340,40 @@ class Aggregator(object):
                 item.response = resp
                 item.is_in_flight = False
                 c[signature] = item
+        if self._shared_cache is not None:
+            self._shared_cache.set(
+                signature, sc_messages.AllocateQuotaResponse.serialize(resp))
 
     def allocate_quota(self, req):
+        """Determine if ``req`` has a cached response, queuing it if not.
+
+        If ``req`` is an :class:`Info`, an AllocateQuotaRequest is only made
+        from it when there is no cached response.
+
+        Args:
+          req (``AllocateQuotaRequest`` or :class:`Info`): the request
+
+        Returns:
+           ``AllocateQuotaResponse``: the cached or a temporary response, or
+             None if there is no cache
+
+        """
         if self._cache is None:
             return None  # no cache, send request now
-        if not isinstance(req, sc_messages.AllocateQuotaRequest):
-            raise ValueError(u'Invalid request')
-        if req.service_name != self.service_name:
-            _logger.error(u'bad allocate_quota(): service_name %s does not match ours %s',
-                          req.service_name, self.service_name)
-            raise ValueError(u'Service name mismatch')
-        allocate_quota_request = req
-        if allocate_quota_request is None:
-            _logger.error(u'bad allocate_quota(): no allocate_quota_request in %s', req)
-            raise ValueError(u'Expected operation not set')
-        op = allocate_quota_request.allocate_operation
-        if not op:
-            _logger.error(u'bad allocate_quota(): no operation in %s', req)
-            raise ValueError(u'Expected operation not set')
-
-        signature = sign(allocate_quota_request)
-        with self._cache as cache, self._out as out:
+        quota_info, allocate_quota_request, signature = self._sign_request(req)
+        with self._cache.shard(signature) as cache, self._out as out:
             now = self._timer()
             _logger.debug(u'checking the cache for %r\n%s', signature, cache)
             item = cache.get(signature)
             if item is None:
+                item = self._from_shared_cache(signature, req)
+                if item is not None:
+                    cache[signature] = item
+            if item is None:
+                if quota_info is not None:
+                    # the request is sent now, so it must be made
+                    allocate_quota_request = quota_info.as_allocate_quota_request()
+                op = allocate_quota_request.allocate_operation
                 # to avoid sending concurrent allocate_quota from
                 # concurrent requests, insert a temporary positive
                 # response in the cache. Quota requests from other API
@@ -350,7 +385,7 @@ class Aggregator(object):
                 item.signature = signature
                 item.is_in_flight = True
                 cache[signature] = item
-                out.append(req)  # pylint: disable=no-member
+                out.append(allocate_quota_request)  # pylint: disable=no-member
                 return temp_response  # positive response
             if not item.is_in_flight and self._should_refresh(item):
                 item.is_in_flight = True
@@ -363,9 +398,51 @@ class Aggregator(object):
                     refresh_request.allocate_operation.quota_mode = normal
                 out.append(refresh_request)  # pylint: disable=no-member
             if item.is_positive_response():
-                item.aggregate(allocate_quota_request)
+                if quota_info is not None:
+                    item.aggregate_info(quota_info)
+                else:
+                    item.aggregate(allocate_quota_request)
             return item.response
 
+    def _sign_request(self, req):
+        """Validates ``req`` and obtains its signature.
+
+        Returns:
+          tuple: the :class:`Info` or ``AllocateQuotaRequest`` in ``req``, with
+            ``None`` in place of the other, and the signature
+
+        """
+        if not isinstance(req, (sc_messages.AllocateQuotaRequest, Info)):
+            raise ValueError(u'Invalid request')
+        if req.service_name != self.service_name:
+            _logger.error(u'bad allocate_quota(): service_name %s does not match ours %s',
+                          req.service_name, self.service_name)
+            raise ValueError(u'Service name mismatch')
+        if isinstance(req, Info):
+            return req, None, req.signature()
+        if not req.allocate_operation:
+            _logger.error(u'bad allocate_quota(): no operation in %s', req)
+            raise ValueError(u'Expected operation not set')
+        return None, req, sign(req)
+
+    def _from_shared_cache(self, signature, req):
+        # uses a response added by another process sharing the cache; the
+        # cost of req is then aggregated, and sent by a later flush
+        if self._shared_cache is None:
+            return None
+        found = self._shared_cache.get(signature)
+        if found is None:
+            return None
+        data, last_check_time = found
+        _logger.debug(u'using the shared response for %r', signature)
+        if isinstance(req, Info):
+            req = req.as_allocate_quota_request()
+        item = CachedItem(req,
+                          sc_messages.AllocateQuotaResponse.deserialize(data),
+                          self.service_name, last_check_time)
+        item.signature = signature
+        return item
+
     def _should_refresh(self, item):
         age = self._timer() - item.last_check_time
         return age >= self._options.flush_interval
@@ -398,6 +475,10 @@ class CachedItem(object):
         self.is_in_flight = False
         self._service_name = service_name
         self._op_aggregator = None
+        # the first Info aggregated since the last extraction, and the total
+        # costs of all of them; its operation is made on extraction
+        self._info = None
+        self._info_costs = None
 
     def aggregate(self, req):
         assert isinstance(req, sc_messages.AllocateQuotaRequest)
@@ -408,7 +489,22 @@ class CachedItem(object):
         else:
             self._op_aggregator.merge_operation(req.allocate_operation)
 
+    def aggregate_info(self, info):
+        if self._info is None:
+            self._info = info
+            self._info_costs = {}
+        costs = self._info_costs
+        for name, cost in (info.quota_info or {}).items():
+            costs[name] = costs.get(name, 0) + cost
+
+    def has_aggregated(self):
+        return self._op_aggregator is not None or self._info is not None
+
     def extract_request(self):
+        if self._info is not None:
+            info = self._info._replace(quota_info=self._info_costs)
+            self._info = self._info_costs = None
+            self.aggregate(info.as_allocate_quota_request())
         if self._op_aggregator is None:
             allocate_quota_request = self.request
         else:
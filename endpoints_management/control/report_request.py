@@ -24,17 +24,17 @@ from __future__ import absolute_import
 
 from builtins import range
 from builtins import object
+from past.builtins import basestring
 import collections
 import functools
-import hashlib
 import logging
+import threading
 import time
 from datetime import datetime, timedelta
 
 from google.cloud import servicecontrol as sc_messages
 from google.logging.type import log_severity_pb2 as log_severity
-from google.protobuf import struct_pb2, timestamp_pb2
-from google.protobuf.json_format import ParseDict
+from google.protobuf import struct_pb2
 
 from enum import Enum
 from . import caches, label_descriptor, operation
@@ -78,6 +78,24 @@ class ReportingRules(collections.namedtuple(u'ReportingRules',
         labels = tuple(labels) if labels else tuple()
         return super(cls, ReportingRules).__new__(cls, logs, metrics, labels)
 
+    def compile(self):
+        """Makes the function that adds the labels and metrics of these rules.
+
+        The function is made on the first call and reused after that; the
+        labels that are the same for every operation are computed once, and
+        the known metrics are updated without their per-metric wrappers.
+
+        Returns:
+          function(:class:`Info`, ``Operation``): a function that updates an
+          operation with the labels and metrics derived from an :class:`Info`
+
+        """
+        update_operation = getattr(self, u'_update_operation', None)
+        if update_operation is None:
+            update_operation = _compile_rules(self)
+            self._update_operation = update_operation
+        return update_operation
+
     @classmethod
     def from_known_inputs(cls, logs=None, metric_names=None, label_names=None):
         """An alternate constructor that assumes known metrics and labels.
@@ -165,7 +183,35 @@ _SEVERITY = log_severity.LogSeverity
 
 def _struct_payload_from(a_dict):
     struct_pb = struct_pb2.Struct()
-    return ParseDict(a_dict, struct_pb)
+    _fill_struct(struct_pb, a_dict)
+    return struct_pb
+
+
+def _fill_struct(struct_pb, a_dict):
+    fields = struct_pb.fields
+    for key, value in a_dict.items():
+        _fill_value(fields[key], value)
+
+
+def _fill_value(value_pb, value):
+    # the checks follow the order used by json_format.ParseDict, so that the
+    # payloads are the same as those it produced
+    if isinstance(value, dict):
+        _fill_struct(value_pb.struct_value, value)
+    elif isinstance(value, list):
+        list_pb = value_pb.list_value
+        for item in value:
+            _fill_value(list_pb.values.add(), item)
+    elif value is None:
+        value_pb.null_value = struct_pb2.NULL_VALUE
+    elif isinstance(value, bool):
+        value_pb.bool_value = value
+    elif isinstance(value, basestring):
+        value_pb.string_value = value
+    elif isinstance(value, (int, float)):
+        value_pb.number_value = value
+    else:
+        raise ValueError(u'Cannot add %r to a log entry payload' % (value,))
 
 
 _KNOWN_LABELS = label_descriptor.KnownLabels
@@ -343,7 +389,7 @@ class Info(
 
         return sc_messages.LogEntry(
             name=name,
-            timestamp=timestamp_pb2.Timestamp().FromJsonString(timestamp.to_rfc3339(now)),
+            timestamp=timestamp.to_timestamp_pb(now),
             severity=severity,
             struct_payload=_struct_payload_from(d))
 
@@ -371,22 +417,7 @@ class Info(
         # Populate metrics and labels if they can be associated with a
         # method/operation
         if op.operation_id and op.operation_name:
-            labels = {}
-            for known_label in rules.labels:
-                known_label.do_labels_update(self, labels)
-
-            # Forcibly add system label reporting here, as the base service
-            # config does not specify it as a label.
-            labels[_KNOWN_LABELS.SCC_PLATFORM.label_name] = (
-                self.platform.friendly_string())
-            labels[_KNOWN_LABELS.SCC_SERVICE_AGENT.label_name] = (
-                SERVICE_AGENT)
-            labels[_KNOWN_LABELS.SCC_USER_AGENT.label_name] = USER_AGENT
-
-            if labels:
-                op.labels = labels
-            for known_metric in rules.metrics:
-                known_metric.do_operation_update(self, op)
+            rules.compile()(self, op)
 
         # Populate the log entries
         now = timer()
@@ -397,8 +428,76 @@ class Info(
             operations=[op])
 
 
+# Forcibly add system label reporting, as the base service config does not
+# specify it as a label.
+_CONSTANT_LABELS = {
+    _KNOWN_LABELS.SCC_SERVICE_AGENT.label_name: SERVICE_AGENT,
+    _KNOWN_LABELS.SCC_USER_AGENT.label_name: USER_AGENT,
+}
+_PLATFORM_LABEL = _KNOWN_LABELS.SCC_PLATFORM.label_name
+_PLATFORM_NAMES = dict(
+    (p, p.friendly_string()) for p in ReportedPlatforms)
+_FORCED_LABELS = (_KNOWN_LABELS.SCC_PLATFORM,
+                  _KNOWN_LABELS.SCC_SERVICE_AGENT,
+                  _KNOWN_LABELS.SCC_USER_AGENT)
+
+# the positions of the conditions on the consumer that enable each type of
+# metric; see update_operation below
+_MARK_INDICES = {
+    metric_descriptor.Mark.PRODUCER: 0,
+    metric_descriptor.Mark.CONSUMER: 1,
+    metric_descriptor.Mark.PRODUCER_BY_CONSUMER: 2,
+}
+
+
+def _compile_rules(rules):
+    label_updaters = tuple(
+        (l.update_label_func, l.label_name) for l in rules.labels
+        if l.update_label_func and l not in _FORCED_LABELS)
+    metric_updaters = tuple(
+        (m.base_update_op_func, m.metric_name, _MARK_INDICES[m.mark])
+        for m in rules.metrics)
+
+    def update_operation(info, op):
+        labels = dict(_CONSTANT_LABELS)
+        for func, name in label_updaters:
+            func(name, info, labels)
+        labels[_PLATFORM_LABEL] = _PLATFORM_NAMES[info.platform]
+        op.labels = labels
+
+        enabled = (True,
+                   info.api_key_valid,
+                   info.consumer_project_number > 0)
+        for func, name, mark_index in metric_updaters:
+            if enabled[mark_index]:
+                func(name, info, op)
+
+    return update_operation
+
+
 _NO_RESULTS = tuple()
 
+# the labels whose values vary with each consumer or end user; they are
+# removed when operations are collapsed
+_HIGH_CARDINALITY_LABELS = tuple(l.label_name for l in (
+    _KNOWN_LABELS.CREDENTIAL_ID,
+    _KNOWN_LABELS.END_USER,
+    _KNOWN_LABELS.END_USER_COUNTRY,
+    _KNOWN_LABELS.REFERER,
+    _KNOWN_LABELS.SCC_ANDROID_CERT_FINGERPRINT,
+    _KNOWN_LABELS.SCC_ANDROID_PACKAGE_NAME,
+    _KNOWN_LABELS.SCC_CALLER_IP,
+    _KNOWN_LABELS.SCC_CONSUMER_PROJECT,
+    _KNOWN_LABELS.SCC_IOS_BUNDLE_ID,
+    _KNOWN_LABELS.SCC_REFERER,
+))
+
+# the metrics that are attributed to the consumer; they are removed when
+# operations are collapsed
+_CONSUMER_METRIC_NAMES = frozenset(
+    m.metric_name for m in metric_descriptor.KnownMetrics
+    if m.mark is not metric_descriptor.Mark.PRODUCER)
+
 
 class Aggregator(object):
     """Aggregates Service Control Report requests.
@@ -433,6 +532,16 @@ class Aggregator(object):
         self._options = options
         self._kinds = kinds
         self._service_name = service_name
+        self._max_pending = None
+        if self._cache is not None and options.max_pending is not None:
+            # like the entries, the budget is divided between the shards
+            num_shards = len(self._cache.shards)
+            self._max_pending = -(-options.max_pending // num_shards)
+        self._overflows_lock = threading.Lock()
+        self._overflows = dict((p, 0) for p in caches.OverflowPolicy)
+        # collapsed operations are held apart from the cache, so collapsing
+        # never evicts the operations pending in it
+        self._collapsed = caches.LockedObject({})
 
     @property
     def flush_interval(self):
@@ -450,6 +559,18 @@ class Aggregator(object):
         """The service to which all requests being aggregated should belong."""
         return self._service_name
 
+    @property
+    def overflows(self):
+        """Counts the actions taken since aggregation went over budget.
+
+        Returns:
+          dict[:class:`endpoints_management.control.caches.OverflowPolicy`, int]:
+            the number of operations dropped or collapsed by each policy
+
+        """
+        with self._overflows_lock:
+            return dict(self._overflows)
+
     def flush(self):
         """Flushes this instance's cache.
 
@@ -463,29 +584,55 @@ class Aggregator(object):
         """
         if self._cache is None:
             return _NO_RESULTS
-        with self._cache as c:
-            flushed_ops = [x.as_operation() for x in c.out_deque]
-            c.out_deque.clear()
-            reqs = []
-            max_ops = self.MAX_OPERATION_COUNT
-            for x in range(0, len(flushed_ops), max_ops):
-                report_request = sc_messages.ReportRequest(
-                    service_name=self.service_name,
-                    operations=flushed_ops[x:x + max_ops])
-                reqs.append(report_request)
-
-            return reqs
+        flushed_ops = []
+        for shard in self._cache.shards:
+            with shard as c:
+                out_deque = c.out_deque
+                flushed_ops.extend(x.as_operation() for x in out_deque)
+                out_deque.clear()
+        flushed_ops.extend(self._clear_collapsed())
+        return self.as_report_requests(flushed_ops)
+
+    def as_report_requests(self, operations):
+        """Batches operations into report requests.
+
+        Args:
+          operations (list[``Operation``]): the operations, e.g, as returned
+            by :func:`clear`
+
+        Returns:
+          list[``ReportRequest``]: requests holding up to
+            ``MAX_OPERATION_COUNT`` of the operations each
+
+        """
+        reqs = []
+        max_ops = self.MAX_OPERATION_COUNT
+        for x in range(0, len(operations), max_ops):
+            report_request = sc_messages.ReportRequest(
+                service_name=self.service_name,
+                operations=operations[x:x + max_ops])
+            reqs.append(report_request)
+
+        return reqs
 
     def clear(self):
         """Clears the cache."""
         if self._cache is None:
             return _NO_RESULTS
-        if self._cache is not None:
-            with self._cache as k:
-                res = [x.as_operation() for x in list(k.values())]
+        res = []
+        for shard in self._cache.shards:
+            with shard as k:
+                res.extend(x.as_operation() for x in list(k.values()))
                 k.clear()
                 k.out_deque.clear()
-                return res
+        res.extend(self._clear_collapsed())
+        return res
+
+    def _clear_collapsed(self):
+        with self._collapsed as aggs:
+            res = [x.as_operation() for x in list(aggs.values())]
+            aggs.clear()
+        return res
 
     def report(self, req):
         """Adds a report request to the cache.
@@ -520,18 +667,100 @@ class Aggregator(object):
 
         # Concurrency:
         #
-        # This holds a lock on the cache while updating it.  No i/o operations
-        # are performed, so any waiting threads see minimal delays
-        with self._cache as cache:
-            for key, op in list(ops_by_signature.items()):
-                agg = cache.get(key)
-                if agg is None:
-                    cache[key] = operation.Aggregator(op, self._kinds)
-                else:
-                    agg.add(op)
+        # This holds a lock on the cache shard holding each operation while
+        # updating it.  No i/o operations are performed, so any waiting threads
+        # see minimal delays
+        for key, op in list(ops_by_signature.items()):
+            with self._cache.shard(key) as cache:
+                added = self._add(cache, key, op)
+            if not added:
+                self._collapse(op)
 
         return self.CACHED_OK
 
+    def _add(self, cache, key, op):
+        """Aggregates ``op`` in a locked shard, keeping to its budget.
+
+        Returns:
+          bool: ``False`` if the operation should be collapsed instead
+
+        """
+        agg = cache.get(key)
+        if agg is not None:
+            agg.add(op)  # merging does not add to the pending operations
+            return True
+
+        # the budget only applies once adding the operation would evict
+        # another one; expired operations wait for the flush regardless
+        max_pending = self._max_pending
+        out_deque = cache.out_deque  # expires the operations that are due
+        evicting = (max_pending is not None and
+                    len(cache) >= cache.maxsize)
+        policy = self._options.overflow_policy
+        if evicting and len(out_deque) >= max_pending:
+            if policy is caches.OverflowPolicy.DROP_NEWEST:
+                self._count_overflow(policy)
+                return True
+            if policy is caches.OverflowPolicy.COLLAPSE:
+                return False
+
+        cache[key] = self._new_aggregator(op)
+
+        # evicting to add the operation may have exceeded the budget
+        while evicting and len(out_deque) > max_pending:
+            out_deque.popleft()
+            self._count_overflow(caches.OverflowPolicy.DROP_OLDEST)
+        return True
+
+    def _collapse(self, op):
+        """Merges ``op`` into the collapsed operations, keeping to the budget.
+
+        An operation that does not merge into an existing collapsed operation
+        is dropped once there are ``max_pending`` of them.
+        """
+        collapsed = _collapse_operation(op)
+        key = _sign_operation(collapsed)
+        with self._collapsed as aggs:
+            agg = aggs.get(key)
+            if agg is not None:
+                agg.add(collapsed)
+            elif len(aggs) < self._options.max_pending:
+                aggs[key] = self._new_aggregator(collapsed)
+            else:
+                self._count_overflow(caches.OverflowPolicy.DROP_NEWEST)
+                return
+        self._count_overflow(caches.OverflowPolicy.COLLAPSE)
+
+    def _new_aggregator(self, op):
+        return operation.ColumnarAggregator(
+            op, self._kinds,
+            latency_sketch_accuracy=self._options.latency_sketch_accuracy)
+
+    def _count_overflow(self, policy):
+        with self._overflows_lock:
+            self._overflows[policy] += 1
+
+
+def _collapse_operation(op):
+    """Copies ``op`` without the fields that vary with each caller.
+
+    The copy has no consumer, high-cardinality labels, consumer metrics or log
+    entries, so operations from many consumers aggregate into one.
+    """
+    collapsed = sc_messages.Operation()
+    collapsed_pb = sc_messages.Operation.pb(collapsed)
+    collapsed_pb.CopyFrom(sc_messages.Operation.pb(op))
+    collapsed_pb.ClearField(u'consumer_id')
+    collapsed_pb.ClearField(u'log_entries')
+    for name in _HIGH_CARDINALITY_LABELS:
+        if name in collapsed_pb.labels:
+            del collapsed_pb.labels[name]
+    value_sets = collapsed_pb.metric_value_sets
+    for index in reversed(range(len(value_sets))):
+        if value_sets[index].metric_name in _CONSUMER_METRIC_NAMES:
+            del value_sets[index]
+    return collapsed
+
 
 def _has_high_important_operation(req):
     def is_important(op):
@@ -564,11 +793,5 @@ def _sign_operation(op):
     Returns:
        string: a unique signature for that operation
     """
-    md5 = hashlib.md5()
-    md5.update(op.consumer_id.encode('utf-8'))
-    md5.update(b'\x00')
-    md5.update(op.operation_name.encode('utf-8'))
-    if op.labels:
-        sorted_labels = {k: op.labels[k] for k in sorted(op.labels)}
-        signing.add_dict_to_hash(md5, sorted_labels)
-    return md5.digest()
+    return signing.sign(signing.operation_parts(
+        op.consumer_id, op.operation_name, op.labels))
@@ -37,12 +37,13 @@ import os
 import urllib.request, urllib.parse, urllib.error
 
 
+import cachetools
 from enum import Enum
 from google.api import service_pb2
 from google.protobuf.json_format import Parse, ParseDict, ParseError, MessageToDict
 
 from ..config import service_config
-from . import label_descriptor, metric_descriptor, path_regex
+from . import caches, label_descriptor, metric_descriptor, path_regex, path_trie
 
 
 _logger = logging.getLogger(__name__)
@@ -121,22 +122,35 @@ class Loaders(Enum):
         return self._load_func(**kw)
 
 
+_NOT_FOUND = object()  # caches lookups that did not match any method
+
+
 class MethodRegistry(object):
     """Provides a registry of the api methods defined by a ``Service``.
 
     During construction, ``MethodInfo`` instances are extracted from a
     ``Service``.  The are subsequently accessible via the :func:`lookup` method.
 
+    The results of :func:`lookup`, including misses, are memoized in a bounded
+    LRU cache keyed by the normalized http method and path.
+
     """
     # pylint: disable=too-few-public-methods
     _OPTIONS = u'OPTIONS'
 
-    def __init__(self, service):
+    DEFAULT_LOOKUP_CACHE_SIZE = 0
+    """The default maximum number of memoized lookups; the memo is off"""
+
+    def __init__(self, service, lookup_cache_size=DEFAULT_LOOKUP_CACHE_SIZE):
         """Constructor.
 
         Args:
           service (:class:`endpoints_management.gen.servicemanagement_v1_messages.Service`):
             a service instance
+          lookup_cache_size (int): the maximum number of lookup results to
+            memoize; the memo is disabled if this is 0 or less.  Paths that
+            match no method are memoized too, so a memo on a service whose
+            clients send arbitrary paths may hold few of the hot ones
         """
         if not isinstance(service, service_pb2.Service):
             raise ValueError(u'service should be an instance of Service')
@@ -149,28 +163,67 @@ class MethodRegistry(object):
         self._auth_infos = self._extract_auth_config()
         self._quota_infos = self._extract_quota_config()
 
-        # tracks urls templates
+        # tracks urls templates; those that can't be added to the per-method
+        # tries are matched using their regex instead
+        self._method_tries = collections.defaultdict(path_trie.PathTrie)
         self._templates_method_infos = collections.defaultdict(list)
         self._extract_methods()
 
+        self._lookup_cache = None
+        if lookup_cache_size > 0:
+            self._lookup_cache = caches.LockedObject(
+                cachetools.LRUCache(lookup_cache_size))
+        self._lookup_cache_hits = 0
+        self._lookup_cache_misses = 0
+
+    @property
+    def lookup_cache_hits(self):
+        """The number of lookups answered by the lookup cache."""
+        return self._lookup_cache_hits
+
+    @property
+    def lookup_cache_misses(self):
+        """The number of lookups that were not in the lookup cache."""
+        return self._lookup_cache_misses
+
     def lookup(self, http_method, path):
         http_method = http_method.lower()
         if path.startswith(u'/'):
             path = path[1:]
+        # need to remove url quoting of colons. this is the simplest way.
+        path = path.replace('%3A', ':')
+        if self._lookup_cache is None:
+            return self._lookup(http_method, path)
+
+        key = (http_method, path)
+        with self._lookup_cache as cache:
+            method_info = cache.get(key)
+            if method_info is not None:
+                self._lookup_cache_hits += 1
+                return None if method_info is _NOT_FOUND else method_info
+            self._lookup_cache_misses += 1
+
+        method_info = self._lookup(http_method, path)
+        with self._lookup_cache as cache:
+            cache[key] = _NOT_FOUND if method_info is None else method_info
+        return method_info
+
+    def _lookup(self, http_method, path):
+        trie = self._method_tries.get(http_method)
         tmi = self._templates_method_infos.get(http_method)
-        if not tmi:
+        if not trie and not tmi:
             _logger.debug(u'No methods for http method %s in %s',
                           http_method,
+                          list(self._method_tries.keys()) +
                           list(self._templates_method_infos.keys()))
             return None
-        # need to remove url quoting of colons. this is the simplest way.
-        path = path.replace('%3A', ':')
-        # pylint: disable=fixme
-        # TODO: speed this up if it proves to be bottleneck.
-        #
-        # There is sophisticated trie-based solution in esp, something similar
-        # could be built around the path_template implementation
-        for template, method_info in tmi:
+        if trie:
+            method_info = trie.lookup(path)
+            if method_info is not None:
+                _logger.debug(u'%s matched a template for %s', path, http_method)
+                return method_info
+
+        for template, method_info in tmi or ():
             _logger.debug(u'trying %s with template %s', path, template.pattern)
             match = template.match(path)
             if match:
@@ -247,6 +300,11 @@ class MethodRegistry(object):
         try:
             http_method = http_method.lower()
             template = path_regex.compile_path_pattern(url)
+            if self._method_tries[http_method].insert(url, method_info):
+                _logger.debug(u'Registered url %s in the trie for method %s',
+                              url,
+                              http_method)
+                return True
             self._templates_method_infos[http_method].append((template, method_info))
             _logger.debug(u'Registered template %s under method %s',
                           template.pattern,
@@ -0,0 +1,364 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""sidecar lets the processes on a host share one service control client.
+
+Under a pre-fork server, each worker process would otherwise aggregate,
+cache and flush its own requests.  Instead, a single daemon on the host runs
+a :class:`endpoints_management.control.client.Client`, and serves the workers
+over a Unix domain socket; the check and quota responses it caches are used
+by all of them, and their reports are merged before they are sent.
+
+:class:`Server` is the daemon, and :func:`serve` runs one until it is
+interrupted.  :func:`load_client` creates the client used by the workers; it
+does no caching or aggregation of its own, and sends each request to the
+daemon using the transport made by :func:`transport_func`.
+
+Each message is a frame made of a 1 byte kind, the 4 byte big-endian size of
+its payload, and the payload.  The payload of a request is the serialized
+request.  Check and quota requests are answered with a frame of the same
+kind, whose payload is a byte saying whether there is a response, followed by
+the serialized response if there is one; report requests are not answered.
+
+Example:
+
+  >>> # in the daemon
+  >>> from endpoints_management.control import sidecar
+  >>> sidecar.serve('my-service-name', '/run/endpoints/my-service.sock')
+
+  >>> # in each worker
+  >>> control_client = sidecar.load_client('my-service-name',
+  ...                                      '/run/endpoints/my-service.sock')
+  >>> app = wsgi.add_all(app, project_id, control_client)
+
+"""
+
+from __future__ import absolute_import
+
+from builtins import object
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+
+from apitools.base.py import exceptions
+from google.cloud import servicecontrol as sc_messages
+
+from . import client
+
+_logger = logging.getLogger(__name__)
+
+
+# kind, payload size
+_HEADER = struct.Struct(u'>BI')
+
+# the kinds of frame
+_CHECK = 1
+_QUOTA = 2
+_REPORT = 3
+
+# the largest payload accepted, to protect against corrupt frames
+_MAX_PAYLOAD_SIZE = 16 * 1024 * 1024
+
+# the first byte of the payload of a reply; an empty response serializes to
+# no bytes, so it must be told apart from no response
+_NO_RESPONSE = b'\x00'
+_HAS_RESPONSE = b'\x01'
+
+# the types of the messages sent in each kind of frame
+_REQUEST_TYPES = {
+    _CHECK: sc_messages.CheckRequest,
+    _QUOTA: sc_messages.AllocateQuotaRequest,
+    _REPORT: sc_messages.ReportRequest,
+}
+_RESPONSE_TYPES = {
+    _CHECK: sc_messages.CheckResponse,
+    _QUOTA: sc_messages.AllocateQuotaResponse,
+}
+
+DEFAULT_TIMEOUT = 5.0
+"""The default number of seconds a worker waits for the daemon."""
+
+
+class _FrameError(Exception):
+    """Indicates that a frame could not be read."""
+
+
+def _send_frame(sock, kind, payload):
+    sock.sendall(_HEADER.pack(kind, len(payload)) + payload)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _recv_frame(sock):
+    """Reads a frame from ``sock``.
+
+    Returns:
+      tuple(int, bytes): the kind and payload of the frame, or None if the
+        socket was closed before a frame started
+
+    Raises:
+      _FrameError: if the frame is too large, or the socket was closed part way
+        through it
+
+    """
+    header = _recv_exactly(sock, _HEADER.size)
+    if header is None:
+        return None
+    kind, size = _HEADER.unpack(header)
+    if size > _MAX_PAYLOAD_SIZE:
+        raise _FrameError(u'frame payload of %d bytes is too large' % (size,))
+    payload = _recv_exactly(sock, size) if size else b''
+    if payload is None:
+        raise _FrameError(u'the socket closed during a frame')
+    return kind, payload
+
+
+class _SidecarServices(object):
+    """Sends requests to a sidecar daemon over a Unix domain socket.
+
+    Like the transports used by :class:`client.Client`, it is accessed via
+    ``transport.services``.  Failures to reach the daemon are raised as
+    apitools errors, so that the client fails open as it does when the
+    service control api cannot be reached.
+
+    Thread compatible.
+    """
+
+    def __init__(self, path, timeout=DEFAULT_TIMEOUT):
+        self._path = path
+        self._timeout = timeout
+        self._sock = None
+
+    @property
+    def services(self):
+        return self
+
+    def Check(self, req):  # pylint: disable=invalid-name
+        return self._call(_CHECK, req)
+
+    def AllocateQuota(self, req):  # pylint: disable=invalid-name
+        return self._call(_QUOTA, req)
+
+    def Report(self, req):  # pylint: disable=invalid-name
+        self._send(_REPORT, req)
+
+    def close(self):
+        """Closes the connection to the daemon, if one is open."""
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _connect(self):
+        if self._sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self._timeout)
+            try:
+                sock.connect(self._path)
+            except Exception:
+                sock.close()
+                raise
+            self._sock = sock
+        return self._sock
+
+    def _send(self, kind, req):
+        payload = _REQUEST_TYPES[kind].serialize(req)
+        try:
+            _send_frame(self._connect(), kind, payload)
+        except (socket.error, socket.timeout) as e:
+            self.close()
+            raise exceptions.CommunicationError(
+                u'could not send to the sidecar at %s: %s' % (self._path, e))
+
+    def _call(self, kind, req):
+        self._send(kind, req)
+        try:
+            frame = _recv_frame(self._sock)
+        except (socket.error, socket.timeout, _FrameError) as e:
+            self.close()
+            raise exceptions.CommunicationError(
+                u'no response from the sidecar at %s: %s' % (self._path, e))
+        if (frame is None or frame[0] != kind or
+                frame[1][:1] not in (_NO_RESPONSE, _HAS_RESPONSE)):
+            self.close()
+            raise exceptions.CommunicationError(
+                u'bad response from the sidecar at %s' % (self._path,))
+        payload = frame[1]
+        if payload[:1] == _NO_RESPONSE:
+            return None
+        return _RESPONSE_TYPES[kind].deserialize(payload[1:])
+
+
+def transport_func(path, timeout=DEFAULT_TIMEOUT):
+    """Makes a function that creates transports that send to a daemon.
+
+    Each thread that calls the function gets its own connection.
+
+    Args:
+      path (string): the path of the daemon's socket
+      timeout (float): the number of seconds to wait for the daemon
+
+    Returns:
+      function(): creates a transport for use by :class:`client.Client`
+
+    """
+    local = threading.local()
+
+    def create_transport():
+        if not getattr(local, u'transport', None):
+            local.transport = _SidecarServices(path, timeout=timeout)
+        return local.transport
+
+    return create_transport
+
+
+def load_client(service_name, path, timeout=DEFAULT_TIMEOUT, **kw):
+    """Creates a client that sends its requests to a daemon.
+
+    The client does no caching or aggregation of its own, as the daemon
+    does that for all the processes using it.
+
+    Args:
+      service_name (string): the name of the service
+      path (string): the path of the daemon's socket
+      timeout (float): the number of seconds to wait for the daemon
+      **kw: the other keyword args supported by the constructor of
+        :class:`client.Client`
+
+    Returns:
+      :class:`client.Client`: the client
+
+    """
+    check_opts, quota_opts, report_opts = (
+        client.Loaders.NO_CACHE.load_options())
+    return client.Client(service_name, check_opts, quota_opts, report_opts,
+                         create_transport=transport_func(path, timeout),
+                         **kw)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    """Handles the frames sent over a connection from a worker."""
+
+    def handle(self):
+        sock = self.request
+        while True:
+            try:
+                frame = _recv_frame(sock)
+            except (socket.error, _FrameError):
+                _logger.warn(u'dropped a bad sidecar connection',
+                             exc_info=True)
+                return
+            if frame is None:
+                return
+            kind, payload = frame
+            if kind not in _REQUEST_TYPES:
+                _logger.error(u'dropped a sidecar connection that sent a '
+                              u'frame of unknown kind %d', kind)
+                return
+            reply = self._dispatch(kind, payload)
+            if kind == _REPORT:
+                continue
+            try:
+                _send_frame(sock, kind, reply)
+            except socket.error:
+                _logger.warn(u'could not reply on a sidecar connection',
+                             exc_info=True)
+                return
+
+    def _dispatch(self, kind, payload):
+        """Passes a request to the client.
+
+        Returns:
+          bytes: the payload of the reply, or ``None`` for a report
+
+        """
+        control_client = self.server.control_client
+        try:
+            req = _REQUEST_TYPES[kind].deserialize(payload)
+            if kind == _REPORT:
+                control_client.report(req)
+                return None
+            if kind == _CHECK:
+                resp = control_client.check(req)
+            else:
+                resp = control_client.allocate_quota(req)
+            if resp is not None:
+                return _HAS_RESPONSE + _RESPONSE_TYPES[kind].serialize(resp)
+        except Exception:  # pylint: disable=broad-except
+            _logger.error(u'failed to handle a sidecar request of kind %d',
+                          kind, exc_info=True)
+        return None if kind == _REPORT else _NO_RESPONSE
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves the requests of the workers using a single client.
+
+    Each connection is handled by its own thread, and every request is passed
+    to the same :class:`client.Client`, so its caches and aggregation cover
+    all the workers.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, control_client):
+        """Constructor.
+
+        A stale socket file at ``path`` is removed.
+
+        Args:
+          path (string): the path at which to listen
+          control_client (:class:`client.Client`): the client that handles
+            the requests; it should be started before serving
+
+        """
+        if os.path.exists(path):
+            os.remove(path)
+        self.control_client = control_client
+        socketserver.UnixStreamServer.__init__(self, path, _Handler)
+
+
+def serve(service_name, path, loader=client.Loaders.ENVIRONMENT, **kw):
+    """Runs a daemon until it is interrupted.
+
+    Args:
+      service_name (string): the name of the service
+      path (string): the path at which to listen
+      loader (:class:`client.Loaders`): loads the options of the client
+      **kw: the other keyword args supported by the constructor of
+        :class:`client.Client`
+
+    """
+    control_client = loader.load(service_name, **kw)
+    control_client.start()
+    server = Server(path, control_client)
+    _logger.info(u'serving %s at %s', service_name, path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        _logger.info(u'stopped serving %s at %s', service_name, path)
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+        control_client.stop()
@@ -12,10 +12,99 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Provides support for creating signatures using secure hashes."""
+"""Provides support for creating signatures using secure hashes.
+
+Signatures are the keys used to find requests and operations that can be
+aggregated, and are only compared within a process, so they need not be
+secure.  :func:`sign` obtains them using the current signer, a hash
+constructor like :func:`hashlib.md5`.  The default signer is the fast
+non-cryptographic :data:`XXH3_128` when the xxhash package is installed, and
+:data:`MD5` otherwise; :func:`set_signer` changes it.
+
+"""
 
 from __future__ import absolute_import
 
+import hashlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+MD5 = hashlib.md5
+"""Signs using md5."""
+
+XXH3_128 = None if xxhash is None else xxhash.xxh3_128
+"""Signs using the 128-bit xxh3 hash; ``None`` if xxhash is not installed."""
+
+DEFAULT_SIGNER = MD5 if XXH3_128 is None else XXH3_128
+
+
+def set_signer(signer=None):
+    """Sets the signer used by :func:`sign`.
+
+    Signatures obtained using different signers do not match, so this should
+    be called before any requests are aggregated.
+
+    Args:
+       signer (callable[[bytes], `Hash`]): a hash constructor, e.g
+         :data:`MD5`; if ``None``, :data:`DEFAULT_SIGNER` is used
+    """
+    global _signer, _empty_signature  # pylint: disable=global-statement
+    _signer = DEFAULT_SIGNER if signer is None else signer
+    _empty_signature = sign((u'',))
+
+
+def sign(parts):
+    """Obtains a signature for a sequence of strings.
+
+    The strings are joined with NUL separators and hashed in one pass, which
+    gives the same hash as adding them to it one at a time.
+
+    Args:
+       parts (iterable[string]): the strings to sign
+
+    Returns:
+       bytes: the signature
+    """
+    return _signer(u'\x00'.join(parts).encode('utf-8')).digest()
+
+
+def empty_signature():
+    """The signature of an empty string, e.g of a value with no labels."""
+    return _empty_signature
+
+
+def add_labels(parts, labels):
+    """Adds ``labels`` to ``parts``, sorted by key.
+
+    Args:
+       parts (list[string]): the strings to be signed
+       labels (dict[string, [string]]): the labels to add to them
+    """
+    if labels:
+        for k, v in sorted(labels.items()):
+            parts.append(k)
+            parts.append(v)
+
+
+def operation_parts(operation_name, consumer_id, labels):
+    """Obtains the strings to be signed for an operation.
+
+    Args:
+       operation_name (string): the operation name
+       consumer_id (string): the operation's consumer id
+       labels (dict[string, [string]]): the operation's labels
+
+    Returns:
+       list[string]: the strings to be signed, to which more may be added
+    """
+    parts = [operation_name, consumer_id]
+    add_labels(parts, labels)
+    return parts
+
 
 def add_dict_to_hash(a_hash, a_dict):
     """Adds `a_dict` to `a_hash`
@@ -25,7 +114,10 @@ def add_dict_to_hash(a_hash, a_dict):
        a_dict (dict[string, [string]]): the dictionary to add to the hash
 
     """
-    if a_dict is None:
+    if not a_dict:
         return
-    for k, v in list(a_dict.items()):
-        a_hash.update(b'\x00' + k.encode('utf-8') + b'\x00' + v.encode('utf-8'))
+    a_hash.update(u''.join(
+        u'\x00' + k + u'\x00' + v for k, v in a_dict.items()).encode('utf-8'))
+
+
+set_signer()
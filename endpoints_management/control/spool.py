@@ -0,0 +1,333 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""spool keeps report requests that could not be sent on disk.
+
+A :class:`Spool` is a directory of append-only segment files.  Each record in
+a segment is a serialized request, preceded by its size and checksum.
+Records are appended to the newest segment until it is full; the oldest
+segments are replayed first, and are evicted once the spool grows beyond its
+size limit.
+
+:class:`endpoints_management.control.client.Client` spools the report
+requests it fails to send, and replays them from a background thread.
+
+Example:
+
+  >>> from endpoints_management.control import client, spool
+  >>> report_spool = spool.Spool('/var/spool/endpoints/my-service')
+  >>> a_client = client.Loaders.DEFAULT.load('my-service-name',
+  ...                                        report_spool=report_spool)
+
+"""
+
+from __future__ import absolute_import
+
+from builtins import object
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+_logger = logging.getLogger(__name__)
+
+
+# payload size, crc32 of the payload
+_RECORD_HEADER = struct.Struct(u'>II')
+
+_SEGMENT_SUFFIX = u'.seg'
+
+# the sequence number of the oldest segment, and the offset of its first
+# record that is yet to be replayed
+_HEAD = struct.Struct(u'>QQ')
+_HEAD_NAME = u'head'
+
+
+class Spool(object):
+    """Holds serialized requests in segment files in a directory.
+
+    A directory should only be used by one spool at a time.  Segments left by
+    an earlier spool in the same directory are replayed from where it
+    stopped, and new records are never appended to them, so a record torn by
+    a crash only loses the records after it in its segment.
+
+    Thread safe.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+    """The default limit on the size of a spool."""
+
+    DEFAULT_SEGMENT_BYTES = 1024 * 1024
+    """The default size at which a new segment is started."""
+
+    DEFAULT_MAX_ATTEMPTS = 10
+    """The default number of times a record is replayed before it's dropped."""
+
+    def __init__(self,
+                 path,
+                 max_bytes=DEFAULT_MAX_BYTES,
+                 segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """Constructor.
+
+        Args:
+          path (string): the directory holding the segments; it is created if
+            it does not exist
+          max_bytes (int): the oldest segments are evicted once the spool is
+            larger than this
+          segment_bytes (int): a new segment is started once the newest is
+            larger than this
+          max_attempts (int): the number of times replaying a record may fail
+            before it is dropped
+
+        """
+        if segment_bytes <= 0:
+            raise ValueError(u'segment size should be > 0')
+        if max_attempts <= 0:
+            raise ValueError(u'number of attempts should be > 0')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._path = path
+        self._max_bytes = max_bytes
+        self._segment_bytes = segment_bytes
+        self._max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._segments = []  # [seq, size], oldest first
+        for name in sorted(os.listdir(path)):
+            seq = _segment_seq(name)
+            if seq is not None:
+                size = os.path.getsize(os.path.join(path, name))
+                self._segments.append([seq, size])
+        self._segments.sort()
+        self._next_seq = self._segments[-1][0] + 1 if self._segments else 0
+        self._active = None  # the file of the newest segment, if writable
+        self._head_offset = self._load_head_offset()
+        self._head_attempts = 0
+        self.appended = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.evicted_bytes = 0
+
+    @property
+    def size(self):
+        """The number of bytes in the spool's segments."""
+        with self._lock:
+            return sum(size for _, size in self._segments)
+
+    def append(self, payload):
+        """Adds a record to the spool.
+
+        Args:
+          payload (bytes): the record
+
+        Raises:
+          IOError: if the record could not be written
+
+        """
+        record = _RECORD_HEADER.pack(len(payload),
+                                     zlib.crc32(payload) & 0xffffffff)
+        record += payload
+        with self._lock:
+            if self._active is None:
+                self._start_segment()
+            self._active.write(record)
+            self._active.flush()
+            self._segments[-1][1] += len(record)
+            self.appended += 1
+            if self._segments[-1][1] >= self._segment_bytes:
+                self._seal()
+            self._evict()
+
+    def replay(self, send_func):
+        """Sends the spooled records, oldest first.
+
+        Records are removed once they are sent.  Replaying stops at the first
+        record that fails; it is retried by the next replay, unless it has
+        failed ``max_attempts`` times, in which case it is dropped.
+
+        Args:
+          send_func (function(bytes)): sends a record, raising an exception
+            if it fails
+
+        Returns:
+          bool: ``True`` if every record was sent or dropped, otherwise
+            ``False``
+
+        """
+        with self._replay_lock:
+            while True:
+                with self._lock:
+                    if not self._segments:
+                        return True
+                    if self._segments[0][1] == 0:
+                        self._remove_head()
+                        continue
+                    if len(self._segments) == 1:
+                        self._seal()
+                    seq = self._segments[0][0]
+                if not self._replay_segment(seq, send_func):
+                    return False
+
+    def close(self):
+        """Closes the newest segment; later records start a new one."""
+        with self._lock:
+            self._seal()
+
+    def _replay_segment(self, seq, send_func):
+        path = self._segment_path(seq)
+        try:
+            with open(path, u'rb') as f:
+                contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):  # missing, or empty
+            _logger.debug(u'could not map spool segment %s', path,
+                          exc_info=True)
+            contents = None
+        try:
+            for end, payload in _records(contents, self._head_offset, path):
+                try:
+                    send_func(payload)
+                    self.replayed += 1
+                except Exception:  # pylint: disable=broad-except
+                    self._head_attempts += 1
+                    if self._head_attempts < self._max_attempts:
+                        _logger.debug(u'failed to replay a spooled record',
+                                      exc_info=True)
+                        return False
+                    _logger.error(u'dropped a spooled record after %d attempts',
+                                  self._head_attempts, exc_info=True)
+                    self.dropped += 1
+                with self._lock:
+                    if not self._segments or self._segments[0][0] != seq:
+                        return True  # the segment was evicted
+                    self._head_offset = end
+                    self._head_attempts = 0
+                    self._save_head_offset(seq, end)
+        finally:
+            if contents is not None:
+                contents.close()
+        with self._lock:
+            if self._segments and self._segments[0][0] == seq:
+                self._remove_head()
+        return True
+
+    def _load_head_offset(self):
+        try:
+            with open(os.path.join(self._path, _HEAD_NAME), u'rb') as f:
+                seq, offset = _HEAD.unpack(f.read(_HEAD.size))
+        except (IOError, OSError, struct.error):
+            return 0
+        if self._segments and self._segments[0][0] == seq:
+            return offset
+        self._remove_head_offset()  # its segment is gone
+        return 0
+
+    def _save_head_offset(self, seq, offset):
+        # replaced atomically, so a crash leaves the old or the new offset
+        path = os.path.join(self._path, _HEAD_NAME)
+        try:
+            with open(path + u'.tmp', u'wb') as f:
+                f.write(_HEAD.pack(seq, offset))
+            os.replace(path + u'.tmp', path)
+        except (IOError, OSError):
+            _logger.warn(u'could not save the spool head offset; replayed '
+                         u'records may be sent again', exc_info=True)
+
+    def _remove_head_offset(self):
+        try:
+            os.remove(os.path.join(self._path, _HEAD_NAME))
+        except OSError:
+            pass  # there was no offset
+
+    def _segment_path(self, seq):
+        return os.path.join(self._path, u'%016d%s' % (seq, _SEGMENT_SUFFIX))
+
+    def _start_segment(self):
+        seq = self._next_seq
+        self._next_seq += 1
+        self._active = open(self._segment_path(seq), u'ab')
+        self._segments.append([seq, 0])
+
+    def _seal(self):
+        if self._active is None:
+            return
+        try:
+            os.fsync(self._active.fileno())
+        finally:
+            self._active.close()
+            self._active = None
+
+    def _remove_head(self):
+        seq, _ = self._segments.pop(0)
+        self._head_offset = 0
+        self._head_attempts = 0
+        if not self._segments:
+            self._seal()
+        # the offset goes first, so that it never applies to a later segment
+        # with the same sequence number
+        self._remove_head_offset()
+        try:
+            os.remove(self._segment_path(seq))
+        except OSError:
+            _logger.warn(u'could not remove spool segment %d', seq,
+                         exc_info=True)
+
+    def _evict(self):
+        total = sum(size for _, size in self._segments)
+        while total > self._max_bytes and len(self._segments) > 1:
+            size = self._segments[0][1]
+            _logger.warn(u'evicted %d bytes of spooled records: the spool is '
+                         u'over %d bytes', size, self._max_bytes)
+            self._remove_head()
+            self.evicted_bytes += size
+            total -= size
+
+
+def _segment_seq(name):
+    if not name.endswith(_SEGMENT_SUFFIX):
+        return None
+    try:
+        return int(name[:-len(_SEGMENT_SUFFIX)])
+    except ValueError:
+        return None
+
+
+def _records(contents, offset, path):
+    """Yields the records of a segment starting at ``offset``.
+
+    Yields:
+      tuple(int, bytes): the offset after each record, and its payload
+
+    """
+    if contents is None:
+        return
+    limit = len(contents)
+    while offset + _RECORD_HEADER.size <= limit:
+        size, crc = _RECORD_HEADER.unpack_from(contents, offset)
+        start = offset + _RECORD_HEADER.size
+        end = start + size
+        if end > limit:
+            _logger.warn(u'ignored a torn record at offset %d of %s',
+                         offset, path)
+            return
+        payload = contents[start:end]
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            _logger.warn(u'ignored a corrupt record at offset %d of %s',
+                         offset, path)
+            return
+        yield end, payload
+        offset = end
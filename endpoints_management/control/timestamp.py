@@ -18,7 +18,13 @@
 datetime types and the rfc3339 representation used in json messsages.
 
 :func:`compare` allows comparison of any timestamp representation, either the
-standard python datetime types, or an rfc3339 string representation
+standard python datetime types, ``Timestamp`` messages or an rfc3339 string
+representation
+
+:func:`to_timestamp_pb` converts standard python datetime types and seconds
+since the epoch to the ``Timestamp`` messages used in protobuf messages,
+without formatting them as strings.  :func:`stamp` does the same, but reuses
+the message made for the previous instant it was given
 
 """
 
@@ -27,13 +33,22 @@ from __future__ import absolute_import
 from past.builtins import basestring
 import datetime
 import logging
+import math
 
+from google.protobuf import timestamp_pb2
 import strict_rfc3339
 
 _logger = logging.getLogger(__name__)
 
 
 _EPOCH_START = datetime.datetime(1970, 1, 1)
+_NANOS_PER_SECOND = 1000000000
+_NANOS_PER_MICROSECOND = 1000
+_SECONDS_PER_DAY = 86400
+
+# the most recent input and result of stamp, shared by all its callers in a
+# process; it is replaced as a whole, so threads never see half of an update
+_last_stamp = (None, None)
 
 
 def compare(a, b):
@@ -41,11 +56,11 @@ def compare(a, b):
 
     ``a`` and ``b`` must be the same type, in addition to normal
     representations of timestamps that order naturally, they can be rfc3339
-    formatted strings.
+    formatted strings or ``Timestamp`` messages.
 
     Args:
-      a (string|object): a timestamp
-      b (string|object): another timestamp
+      a (string|Timestamp|object): a timestamp
+      b (string|Timestamp|object): another timestamp
 
     Returns:
       int: -1 if a < b, 0 if a == b or 1 if a > b
@@ -62,7 +77,10 @@ def compare(a, b):
                       a, b, type(a), type(b))
         raise ValueError(u'cannot compare inputs of differing types')
 
-    if a_is_text:
+    if isinstance(a, timestamp_pb2.Timestamp):
+        a = (a.seconds, a.nanos)
+        b = (b.seconds, b.nanos)
+    elif a_is_text:
         a = from_rfc3339(a, with_nanos=True)
         b = from_rfc3339(b, with_nanos=True)
 
@@ -106,6 +124,81 @@ def to_rfc3339(timestamp):
         timestamp.total_seconds())
 
 
+def to_timestamp_pb(timestamp):
+    """Converts ``timestamp`` to a ``Timestamp`` message.
+
+    ``timestamp`` can be a ``datetime.datetime`` or a ``datetime.timedelta``,
+    as with :func:`to_rfc3339`, or the number of seconds since the beginning
+    of the unix epoch.  Naive datetimes are assumed to be in UTC.
+
+    Args:
+      timestamp (datetime|timedelta|float): represents the timestamp to
+        convert
+
+    Returns:
+      :class:`google.protobuf.timestamp_pb2.Timestamp`: the converted timestamp
+
+    Raises:
+      ValueError: if timestamp is not a datetime.datetime, a
+        datetime.timedelta or a number
+
+    """
+    if isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool):
+        seconds = int(math.floor(timestamp))
+        nanos = int(round((timestamp - seconds) * _NANOS_PER_SECOND))
+        if nanos == _NANOS_PER_SECOND:
+            seconds, nanos = seconds + 1, 0
+        return timestamp_pb2.Timestamp(seconds=seconds, nanos=nanos)
+    if isinstance(timestamp, datetime.datetime):
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.replace(tzinfo=None) - timestamp.utcoffset()
+        timestamp = timestamp - _EPOCH_START
+    if not isinstance(timestamp, datetime.timedelta):
+        _logger.error(u'Could not convert %s to a Timestamp,', timestamp)
+        raise ValueError(u'Invalid timestamp type')
+    return timestamp_pb2.Timestamp(
+        seconds=timestamp.days * _SECONDS_PER_DAY + timestamp.seconds,
+        nanos=timestamp.microseconds * _NANOS_PER_MICROSECOND)
+
+
+def stamp(timestamp):
+    """Converts ``timestamp`` to a ``Timestamp`` message, like
+    :func:`to_timestamp_pb`.
+
+    Operations made at the same instant share a ``Timestamp``: if
+    ``timestamp`` is the same as on the previous call in this process, by
+    any caller, the message made then is returned again.  The result must be
+    copied rather than modified, as happens when it is assigned to a field of
+    another message.  :func:`reset_stamp` forgets the previous call.
+
+    Args:
+      timestamp (datetime|timedelta|float): represents the timestamp to
+        convert
+
+    Returns:
+      :class:`google.protobuf.timestamp_pb2.Timestamp`: the converted timestamp
+
+    Raises:
+      ValueError: if timestamp is not a datetime.datetime, a
+        datetime.timedelta or a number
+
+    """
+    global _last_stamp  # pylint: disable=global-statement
+    last_timestamp, last_pb = _last_stamp
+    if last_pb is not None and last_timestamp == timestamp and (
+            type(last_timestamp) is type(timestamp)):
+        return last_pb
+    result = to_timestamp_pb(timestamp)
+    _last_stamp = (timestamp, result)
+    return result
+
+
+def reset_stamp():
+    """Makes the next call to :func:`stamp` convert its timestamp afresh."""
+    global _last_stamp  # pylint: disable=global-statement
+    _last_stamp = (None, None)
+
+
 def from_rfc3339(rfc3339_text, with_nanos=False):
     """Parse a RFC 3339 date string format to datetime.date.
 
@@ -96,7 +96,10 @@ def running_on_devserver():
 
 
 def add_all(application, project_id, control_client,
-            loader=service.Loaders.FROM_SERVICE_MANAGEMENT):
+            loader=service.Loaders.FROM_SERVICE_MANAGEMENT,
+            stream_responses=False,
+            defer_reports=False,
+            latency_monitor=None):
     """Adds all endpoints middleware to a wsgi application.
 
     Sets up application to use all default endpoints middleware.
@@ -125,8 +128,17 @@ def add_all(application, project_id, control_client,
        control_client: the service control client instance
        loader (:class:`endpoints_management.control.service.Loader`): loads the service
           instance that configures this instance's behaviour
+       stream_responses (bool): if True, responses are streamed rather than
+          buffered before reporting; see :class:`Middleware`
+       defer_reports (bool): if True, report requests are built by the
+          control_client off the request thread; see :class:`Middleware`
+       latency_monitor (:class:`endpoints_management.control.latency.Monitor`):
+          if set, the latencies of each request are recorded on it
     """
-    return ConfigFetchWrapper(application, project_id, control_client, loader)
+    return ConfigFetchWrapper(application, project_id, control_client, loader,
+                              stream_responses=stream_responses,
+                              defer_reports=defer_reports,
+                              latency_monitor=latency_monitor)
 
 
 class ConfigFetchWrapper(object):
@@ -145,7 +157,10 @@ class ConfigFetchWrapper(object):
     """
     def __init__(self, application, project_id, control_client,
                  loader=service.Loaders.FROM_SERVICE_MANAGEMENT,
-                 disable_threading=False):
+                 disable_threading=False,
+                 stream_responses=False,
+                 defer_reports=False,
+                 latency_monitor=None):
         self.service_config = None
         self.background_thread = None
         self.threading_failed = disable_threading
@@ -156,6 +171,9 @@ class ConfigFetchWrapper(object):
         self.project_id = project_id
         self.control_client = control_client
         self.loader = loader
+        self.stream_responses = stream_responses
+        self.defer_reports = defer_reports
+        self.latency_monitor = latency_monitor
 
         self.try_loading()
         self.wrap_app()
@@ -174,7 +192,10 @@ class ConfigFetchWrapper(object):
             return
         authenticator = _create_authenticator(self.service_config)
 
-        wrapped_app = Middleware(self.application, self.project_id, self.control_client)
+        wrapped_app = Middleware(self.application, self.project_id, self.control_client,
+                                 stream_responses=self.stream_responses,
+                                 defer_reports=self.defer_reports,
+                                 latency_monitor=self.latency_monitor)
         if authenticator:
             wrapped_app = AuthenticationMiddleware(wrapped_app, authenticator)
         self.wsgi_backend = EnvironmentMiddleware(wrapped_app, self.service_config)
@@ -265,6 +286,7 @@ class EnvironmentMiddleware(object):
             logs=logs,
             metric_names=metric_names,
             label_names=label_names)
+        reporting_rules.compile()
 
         return registry, reporting_rules
 
@@ -316,7 +338,10 @@ class Middleware(object):
                  project_id,
                  control_client,
                  next_operation_id=_next_operation_uuid,
-                 timer=datetime.utcnow):
+                 timer=datetime.utcnow,
+                 stream_responses=False,
+                 defer_reports=False,
+                 latency_monitor=None):
         """Initializes a new Middleware instance.
 
         Args:
@@ -325,12 +350,23 @@ class Middleware(object):
            control_client: the service control client instance
            next_operation_id (func): produces the next operation
            timer (func[[datetime.datetime]]): a func that obtains the current time
+           stream_responses (bool): if True, the application's response is
+             passed through as it is produced and the report is sent once it
+             has been fully iterated or closed; otherwise it is buffered
+           defer_reports (bool): if True, report infos are handed to
+             ``control_client.report_info`` so that building the report
+             request can happen off the request thread
+           latency_monitor (:class:`endpoints_management.control.latency.Monitor`):
+             if set, the latencies of each request are recorded on it
            """
         self._application = application
         self._project_id = project_id
         self._control_client = control_client
         self._next_operation_id = next_operation_id
         self._timer = timer
+        self._stream_responses = stream_responses
+        self._defer_reports = defer_reports
+        self._latency_monitor = latency_monitor
 
     def __call__(self, environ, start_response):
         # pylint: disable=too-many-locals
@@ -367,21 +403,18 @@ class Middleware(object):
             _logger.debug(u"skipping %s, no api key was provided", parsed_uri)
             error_msg = self._handle_missing_api_key(app_info, start_response)
         else:
-            check_req = check_info.as_check_request()
-            _logger.debug(u'checking %s with %s', method_info, check_request)
-            check_resp = self._control_client.check(check_req)
+            # the client only makes a CheckRequest if it is not cached
+            _logger.debug(u'checking %s with %s', method_info, check_info)
+            check_resp = self._control_client.check(check_info)
             error_msg = self._handle_check_response(app_info, check_resp, start_response)
-            if (check_resp and check_resp.check_info and
-                    check_resp.check_info.consumerInfo):
-                consumer_project_number = (
-                    check_resp.check_info.consumerInfo.projectNumber)
+            consumer_project_number = _consumer_project_number(
+                check_resp, consumer_project_number)
             if error_msg is None:
                 quota_info = self._create_quota_info(method_info, parsed_uri, environ)
                 if not quota_info.quota_info:
                     _logger.debug(u'no metric costs for this method')
                 else:
-                    quota_request = quota_info.as_allocate_quota_request()
-                    quota_response = self._control_client.allocate_quota(quota_request)
+                    quota_response = self._control_client.allocate_quota(quota_info)
                     error_msg = self._handle_quota_response(
                         app_info, quota_response, start_response)
 
@@ -389,16 +422,31 @@ class Middleware(object):
             # send a report request that indicates that the request failed
             rules = environ.get(EnvironmentMiddleware.REPORTING_RULES)
             latency_timer.end()
-            report_req = self._create_report_request(method_info,
-                                                     check_info,
-                                                     app_info,
-                                                     latency_timer,
-                                                     rules,
-                                                     consumer_project_number)
-            _logger.debug(u'scheduling report_request %s', report_req)
-            self._control_client.report(report_req)
+            self._send_report(method_info,
+                              check_info,
+                              app_info,
+                              latency_timer,
+                              rules,
+                              consumer_project_number)
             return error_msg
 
+        return self._run_application(environ,
+                                     start_response,
+                                     method_info,
+                                     check_info,
+                                     app_info,
+                                     latency_timer,
+                                     consumer_project_number)
+
+    def _run_application(self,
+                         environ,
+                         start_response,
+                         method_info,
+                         check_info,
+                         app_info,
+                         latency_timer,
+                         consumer_project_number):
+        # pylint: disable=too-many-arguments
         # update the client with the response
         latency_timer.app_start()
 
@@ -413,22 +461,60 @@ class Middleware(object):
             return start_response(status, response_headers, exc_info)
 
         result = self._application(environ, inner_start_response)
+        rules = environ.get(EnvironmentMiddleware.REPORTING_RULES)
+
+        def send_report(response_size):
+            latency_timer.end()
+            app_info.response_size = response_size
+            self._send_report(method_info,
+                              check_info,
+                              app_info,
+                              latency_timer,
+                              rules,
+                              consumer_project_number)
+
+        if self._stream_responses:
+            return _ReportingIterable(result, send_report)
 
         # perform reporting, result must be joined otherwise the latency record
         # is incorrect
         result = b''.join(result)
-        latency_timer.end()
-        app_info.response_size = len(result)
-        rules = environ.get(EnvironmentMiddleware.REPORTING_RULES)
+        send_report(len(result))
+        return (result, )
+
+    def _send_report(self,
+                     method_info,
+                     check_info,
+                     app_info,
+                     latency_timer,
+                     reporting_rules,
+                     consumer_project_number):
+        self._record_latencies(method_info, latency_timer)
+        if self._defer_reports:
+            report_info = self._create_report_info(method_info,
+                                                   check_info,
+                                                   app_info,
+                                                   latency_timer,
+                                                   consumer_project_number)
+            _logger.debug(u'queueing report_info %s', report_info)
+            self._control_client.report_info(report_info, reporting_rules,
+                                             self._timer())
+            return
+
         report_req = self._create_report_request(method_info,
                                                  check_info,
                                                  app_info,
                                                  latency_timer,
-                                                 rules,
+                                                 reporting_rules,
                                                  consumer_project_number)
         _logger.debug(u'scheduling report_request %s', report_req)
         self._control_client.report(report_req)
-        return (result, )
+
+    def _record_latencies(self, method_info, latency_timer):
+        if self._latency_monitor is not None:
+            self._latency_monitor.record(method_info.selector,
+                                         latency_timer.request_time,
+                                         latency_timer.backend_time)
 
     def _create_report_request(self,
                                method_info,
@@ -437,9 +523,22 @@ class Middleware(object):
                                latency_timer,
                                reporting_rules,
                                consumer_project_number):
+        report_info = self._create_report_info(method_info,
+                                               check_info,
+                                               app_info,
+                                               latency_timer,
+                                               consumer_project_number)
+        return report_info.as_report_request(reporting_rules, timer=self._timer)
+
+    def _create_report_info(self,
+                            method_info,
+                            check_info,
+                            app_info,
+                            latency_timer,
+                            consumer_project_number):
         # TODO: determine how to obtain the consumer_project_id and the location
         # correctly
-        report_info = report_request.Info(
+        return report_request.Info(
             api_key=check_info.api_key,
             api_key_valid=app_info.api_key_valid,
             api_method=method_info.selector,
@@ -462,7 +561,6 @@ class Middleware(object):
             service_name=check_info.service_name,
             url=app_info.url
         )
-        return report_info.as_report_request(reporting_rules, timer=self._timer)
 
     def _get_api_key_info(self, method_info, parsed_uri, environ):
         api_key = _find_api_key_param(method_info, parsed_uri)
@@ -559,6 +657,13 @@ class Middleware(object):
         return resp({'REQUEST_METHOD': 'POST', 'HTTP_ACCEPT': 'application/json'}, start_response)
 
 
+def _consumer_project_number(check_resp, default):
+    if (check_resp and check_resp.check_info and
+            check_resp.check_info.consumerInfo):
+        return check_resp.check_info.consumerInfo.projectNumber
+    return default
+
+
 class _AppInfo(object):
     # pylint: disable=too-few-public-methods
 
@@ -571,6 +676,47 @@ class _AppInfo(object):
         self.url = None
 
 
+class _ReportingIterable(object):
+    """Passes through a wsgi response, counting the bytes that it yields.
+
+    ``on_done`` is invoked exactly once with the byte count, either when the
+    response is exhausted or when it is closed by the server.
+    """
+
+    def __init__(self, iterable, on_done):
+        self._iterable = iterable
+        self._iterator = iter(iterable)
+        self._on_done = on_done
+        self._size = 0
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self._iterator)
+        except StopIteration:
+            self._finish()
+            raise
+        self._size += len(chunk)
+        return chunk
+
+    def close(self):
+        try:
+            close = getattr(self._iterable, u'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._finish()
+
+    def _finish(self):
+        if self._done:
+            return
+        self._done = True
+        self._on_done(self._size)
+
+
 class _LatencyTimer(object):
 
     def __init__(self, timer):
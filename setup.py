@@ -43,6 +43,11 @@ install_requires = [
     'webob>=1.7.4',
 ]
 
+extras_require = {
+    # a faster signer for aggregation keys
+    'xxhash': ['xxhash>=3.0.0'],
+}
+
 tests_require = [
     "flask>=0.11.1",
     "httmock>=1.2",
@@ -73,6 +78,7 @@ setup(
         'Programming Language :: Python :: Implementation :: CPython',
     ],
     install_requires=install_requires,
+    extras_require=extras_require,
     setup_requires=["pytest_runner"],
     tests_require=tests_require,
     test_suite="tests"
@@ -0,0 +1,306 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import asyncio
+import unittest
+from expects import be_false, be_none, be_true, expect, equal
+from unittest import mock
+
+from google.cloud import servicecontrol as sc_messages
+
+from endpoints_management.auth import tokens
+from endpoints_management.control import asgi, async_client, latency, service
+
+
+_STREAMED_CHUNKS = (b'first chunk', b'second chunk', b'last chunk')
+
+
+class _StreamingAsgiApp(object):
+    def __init__(self):
+        self.scope = None
+
+    async def __call__(self, scope, receive, send):
+        self.scope = scope
+        await send({u'type': u'http.response.start', u'status': 200,
+                    u'headers': []})
+        for chunk in _STREAMED_CHUNKS[:-1]:
+            await send({u'type': u'http.response.body', u'body': chunk,
+                        u'more_body': True})
+        await send({u'type': u'http.response.body',
+                    u'body': _STREAMED_CHUNKS[-1]})
+
+
+def _make_scope(path=u'/any', method=u'GET', headers=(), query_string=b''):
+    return {
+        u'type': u'http',
+        u'method': method,
+        u'scheme': u'http',
+        u'path': path,
+        u'root_path': u'',
+        u'query_string': query_string,
+        u'headers': list(headers),
+        u'server': (u'localhost', 80),
+        u'client': (u'192.168.0.3', 1234),
+    }
+
+
+def _call(app, scope):
+    sent = []
+
+    async def receive():
+        return {u'type': u'http.request', u'body': b'', u'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    return sent
+
+
+def _make_control_client():
+    control_client = mock.MagicMock(spec=async_client.AsyncClient)
+    control_client.check.return_value = sc_messages.CheckResponse(
+        operation_id=u'fake_operation_id')
+    control_client.allocate_quota.return_value = sc_messages.AllocateQuotaResponse(
+        operation_id=u'fake_operation_id')
+    return control_client
+
+
+class TestEnvironmentMiddleware(unittest.TestCase):
+
+    def test_should_add_service_et_al_to_the_scope(self):
+        cls = asgi.EnvironmentMiddleware
+        wrappee = _StreamingAsgiApp()
+        wanted_service = service.Loaders.SIMPLE.load()
+        wrapped = cls(wrappee, wanted_service)
+
+        _call(wrapped, _make_scope())
+        given = wrappee.scope
+        expect(given.get(cls.SERVICE)).to(equal(wanted_service))
+        expect(given.get(cls.SERVICE_NAME)).to(equal(wanted_service.name))
+        expect(given.get(cls.METHOD_REGISTRY)).not_to(be_none)
+        expect(given.get(cls.REPORTING_RULES)).not_to(be_none)
+        expect(given.get(cls.METHOD_INFO)).not_to(be_none)
+
+    def test_should_handle_method_override(self):
+        cls = asgi.EnvironmentMiddleware
+        wrappee = _StreamingAsgiApp()
+        wrapped = cls(wrappee, service.Loaders.SIMPLE.load())
+
+        _call(wrapped, _make_scope(
+            method=u'POST',
+            headers=[(b'x-http-method-override', b'PATCH')]))
+        assert wrappee.scope[cls.METHOD_INFO].selector == 'allow-all.PATCH'
+
+    def test_should_pass_through_other_scopes(self):
+        wrappee = mock.AsyncMock()
+        wrapped = asgi.EnvironmentMiddleware(wrappee,
+                                             service.Loaders.SIMPLE.load())
+        scope = {u'type': u'lifespan'}
+        _call(wrapped, scope)
+        expect(wrappee.call_args[0][0]).to(equal(scope))
+
+
+class TestMiddleware(unittest.TestCase):
+    PROJECT_ID = u'middleware'
+
+    def test_should_not_send_requests_if_there_is_no_service(self):
+        control_client = _make_control_client()
+        wrapped = asgi.Middleware(_StreamingAsgiApp(), self.PROJECT_ID,
+                                  control_client)
+        _call(wrapped, _make_scope())
+        expect(control_client.check.called).to(be_false)
+        expect(control_client.report.called).to(be_false)
+        expect(control_client.allocate_quota.called).to(be_false)
+
+    def test_should_send_requests_using_the_client(self):
+        control_client = _make_control_client()
+        with_control = asgi.Middleware(_StreamingAsgiApp(), self.PROJECT_ID,
+                                       control_client)
+        wrapped = asgi.EnvironmentMiddleware(with_control,
+                                             service.Loaders.SIMPLE.load())
+        sent = _call(wrapped, _make_scope())
+        expect(control_client.check.await_count).to(equal(1))
+        expect(control_client.report.await_count).to(equal(1))
+        # no quota definitions in this service config
+        expect(control_client.allocate_quota.called).to(be_false)
+        body = b''.join(m.get(u'body', b'') for m in sent)
+        expect(body).to(equal(b''.join(_STREAMED_CHUNKS)))
+
+    def test_should_stream_the_response_before_reporting(self):
+        control_client = _make_control_client()
+        sent = []
+
+        async def report(dummy_req):
+            sent.append(u'report')
+
+        control_client.report.side_effect = report
+        with_control = asgi.Middleware(_StreamingAsgiApp(), self.PROJECT_ID,
+                                       control_client)
+        wrapped = asgi.EnvironmentMiddleware(with_control,
+                                             service.Loaders.SIMPLE.load())
+
+        async def receive():
+            return {u'type': u'http.request'}
+
+        async def send(message):
+            sent.append(message[u'type'])
+
+        asyncio.run(wrapped(_make_scope(), receive, send))
+        expect(sent).to(equal([u'http.response.start'] +
+                              [u'http.response.body'] * len(_STREAMED_CHUNKS) +
+                              [u'report']))
+        report_req = control_client.report.call_args[0][0]
+        expect(report_req).not_to(be_none)
+
+    def test_should_report_if_the_application_fails(self):
+        control_client = _make_control_client()
+        wrappee = mock.AsyncMock(side_effect=ValueError())
+        with_control = asgi.Middleware(wrappee, self.PROJECT_ID, control_client)
+        wrapped = asgi.EnvironmentMiddleware(with_control,
+                                             service.Loaders.SIMPLE.load())
+        with self.assertRaises(ValueError):
+            _call(wrapped, _make_scope())
+        expect(control_client.report.await_count).to(equal(1))
+
+    def test_should_send_report_request_if_check_fails(self):
+        control_client = _make_control_client()
+        control_client.check.return_value = sc_messages.CheckResponse(
+            operation_id=u'fake_operation_id',
+            check_errors=[
+                sc_messages.CheckError(
+                    code=sc_messages.CheckError.Code.PROJECT_DELETED)
+            ]
+        )
+        wrappee = mock.AsyncMock()
+        wrapped = asgi.add_all(wrappee,
+                               self.PROJECT_ID,
+                               control_client,
+                               loader=service.Loaders.SIMPLE)
+        sent = _call(wrapped, _make_scope())
+        expect(wrappee.called).to(be_false)
+        expect(control_client.check.called).to(be_true)
+        expect(control_client.report.called).to(be_true)
+        expect(control_client.allocate_quota.called).to(be_false)
+        expect(sent[0][u'status']).to(equal(403))
+
+    def test_should_record_latencies_on_the_latency_monitor(self):
+        monitor = latency.Monitor()
+        wrapped = asgi.add_all(_StreamingAsgiApp(),
+                               self.PROJECT_ID,
+                               _make_control_client(),
+                               loader=service.Loaders.SIMPLE,
+                               latency_monitor=monitor)
+        _call(wrapped, _make_scope())
+        _call(wrapped, _make_scope())
+        snapshot = monitor.snapshot()
+        expect(len(snapshot)).to(equal(1))
+        expect(list(snapshot.values())[0].total.count).to(equal(2))
+
+    def test_load_service_failed_retrying(self):
+        control_client = _make_control_client()
+        loader = mock.MagicMock()
+        # fail to load twice, then load
+        loader.load.side_effect = [None, None, service.Loaders.SIMPLE.load()]
+        # will consume first value
+        wrapped = asgi.ConfigFetchWrapper(_StreamingAsgiApp(), self.PROJECT_ID,
+                                          control_client, loader=loader)
+
+        async def make_requests():
+            statuses = []
+            for _ in range(3):
+                sent = []
+
+                async def send(message):
+                    sent.append(message)
+
+                await wrapped(_make_scope(), None, send)
+                statuses.append(sent[0][u'status'])
+                pending = wrapped._pending_load
+                if pending is not None:
+                    await pending
+            return statuses
+
+        # the first two requests start loads, the last loaded config is used
+        expect(asyncio.run(make_requests())).to(equal([503, 503, 200]))
+
+
+class TestAuthenticationMiddleware(unittest.TestCase):
+
+    def setUp(self):
+        self._mock_application = _StreamingAsgiApp()
+        self._mock_authenticator = mock.MagicMock(spec=tokens.Authenticator)
+        self._middleware = asgi.AuthenticationMiddleware(
+            self._mock_application, self._mock_authenticator)
+
+    def test_no_authentication(self):
+        with self.assertRaisesRegex(ValueError, u"Invalid authenticator"):
+            asgi.AuthenticationMiddleware(self._mock_application, None)
+
+    def test_no_method_info(self):
+        _call(self._middleware, _make_scope())
+        expect(self._mock_authenticator.authenticate.called).to(be_false)
+        expect(asgi.AuthenticationMiddleware.USER_INFO in
+               self._mock_application.scope).to(be_false)
+
+    def test_successful_authentication(self):
+        auth_info = mock.MagicMock()
+        service_name = u"test-service-name"
+        method_info = mock.MagicMock()
+        method_info.auth_info = auth_info
+        scope = _make_scope(
+            headers=[(b'authorization', b'Bearer test-bearer-token')])
+        scope[asgi.EnvironmentMiddleware.METHOD_INFO] = method_info
+        scope[asgi.EnvironmentMiddleware.SERVICE_NAME] = service_name
+
+        user_info = mock.MagicMock()
+        self._mock_authenticator.authenticate.return_value = user_info
+        _call(self._middleware, scope)
+        expect(self._mock_application.scope.get(
+            asgi.AuthenticationMiddleware.USER_INFO)).to(equal(user_info))
+        self._mock_authenticator.authenticate.assert_called_once_with(
+            u"test-bearer-token", auth_info, service_name)
+
+    def test_auth_token_in_query(self):
+        method_info = mock.MagicMock()
+        scope = _make_scope(query_string=b'access_token=test-bearer-token')
+        scope[asgi.EnvironmentMiddleware.METHOD_INFO] = method_info
+        scope[asgi.EnvironmentMiddleware.SERVICE_NAME] = u"test-service-name"
+
+        self._mock_authenticator.authenticate.side_effect = ValueError()
+        _call(self._middleware, scope)
+        expect(self._mock_application.scope.get(
+            asgi.AuthenticationMiddleware.USER_INFO)).to(be_none)
+        self._mock_authenticator.authenticate.assert_called_once_with(
+            u"test-bearer-token", method_info.auth_info, u"test-service-name")
+
+
+class TestEnvironFromScope(unittest.TestCase):
+
+    def test_should_convert_headers_like_a_wsgi_server(self):
+        environ = asgi._environ_from_scope(_make_scope(
+            path=u'/café',
+            query_string=b'key=abc',
+            headers=[(b'content-length', b'12'),
+                     (b'x-api-key', b'a'),
+                     (b'x-api-key', b'b'),
+                     (b'referer', b'example.com')]))
+        expect(environ[u'CONTENT_LENGTH']).to(equal(u'12'))
+        expect(environ[u'HTTP_X_API_KEY']).to(equal(u'a,b'))
+        expect(environ[u'HTTP_REFERER']).to(equal(u'example.com'))
+        expect(environ[u'QUERY_STRING']).to(equal(u'key=abc'))
+        expect(environ[u'PATH_INFO']).to(equal(u'/cafÃ©'))
+        expect(environ[u'REMOTE_ADDR']).to(equal(u'192.168.0.3'))
@@ -0,0 +1,281 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import asyncio
+import datetime
+import unittest
+from unittest import mock
+
+from apitools.base.py import exceptions
+from expects import be_false, be_none, be_true, equal, expect
+
+from google.cloud import servicecontrol as sc_messages
+
+from endpoints_management.control import (
+    async_client, caches, check_request, client, quota_request, report_request
+)
+
+
+def _make_dummy_report_request(project_id, service_name):
+    rules = report_request.ReportingRules()
+    info = report_request.Info(
+        consumer_project_id=project_id,
+        operation_id=u'an_op_id',
+        operation_name=u'an_op_name',
+        method=u'GET',
+        referer=u'a_referer',
+        service_name=service_name)
+    return info.as_report_request(rules)
+
+
+def _make_dummy_quota_request(project_id, service_name):
+    info = quota_request.Info(
+        consumer_project_id=project_id,
+        operation_id=u'an_op_id',
+        operation_name=u'an_op_name',
+        referer=u'a_referer',
+        service_name=service_name,
+        quota_info={'foo': 1, 'bar': 2})
+    return info.as_allocate_quota_request()
+
+
+def _make_dummy_check_request(project_id, service_name):
+    info = check_request.Info(
+        consumer_project_id=project_id,
+        operation_id=u'an_op_id',
+        operation_name=u'an_op_name',
+        referer=u'a_referer',
+        service_name=service_name)
+    return info.as_check_request()
+
+
+def _make_mock_transport():
+    transport = mock.MagicMock()
+    transport.services.Check = mock.AsyncMock()
+    transport.services.AllocateQuota = mock.AsyncMock()
+    transport.services.Report = mock.AsyncMock()
+    return transport
+
+
+class TestAsyncClientStartAndStop(unittest.IsolatedAsyncioTestCase):
+    SERVICE_NAME = u'start-and-stop'
+    PROJECT_ID = SERVICE_NAME + u'.project'
+
+    def setUp(self):
+        self._mock_transport = _make_mock_transport()
+        self._subject = async_client.load(
+            self.SERVICE_NAME,
+            create_transport=lambda: self._mock_transport)
+
+    async def asyncTearDown(self):
+        await self._subject.stop()
+
+    async def test_should_create_flush_tasks_when_started(self):
+        self._subject.start()
+        expect(len(self._subject._flush_tasks)).to(equal(3))
+
+    async def test_should_only_create_flush_tasks_on_first_start(self):
+        self._subject.start()
+        self._subject.start()
+        expect(len(self._subject._flush_tasks)).to(equal(3))
+
+    async def test_should_not_create_flush_tasks_for_disabled_caches(self):
+        self._subject = async_client.AsyncClient(
+            self.SERVICE_NAME,
+            caches.CheckOptions(num_entries=-1),
+            caches.QuotaOptions(num_entries=-1),
+            caches.ReportOptions(num_entries=-1),
+            create_transport=lambda: self._mock_transport)
+        self._subject.start()
+        expect(self._subject._flush_tasks).to(equal([]))
+
+    async def test_should_noop_stop_if_not_started(self):
+        await self._subject.stop()
+        expect(self._mock_transport.services.Report.called).to(be_false)
+
+    async def test_should_cancel_flush_tasks_on_stop(self):
+        self._subject.start()
+        tasks = list(self._subject._flush_tasks)
+        await self._subject.stop()
+        for task in tasks:
+            expect(task.cancelled()).to(be_true)
+
+    async def test_should_send_aggregated_reports_on_stop(self):
+        await self._subject.report(
+            _make_dummy_report_request(self.PROJECT_ID, self.SERVICE_NAME))
+        expect(self._mock_transport.services.Report.called).to(be_false)
+        await self._subject.stop()
+        expect(self._mock_transport.services.Report.called).to(be_true)
+        sent = self._mock_transport.services.Report.call_args[0][0]
+        expect(isinstance(sent, sc_messages.ReportRequest)).to(be_true)
+
+
+class TestAsyncClientCheck(unittest.IsolatedAsyncioTestCase):
+    SERVICE_NAME = u'check'
+    PROJECT_ID = SERVICE_NAME + u'.project'
+
+    def setUp(self):
+        self._mock_transport = _make_mock_transport()
+        self._subject = async_client.load(
+            self.SERVICE_NAME,
+            create_transport=lambda: self._mock_transport)
+
+    async def asyncTearDown(self):
+        await self._subject.stop()
+
+    async def test_should_start_itself_on_check_without_start(self):
+        dummy_request = _make_dummy_check_request(self.PROJECT_ID,
+                                                  self.SERVICE_NAME)
+        await self._subject.check(dummy_request)
+        assert self._subject._running
+
+    async def test_should_send_the_request_if_not_cached(self):
+        dummy_request = _make_dummy_check_request(self.PROJECT_ID,
+                                                  self.SERVICE_NAME)
+        await self._subject.check(dummy_request)
+        self._mock_transport.services.Check.assert_awaited_once_with(
+            dummy_request)
+
+    async def test_should_not_send_the_request_if_cached(self):
+        t = self._mock_transport
+        dummy_request = _make_dummy_check_request(self.PROJECT_ID,
+                                                  self.SERVICE_NAME)
+        dummy_response = sc_messages.CheckResponse(
+            operation_id=dummy_request.operation.operation_id)
+        t.services.Check.return_value = dummy_response
+        expect(await self._subject.check(dummy_request)).to(equal(dummy_response))
+        t.services.Check.reset_mock()
+        expect(await self._subject.check(dummy_request)).to(equal(dummy_response))
+        expect(t.services.Check.called).to(be_false)
+
+    async def test_should_return_null_if_transport_fails(self):
+        dummy_request = _make_dummy_check_request(self.PROJECT_ID,
+                                                  self.SERVICE_NAME)
+        self._mock_transport.services.Check.side_effect = exceptions.Error()
+        expect(await self._subject.check(dummy_request)).to(be_none)
+
+
+class TestAsyncClientQuota(unittest.IsolatedAsyncioTestCase):
+    SERVICE_NAME = u'quota'
+    PROJECT_ID = SERVICE_NAME + u'.project'
+
+    def setUp(self):
+        self._mock_transport = _make_mock_transport()
+        self._subject = async_client.load(
+            self.SERVICE_NAME,
+            create_transport=lambda: self._mock_transport)
+
+    async def asyncTearDown(self):
+        await self._subject.stop()
+
+    async def test_should_queue_the_request_if_not_cached(self):
+        dummy_request = _make_dummy_quota_request(self.PROJECT_ID,
+                                                  self.SERVICE_NAME)
+        resp = await self._subject.allocate_quota(dummy_request)
+        with self._subject._quota_aggregator._out as out_deque:
+            expect(out_deque[0]).to(equal(dummy_request))
+        expect(resp.operation_id).to(equal(
+            dummy_request.allocate_operation.operation_id))
+        expect(self._mock_transport.services.AllocateQuota.called).to(be_false)
+
+    async def test_should_send_queued_requests_when_flushed(self):
+        dummy_request = _make_dummy_quota_request(self.PROJECT_ID,
+                                                  self.SERVICE_NAME)
+        await self._subject.allocate_quota(dummy_request)
+        await self._subject._flush_quota_aggregator()
+        self._mock_transport.services.AllocateQuota.assert_awaited_once_with(
+            dummy_request)
+
+    async def test_should_return_dummy_response_if_transport_fails(self):
+        self._subject = async_client.AsyncClient(
+            self.SERVICE_NAME,
+            caches.CheckOptions(),
+            caches.QuotaOptions(num_entries=-1),
+            caches.ReportOptions(),
+            create_transport=lambda: self._mock_transport)
+        dummy_request = _make_dummy_quota_request(self.PROJECT_ID,
+                                                  self.SERVICE_NAME)
+        self._mock_transport.services.AllocateQuota.side_effect = exceptions.Error()
+        resp = await self._subject.allocate_quota(dummy_request)
+        expect(resp).to(equal(sc_messages.AllocateQuotaResponse()))
+
+
+class TestAsyncClientReport(unittest.IsolatedAsyncioTestCase):
+    SERVICE_NAME = u'report'
+    PROJECT_ID = SERVICE_NAME + u'.project'
+
+    def setUp(self):
+        self._mock_transport = _make_mock_transport()
+        self._subject = async_client.load(
+            self.SERVICE_NAME,
+            create_transport=lambda: self._mock_transport)
+
+    async def asyncTearDown(self):
+        await self._subject.stop()
+
+    async def test_should_not_send_the_request_if_cached(self):
+        await self._subject.report(
+            _make_dummy_report_request(self.PROJECT_ID, self.SERVICE_NAME))
+        expect(self._mock_transport.services.Report.called).to(be_false)
+
+    async def test_should_send_the_request_if_caching_is_disabled(self):
+        self._subject = async_client.AsyncClient(
+            self.SERVICE_NAME,
+            caches.CheckOptions(),
+            caches.QuotaOptions(),
+            caches.ReportOptions(num_entries=-1),
+            create_transport=lambda: self._mock_transport)
+        dummy_request = _make_dummy_report_request(self.PROJECT_ID,
+                                                   self.SERVICE_NAME)
+        await self._subject.report(dummy_request)
+        self._mock_transport.services.Report.assert_awaited_once_with(
+            dummy_request)
+
+    async def test_should_ignore_transport_failures(self):
+        self._subject = async_client.AsyncClient(
+            self.SERVICE_NAME,
+            caches.CheckOptions(),
+            caches.QuotaOptions(),
+            caches.ReportOptions(num_entries=-1),
+            create_transport=lambda: self._mock_transport)
+        self._mock_transport.services.Report.side_effect = exceptions.Error()
+        await self._subject.report(
+            _make_dummy_report_request(self.PROJECT_ID, self.SERVICE_NAME))
+
+    async def test_should_flush_reports_from_the_flush_task(self):
+        self._subject = async_client.AsyncClient(
+            self.SERVICE_NAME,
+            caches.CheckOptions(num_entries=-1),
+            caches.QuotaOptions(num_entries=-1),
+            caches.ReportOptions(
+                flush_interval=datetime.timedelta(milliseconds=1)),
+            create_transport=lambda: self._mock_transport)
+        await self._subject.report(
+            _make_dummy_report_request(self.PROJECT_ID, self.SERVICE_NAME))
+        await asyncio.sleep(0.05)
+        expect(self._mock_transport.services.Report.called).to(be_true)
+
+
+class TestLoad(unittest.TestCase):
+
+    def test_should_use_the_loader_options(self):
+        loader = mock.MagicMock(spec=client.Loaders.DEFAULT)
+        loader.load_options.return_value = (caches.CheckOptions(),
+                                            caches.QuotaOptions(),
+                                            caches.ReportOptions())
+        subject = async_client.load(u'loaded', loader)
+        expect(isinstance(subject, async_client.AsyncClient)).to(be_true)
+        loader.load_options.assert_called_once_with()
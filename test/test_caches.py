@@ -16,9 +16,14 @@ from __future__ import absolute_import
 
 import collections
 import datetime
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
-from expects import be, be_a, be_none, equal, expect, raise_error
+from expects import (be, be_a, be_false, be_none, be_true, equal, expect,
+                     raise_error)
 
 from endpoints_management.control import caches, report_request
 
@@ -57,6 +62,14 @@ class TestDequeOutLRUCache(unittest.TestCase):
         expect(cache.get(2)).to(be_none)
         expect(len(cache.out_deque)).to(be(2))
 
+    def test_should_add_deleted_items_to_the_deque(self):
+        cache = caches.DequeOutLRUCache(_TEST_NUM_ENTRIES)
+        cache[1] = u'one'
+        cache[2] = u'two'
+        del cache[1]
+        expect(cache.pop(2)).to(equal(u'two'))
+        expect(list(cache.out_deque)).to(equal([u'one', u'two']))
+
 
 class _Timer(object):
     def __init__(self, auto=False):
@@ -137,6 +150,45 @@ class TestDequeOutTTLCache(unittest.TestCase):
         expect(cache[2]).to(equal(2))
         expect(cache.get(1)).to(be_none)
 
+    def test_should_add_expired_items_to_the_deque(self):
+        cache = caches.DequeOutTTLCache(_TEST_NUM_ENTRIES, ttl=2, timer=_Timer())
+        cache[1] = 1
+        cache.timer.tick()
+        cache[2] = 2
+        expect(len(cache.out_deque)).to(equal(0))
+        cache.timer.tick()
+        expect(list(cache.out_deque)).to(equal([1]))
+        cache.timer.tick()
+        expect(list(cache.out_deque)).to(equal([1, 2]))
+
+    def test_should_order_expiry_by_the_last_update(self):
+        cache = caches.DequeOutTTLCache(_TEST_NUM_ENTRIES, ttl=2, timer=_Timer())
+        cache[1] = 1
+        cache[2] = 2
+        cache.timer.tick()
+        cache[1] = u'updated'
+        cache.timer.tick()
+        expect(list(cache.out_deque)).to(equal([2]))
+        cache.timer.tick()
+        expect(list(cache.out_deque)).to(equal([2, u'updated']))
+
+    def test_should_add_items_replaced_after_expiry_to_the_deque(self):
+        cache = caches.DequeOutTTLCache(_TEST_NUM_ENTRIES, ttl=1, timer=_Timer())
+        cache[1] = u'first'
+        cache.timer.tick()
+        cache[1] = u'second'
+        expect(list(cache.out_deque)).to(equal([u'first']))
+        expect(cache[1]).to(equal(u'second'))
+
+    def test_should_add_deleted_items_to_the_deque(self):
+        cache = caches.DequeOutTTLCache(_TEST_NUM_ENTRIES, ttl=2, timer=_Timer())
+        cache[1] = 1
+        del cache[1]
+        expect(list(cache.out_deque)).to(equal([1]))
+        cache.timer.tick()
+        cache.timer.tick()
+        expect(list(cache.out_deque)).to(equal([1]))  # not added again
+
 
 class _DateTimeTimer(object):
     def __init__(self, auto=False):
@@ -221,6 +273,135 @@ class TestCreate(unittest.TestCase):
             with sync_cache as cache:
                 expect(cache).to(be_a(caches.DequeOutLRUCache))
 
+    def test_should_return_a_sharded_cache_if_there_are_many_shards(self):
+        sharded = caches.create(
+            caches.ReportOptions(num_entries=10, num_shards=4))
+        expect(sharded).to(be_a(caches.ShardedCache))
+        expect(len(sharded.shards)).to(equal(4))
+        for shard in sharded.shards:
+            expect(shard).to(be_a(caches.LockedObject))
+            with shard as cache:
+                expect(cache).to(be_a(caches.DequeOutTTLCache))
+                expect(cache.maxsize).to(equal(3))
+
+    def test_should_not_create_more_shards_than_entries(self):
+        sharded = caches.create(
+            caches.CheckOptions(num_entries=2, num_shards=4))
+        expect(len(sharded.shards)).to(equal(2))
+
+
+class TestShardedCache(unittest.TestCase):
+
+    def setUp(self):
+        self._subject = caches.create(
+            caches.ReportOptions(num_entries=100, num_shards=4))
+
+    def test_should_choose_shards_by_key_prefix(self):
+        shards = self._subject.shards
+        expect(self._subject.shard(b'\x00\x00\x00\x00rest')).to(be(shards[0]))
+        expect(self._subject.shard(b'\x00\x00\x00\x03rest')).to(be(shards[3]))
+        expect(self._subject.shard(b'\x00\x00\x00\x05rest')).to(be(shards[1]))
+
+    def test_should_always_choose_the_same_shard_for_a_key(self):
+        a_key = b'an arbitrary signature'
+        expect(self._subject.shard(a_key)).to(be(self._subject.shard(a_key)))
+
+    def test_locked_object_should_be_its_own_shard(self):
+        locked = caches.LockedObject({})
+        expect(locked.shard(b'any key')).to(be(locked))
+        expect(locked.shards).to(equal((locked,)))
+
+
+class TestSharedMemoryCache(unittest.TestCase):
+    A_KEY = b'\x00\x00\x00\x00\x00\x00\x00\x01rest'
+    A_COLLIDING_KEY = b'\x00\x00\x00\x00\x00\x00\x00\x09rest'
+    TTL = datetime.timedelta(seconds=2)
+
+    def setUp(self):
+        self.timer = _DateTimeTimer()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, u'shared')
+        self._subject = self._open()
+
+    def tearDown(self):
+        self._subject.close()
+        shutil.rmtree(self.dir)
+
+    def _open(self, num_slots=8):
+        return caches.SharedMemoryCache(self.path, num_slots, self.TTL,
+                                        value_size=16, timer=self.timer)
+
+    def test_should_return_stored_values_and_their_times(self):
+        expect(self._subject.get(self.A_KEY)).to(be_none)
+        expect(self._subject.set(self.A_KEY, b'a value')).to(be_true)
+        expect(self._subject.get(self.A_KEY)).to(
+            equal((b'a value', self.timer.time)))
+
+    def test_should_share_values_with_other_instances(self):
+        other = self._open()
+        try:
+            self._subject.set(self.A_KEY, b'a value')
+            expect(other.get(self.A_KEY)).to(equal((b'a value',
+                                                     self.timer.time)))
+        finally:
+            other.close()
+
+    def test_should_reset_files_with_another_layout(self):
+        self._subject.set(self.A_KEY, b'a value')
+        other = self._open(num_slots=4)
+        try:
+            expect(other.get(self.A_KEY)).to(be_none)
+        finally:
+            other.close()
+
+    def test_should_expire_values(self):
+        self._subject.set(self.A_KEY, b'a value')
+        self.timer.tick()
+        expect(self._subject.get(self.A_KEY)).not_to(be_none)
+        self.timer.tick()
+        expect(self._subject.get(self.A_KEY)).to(be_none)
+
+    def test_should_replace_values_in_the_same_slot(self):
+        self._subject.set(self.A_KEY, b'a value')
+        self._subject.set(self.A_COLLIDING_KEY, b'another value')
+        expect(self._subject.get(self.A_KEY)).to(be_none)
+        expect(self._subject.get(self.A_COLLIDING_KEY)).not_to(be_none)
+
+    def test_should_not_store_values_that_are_too_large(self):
+        expect(self._subject.set(self.A_KEY, b'x' * 17)).to(be_false)
+        expect(self._subject.get(self.A_KEY)).to(be_none)
+
+    def test_should_fail_on_keys_that_are_not_bytes(self):
+        testf = lambda: self._subject.get(u'a key')
+        expect(testf).to(raise_error(ValueError))
+
+    @unittest.skipUnless(hasattr(os, u'fork'), u'needs os.fork')
+    def test_should_keep_writers_in_forked_processes_apart(self):
+        with self._subject._write_lock():
+            pid = os.fork()
+            if pid == 0:  # the child writes once the parent releases its lock
+                try:
+                    self._subject.set(self.A_KEY, b'from a child')
+                finally:
+                    os._exit(0)
+            time.sleep(0.2)
+            expect(os.waitpid(pid, os.WNOHANG)).to(equal((0, 0)))
+        _, status = os.waitpid(pid, 0)
+        expect(status).to(equal(0))
+        expect(self._subject.get(self.A_KEY)).to(
+            equal((b'from a child', self.timer.time)))
+
+    def test_should_be_created_from_options_with_a_path(self):
+        expect(caches.create_shared(caches.CheckOptions())).to(be_none)
+        expect(caches.create_shared(caches.CheckOptions(
+            num_entries=0, shared_cache_path=self.path))).to(be_none)
+        shared = caches.create_shared(caches.QuotaOptions(
+            shared_cache_path=self.path))
+        try:
+            expect(shared).to(be_a(caches.SharedMemoryCache))
+        finally:
+            shared.close()
+
 
 class TestReportOptions(unittest.TestCase):
 
@@ -231,6 +412,10 @@ class TestReportOptions(unittest.TestCase):
         expect(options.flush_interval).to(equal(
             caches.ReportOptions.DEFAULT_FLUSH_INTERVAL))
 
+    def test_should_fail_if_max_pending_is_less_than_one(self):
+        testf = lambda: caches.ReportOptions(max_pending=0)
+        expect(testf).to(raise_error(AssertionError))
+
 
 class TestCheckOptions(unittest.TestCase):
     AN_INTERVAL = datetime.timedelta(milliseconds=2)
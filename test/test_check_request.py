@@ -16,12 +16,15 @@ from __future__ import absolute_import
 
 import http.client as httplib
 import datetime
+import os
+import shutil
+import tempfile
 import unittest
 from operator import attrgetter
-from expects import be_none, equal, expect, raise_error
+from unittest import mock
+from expects import be_false, be_none, equal, expect, raise_error
 
 from google.cloud import servicecontrol as sc_messages
-from google.protobuf import timestamp_pb2
 
 from endpoints_management.control import caches, label_descriptor, timestamp
 from endpoints_management.control import (check_request, metric_value)
@@ -181,6 +184,32 @@ class TestCachingAggregator(unittest.TestCase):
         agg.add_response(req, fake_response)
         expect(agg.check(req)).to(equal(fake_response))
 
+    def test_should_cache_responses_for_infos_without_making_requests(self):
+        info = _make_test_info(self.SERVICE_NAME)
+        fake_response = sc_messages.CheckResponse(
+            operation_id=self.FAKE_OPERATION_ID)
+        agg = self.agg
+        expect(agg.check(info)).to(be_none)
+        agg.add_response(info.as_check_request(), fake_response)
+        with mock.patch.object(check_request.Info,
+                               u'as_check_request') as as_check_request:
+            expect(agg.check(info)).to(equal(fake_response))
+            expect(agg.check(info)).to(equal(fake_response))
+            expect(as_check_request.called).to(be_false)
+
+    def test_should_flush_operations_aggregated_from_infos(self):
+        info = _make_test_info(self.SERVICE_NAME)
+        agg = self.agg
+        agg.add_response(info.as_check_request(), sc_messages.CheckResponse(
+            operation_id=self.FAKE_OPERATION_ID))
+        expect(agg.check(info)).not_to(be_none)
+        self.timer.tick()
+        self.timer.tick()  # now expired
+        flushed_reqs = agg.flush()
+        expect(len(flushed_reqs)).to(equal(1))
+        expect(flushed_reqs[0].operation.consumer_id).to(
+            equal(info.consumer_id))
+
     def test_should_not_cache_requests_with_important_operations(self):
         req = _make_test_request(
             self.SERVICE_NAME,
@@ -316,6 +345,162 @@ class TestCachingAggregator(unittest.TestCase):
         expect(len(agg.flush())).to(equal(0))
 
 
+class TestStaleWhileRevalidateAggregator(unittest.TestCase):
+    SERVICE_NAME = u'service.with_stale_cache'
+    FAKE_OPERATION_ID = u'service.with_stale_cache.op_id'
+
+    def setUp(self):
+        self.timer = _DateTimeTimer()
+        self.flush_interval = datetime.timedelta(seconds=1)
+        options = caches.CheckOptions(
+            flush_interval=self.flush_interval,
+            expiration=datetime.timedelta(seconds=4),
+            max_staleness=datetime.timedelta(seconds=2))
+        self.agg = check_request.Aggregator(
+            self.SERVICE_NAME, options, timer=self.timer)
+
+    def test_should_have_flush_interval_as_flush_interval(self):
+        expect(self.agg.flush_interval).to(equal(self.flush_interval))
+
+    def test_should_serve_stale_responses_while_refreshing(self):
+        req = _make_test_request(self.SERVICE_NAME)
+        fake_response = sc_messages.CheckResponse(
+            operation_id=self.FAKE_OPERATION_ID)
+        refreshed_response = sc_messages.CheckResponse(
+            operation_id=self.FAKE_OPERATION_ID + u'.refreshed')
+        agg = self.agg
+        expect(agg.check(req)).to(be_none)
+        agg.add_response(req, fake_response)
+        expect(len(agg.flush())).to(equal(0))  # nothing is stale yet
+
+        self.timer.tick()  # now past the flush_interval
+        expect(agg.check(req)).to(equal(fake_response))
+        expect(agg.check(req)).to(equal(fake_response))
+        flushed = agg.flush()
+        expect(len(flushed)).to(equal(1))  # only one refresh is sent
+        expect(len(agg.flush())).to(equal(0))
+
+        agg.add_response(flushed[0], refreshed_response)
+        expect(agg.check(req)).to(equal(refreshed_response))
+
+    def test_should_not_serve_responses_staler_than_max_staleness(self):
+        req = _make_test_request(self.SERVICE_NAME)
+        fake_response = sc_messages.CheckResponse(
+            operation_id=self.FAKE_OPERATION_ID)
+        agg = self.agg
+        expect(agg.check(req)).to(be_none)
+        agg.add_response(req, fake_response)
+
+        self.timer.tick()  # now past the flush_interval
+        expect(agg.check(req)).to(equal(fake_response))
+        self.timer.tick()
+        expect(agg.check(req)).to(equal(fake_response))
+        self.timer.tick()  # now past the max_staleness, without a refresh
+        expect(agg.check(req)).to(be_none)  # none signals the resend
+
+    def test_should_not_serve_stale_responses_with_errors(self):
+        req = _make_test_request(self.SERVICE_NAME)
+        fake_response = sc_messages.CheckResponse(
+            operation_id=self.FAKE_OPERATION_ID, check_errors=[
+                sc_messages.CheckError(
+                    code=sc_messages.CheckError.Code.NOT_FOUND)
+            ])
+        agg = self.agg
+        expect(agg.check(req)).to(be_none)
+        agg.add_response(req, fake_response)
+        self.timer.tick()  # now past the flush_interval
+        expect(agg.check(req)).to(be_none)
+
+    def test_should_clear_stale_requests(self):
+        req = _make_test_request(self.SERVICE_NAME)
+        agg = self.agg
+        expect(agg.check(req)).to(be_none)
+        agg.add_response(req, sc_messages.CheckResponse(
+            operation_id=self.FAKE_OPERATION_ID))
+        self.timer.tick()  # now past the flush_interval
+        agg.check(req)
+        agg.clear()
+        expect(len(agg.flush())).to(equal(0))
+
+
+class TestShardedCachingAggregator(TestCachingAggregator):
+    SERVICE_NAME = u'service.with_sharded_cache'
+    FAKE_OPERATION_ID = u'service.with_sharded_cache.op_id'
+
+    def setUp(self):
+        self.timer = _DateTimeTimer()
+        self.expiration = datetime.timedelta(seconds=2)
+        options = caches.CheckOptions(
+            flush_interval=datetime.timedelta(seconds=1),
+            expiration=self.expiration,
+            num_shards=4)
+        self.agg = check_request.Aggregator(
+            self.SERVICE_NAME, options, timer=self.timer)
+
+
+class TestShardedStaleWhileRevalidateAggregator(
+        TestStaleWhileRevalidateAggregator):
+    SERVICE_NAME = u'service.with_sharded_stale_cache'
+    FAKE_OPERATION_ID = u'service.with_sharded_stale_cache.op_id'
+
+    def setUp(self):
+        self.timer = _DateTimeTimer()
+        self.flush_interval = datetime.timedelta(seconds=1)
+        options = caches.CheckOptions(
+            flush_interval=self.flush_interval,
+            expiration=datetime.timedelta(seconds=4),
+            max_staleness=datetime.timedelta(seconds=2),
+            num_shards=4)
+        self.agg = check_request.Aggregator(
+            self.SERVICE_NAME, options, timer=self.timer)
+
+
+class TestSharedCacheAggregator(unittest.TestCase):
+    SERVICE_NAME = u'service.with_shared_cache'
+    FAKE_OPERATION_ID = u'service.with_shared_cache.op_id'
+
+    def setUp(self):
+        self.timer = _DateTimeTimer()
+        self.dir = tempfile.mkdtemp()
+        options = caches.CheckOptions(
+            flush_interval=datetime.timedelta(seconds=1),
+            expiration=datetime.timedelta(seconds=2),
+            shared_cache_path=os.path.join(self.dir, u'check'))
+        # aggregators in different processes sharing the cache
+        self.agg = check_request.Aggregator(
+            self.SERVICE_NAME, options, timer=self.timer)
+        self.other_agg = check_request.Aggregator(
+            self.SERVICE_NAME, options, timer=self.timer)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_should_use_responses_added_by_other_aggregators(self):
+        req = _make_test_request(self.SERVICE_NAME)
+        fake_response = sc_messages.CheckResponse(
+            operation_id=self.FAKE_OPERATION_ID)
+        expect(self.agg.check(req)).to(be_none)
+        self.agg.add_response(req, fake_response)
+        expect(self.other_agg.check(req)).to(equal(fake_response))
+
+    def test_should_flush_requests_aggregated_with_shared_responses(self):
+        req = _make_test_request(self.SERVICE_NAME)
+        self.agg.add_response(req, sc_messages.CheckResponse(
+            operation_id=self.FAKE_OPERATION_ID))
+        expect(self.other_agg.check(req)).not_to(be_none)
+        self.timer.tick()
+        self.timer.tick()  # now expired
+        expect(len(self.other_agg.flush())).to(equal(1))
+
+    def test_should_not_use_expired_shared_responses(self):
+        req = _make_test_request(self.SERVICE_NAME)
+        self.agg.add_response(req, sc_messages.CheckResponse(
+            operation_id=self.FAKE_OPERATION_ID))
+        self.timer.tick()
+        self.timer.tick()  # now expired
+        expect(self.other_agg.check(req)).to(be_none)
+
+
 _TEST_CONSUMER_ID = u'testConsumerID'
 _TEST_OP_NAME = u'testOperationName'
 
@@ -332,9 +517,17 @@ def _make_test_request(service_name, importance=None):
     return check_request
 
 
+def _make_test_info(service_name):
+    return check_request.Info(
+        consumer_project_id=_TEST_CONSUMER_ID,
+        operation_id=u'an_op_id',
+        operation_name=_TEST_OP_NAME,
+        service_name=service_name)
+
+
 _WANTED_USER_AGENT = label_descriptor.USER_AGENT
 _WANTED_SERVICE_AGENT = label_descriptor.SERVICE_AGENT
-_START_OF_EPOCH = timestamp_pb2.Timestamp().FromJsonString(timestamp.to_rfc3339(datetime.datetime(1970, 1, 1, 0, 0, 0)))
+_START_OF_EPOCH = timestamp.to_timestamp_pb(datetime.datetime(1970, 1, 1, 0, 0, 0))
 _TEST_SERVICE_NAME = u'a_service_name'
 _INFO_TESTS = [
     (check_request.Info(
@@ -437,6 +630,15 @@ class TestInfo(unittest.TestCase):
             testf = lambda: info.as_check_request(timer=timer)
             expect(testf).to(raise_error(ValueError))
 
+    def test_should_sign_like_the_check_request(self):
+        for info, _ in _INFO_TESTS[1:]:
+            expect(info.signature()).to(equal(
+                check_request.sign(info.as_check_request())))
+
+    def test_should_fail_to_sign_without_a_consumer(self):
+        info, _ = _INFO_TESTS[0]
+        expect(info.signature).to(raise_error(ValueError))
+
 
 class TestConvertResponse(unittest.TestCase):
     PROJECT_ID = u'test_convert_response'
@@ -17,7 +17,9 @@ from __future__ import absolute_import
 from apitools.base.py import exceptions
 import datetime
 import os
+import shutil
 import tempfile
+import threading
 import unittest
 from expects import be_false, be_none, be_true, expect, equal, raise_error
 from unittest import mock
@@ -25,7 +27,7 @@ from unittest import mock
 from google.cloud import servicecontrol as sc_messages
 
 from endpoints_management.control import (
-    caches, check_request, client, quota_request, report_request
+    caches, check_request, client, quota_request, report_request, spool
 )
 
 
@@ -268,6 +270,24 @@ class TestClientCheck(unittest.TestCase):
         self._mock_transport.services.Check.side_effect = exceptions.Error()
         expect(self._subject.check(dummy_request)).to(be_none)
 
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_only_make_requests_from_infos_when_sending(self, dummy_thread_class):
+        t = self._mock_transport
+        self._subject.start()
+        dummy_info = check_request.Info(
+            consumer_project_id=self.PROJECT_ID,
+            operation_id=u'an_op_id',
+            operation_name=u'an_op_name',
+            service_name=self.SERVICE_NAME)
+        dummy_response = sc_messages.CheckResponse(operation_id=u'an_op_id')
+        t.services.Check.return_value = dummy_response
+        expect(self._subject.check(dummy_info)).to(equal(dummy_response))
+        sent = t.services.Check.call_args[0][0]
+        expect(check_request.sign(sent)).to(equal(dummy_info.signature()))
+        t.reset_mock()
+        expect(self._subject.check(dummy_info)).to(equal(dummy_response))
+        expect(t.services.Check.called).to(be_false)
+
 
 class TestClientQuota(unittest.TestCase):
     SERVICE_NAME = u'quota'
@@ -377,6 +397,292 @@ class TestClientReport(unittest.TestCase):
         expect(self._mock_transport.services.Report.called).to(be_true)
 
 
+def _make_dummy_report_info(project_id, service_name):
+    info = report_request.Info(
+        consumer_project_id=project_id,
+        operation_id=u'an_op_id',
+        operation_name=u'an_op_name',
+        method=u'GET',
+        referer=u'a_referer',
+        service_name=service_name)
+    return info, report_request.ReportingRules()
+
+
+class TestClientReportQueue(unittest.TestCase):
+    SERVICE_NAME = u'report-queue'
+    PROJECT_ID = SERVICE_NAME + u'.project'
+
+    def setUp(self):
+        self._mock_transport = mock.MagicMock()
+        self._subject = client.Loaders.DEFAULT.load(
+            self.SERVICE_NAME,
+            create_transport=lambda: self._mock_transport,
+            report_queue_size=1)
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_create_a_report_thread_when_started(self, thread_class):
+        self._subject.start()
+        expect(len(thread_class.call_args_list)).to(equal(2))
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_queue_report_infos(self, dummy_thread_class):
+        info, rules = _make_dummy_report_info(self.PROJECT_ID, self.SERVICE_NAME)
+        self._subject.report_info(info, rules, datetime.datetime.utcnow())
+        expect(self._subject.report_queue_depth).to(equal(1))
+        expect(self._subject.report_queue_drops).to(equal(0))
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_drop_report_infos_when_the_queue_is_full(self, dummy_thread_class):
+        info, rules = _make_dummy_report_info(self.PROJECT_ID, self.SERVICE_NAME)
+        now = datetime.datetime.utcnow()
+        self._subject.report_info(info, rules, now)
+        self._subject.report_info(info, rules, now)
+        expect(self._subject.report_queue_depth).to(equal(1))
+        expect(self._subject.report_queue_drops).to(equal(1))
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_report_queued_infos_on_stop(self, dummy_thread_class):
+        info, rules = _make_dummy_report_info(self.PROJECT_ID, self.SERVICE_NAME)
+        self._subject.report_info(info, rules, datetime.datetime.utcnow())
+        self._subject.stop()
+        expect(self._subject.report_queue_depth).to(equal(0))
+        expect(self._mock_transport.services.Report.called).to(be_true)
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_wait_for_the_report_thread_on_stop(self, thread_class):
+        self._subject.start()
+        self._subject.stop()
+        expect(thread_class.return_value.join.called).to(be_true)
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_report_directly_without_a_queue(self, dummy_thread_class):
+        self._subject = client.Loaders.NO_CACHE.load(
+            self.SERVICE_NAME,
+            create_transport=lambda: self._mock_transport)
+        info, rules = _make_dummy_report_info(self.PROJECT_ID, self.SERVICE_NAME)
+        self._subject.report_info(info, rules, datetime.datetime.utcnow())
+        expect(self._subject.report_queue_depth).to(equal(0))
+        expect(self._mock_transport.services.Report.called).to(be_true)
+
+
+class TestClientFlushWorkers(unittest.TestCase):
+    SERVICE_NAME = u'flush-workers'
+    PROJECT_ID = SERVICE_NAME + u'.project'
+
+    def setUp(self):
+        self._mock_transport = mock.MagicMock()
+        self._subject = client.Loaders.DEFAULT.load(
+            self.SERVICE_NAME,
+            create_transport=lambda: self._mock_transport,
+            flush_workers=2)
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    @mock.patch(u"endpoints_management.control.client.futures", spec=True)
+    def test_should_create_an_executor_per_kind(self, futures, dummy_thread_class):
+        self._subject.start()
+        expect(futures.ThreadPoolExecutor.call_count).to(equal(3))
+        for call in futures.ThreadPoolExecutor.call_args_list:
+            expect(call[1][u'max_workers']).to(equal(2))
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    @mock.patch(u"endpoints_management.control.client.futures", spec=True)
+    def test_should_submit_flushed_reports(self, futures, dummy_thread_class):
+        self._subject.start()
+        self._subject.report(
+            _make_dummy_report_request(self.PROJECT_ID, self.SERVICE_NAME))
+        self._subject.stop()
+        executor = futures.ThreadPoolExecutor.return_value
+        expect(executor.submit.called).to(be_true)
+        expect(futures.wait.called).to(be_true)
+        expect(executor.shutdown.called).to(be_true)
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_send_flushed_reports_on_stop(self, dummy_thread_class):
+        self._subject.start()
+        self._subject.report(
+            _make_dummy_report_request(self.PROJECT_ID, self.SERVICE_NAME))
+        self._subject.stop()
+        expect(self._mock_transport.services.Report.called).to(be_true)
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_log_any_failure_to_send_flushed_reports(self,
+                                                            dummy_thread_class):
+        # failures raised in the executors would otherwise go unseen
+        self._mock_transport.services.Report.side_effect = ValueError()
+        self._subject._send_flushed_report(
+            _make_dummy_report_request(self.PROJECT_ID, self.SERVICE_NAME))
+        expect(self._mock_transport.services.Report.called).to(be_true)
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    @mock.patch(u"endpoints_management.control.client.futures", spec=True)
+    def test_should_send_directly_if_the_executor_is_shutdown(self, futures,
+                                                              dummy_thread_class):
+        self._subject.start()
+        executor = futures.ThreadPoolExecutor.return_value
+        executor.submit.side_effect = RuntimeError()
+        self._subject.report(
+            _make_dummy_report_request(self.PROJECT_ID, self.SERVICE_NAME))
+        self._subject.stop()
+        expect(self._mock_transport.services.Report.called).to(be_true)
+
+
+class TestClientCheckCoalescing(unittest.TestCase):
+    SERVICE_NAME = u'check-coalescing'
+    PROJECT_ID = SERVICE_NAME + u'.project'
+
+    def setUp(self):
+        self._mock_transport = mock.MagicMock()
+        self._release = threading.Event()
+        self._sending = threading.Event()
+        self._dummy_request = _make_dummy_check_request(self.PROJECT_ID,
+                                                        self.SERVICE_NAME)
+        self._dummy_response = sc_messages.CheckResponse(
+            operation_id=self._dummy_request.operation.operation_id)
+
+        def slow_check(dummy_req):
+            self._sending.set()
+            self._release.wait(5)
+            return self._dummy_response
+
+        self._mock_transport.services.Check.side_effect = slow_check
+
+    def _make_subject(self, **kw):
+        return client.Loaders.DEFAULT.load(
+            self.SERVICE_NAME,
+            create_transport=lambda: self._mock_transport,
+            **kw)
+
+    def _check_concurrently(self, subject, count):
+        results = []
+        first = threading.Thread(
+            target=lambda: results.append(subject.check(self._dummy_request)))
+        first.start()
+        self._sending.wait(5)
+        others = [threading.Thread(
+            target=lambda: results.append(subject.check(self._dummy_request)))
+                  for _ in range(count - 1)]
+        for t in others:
+            t.start()
+        return first, others, results
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_share_the_response_of_concurrent_misses(self, dummy_thread_class):
+        subject = self._make_subject()
+        first, others, results = self._check_concurrently(subject, 4)
+        while subject.check_coalesced_waiters < 3:
+            self._release.wait(0.01)
+        self._release.set()
+        for t in [first] + others:
+            t.join()
+        expect(self._mock_transport.services.Check.call_count).to(equal(1))
+        expect(results).to(equal([self._dummy_response] * 4))
+        expect(subject.check_coalesce_timeouts).to(equal(0))
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_fail_open_when_the_deadline_passes(self, dummy_thread_class):
+        subject = self._make_subject(
+            check_coalesce_timeout=datetime.timedelta(milliseconds=1))
+        first, others, results = self._check_concurrently(subject, 2)
+        for t in others:
+            t.join()
+        expect(results).to(equal([None]))
+        expect(subject.check_coalesce_timeouts).to(equal(1))
+        self._release.set()
+        first.join()
+        expect(self._mock_transport.services.Check.call_count).to(equal(1))
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_not_coalesce_if_disabled(self, dummy_thread_class):
+        subject = self._make_subject(check_coalesce_timeout=None)
+        first, others, dummy_results = self._check_concurrently(subject, 2)
+        self._release.set()
+        for t in [first] + others:
+            t.join()
+        expect(self._mock_transport.services.Check.call_count).to(equal(2))
+        expect(subject.check_coalesced_waiters).to(equal(0))
+
+
+class TestClientReportSpool(unittest.TestCase):
+    SERVICE_NAME = u'report-spool'
+    PROJECT_ID = SERVICE_NAME + u'.project'
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._spool = spool.Spool(self._dir)
+        self._mock_transport = mock.MagicMock()
+        self._subject = client.Loaders.DEFAULT.load(
+            self.SERVICE_NAME,
+            create_transport=lambda: self._mock_transport,
+            report_spool=self._spool)
+
+    def tearDown(self):
+        self._spool.close()
+        shutil.rmtree(self._dir)
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_create_a_spool_thread_when_started(self, thread_class):
+        self._subject.start()
+        expect(len(thread_class.call_args_list)).to(equal(2))
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_stop_the_spool_thread_and_close_the_spool(self,
+                                                             thread_class):
+        self._subject.start()
+        with mock.patch.object(self._spool, u'close') as close:
+            self._subject.stop()
+            expect(close.called).to(be_true)
+        expect(thread_class.return_value.join.called).to(be_true)
+
+    def test_should_log_failures_to_spool(self):
+        with mock.patch.object(self._spool, u'append') as append:
+            append.side_effect = TypeError()
+            self._subject._spool_report(
+                _make_dummy_report_request(self.PROJECT_ID, self.SERVICE_NAME))
+            expect(append.called).to(be_true)
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_spool_reports_that_fail_on_stop(self, dummy_thread_class):
+        self._mock_transport.services.Report.side_effect = exceptions.Error()
+        dummy_request = _make_dummy_report_request(self.PROJECT_ID,
+                                                   self.SERVICE_NAME)
+        self._subject.report(dummy_request)
+        self._subject.stop()
+        expect(self._spool.appended).to(equal(1))
+
+        # replay them once the transport recovers
+        self._mock_transport.services.Report.side_effect = None
+        self._mock_transport.services.Report.reset_mock()
+        expect(self._spool.replay(self._subject._send_spooled_report)).to(
+            be_true)
+        expect(self._mock_transport.services.Report.call_count).to(equal(1))
+        expect(self._spool.size).to(equal(0))
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_spool_direct_reports_that_fail(self, dummy_thread_class):
+        self._subject = client.Loaders.NO_CACHE.load(
+            self.SERVICE_NAME,
+            create_transport=lambda: self._mock_transport,
+            report_spool=self._spool)
+        self._mock_transport.services.Report.side_effect = exceptions.Error()
+        dummy_request = _make_dummy_report_request(self.PROJECT_ID,
+                                                   self.SERVICE_NAME)
+        self._subject.report(dummy_request)
+        expect(self._spool.appended).to(equal(1))
+
+        self._mock_transport.services.Report.side_effect = None
+        self._spool.replay(self._subject._send_spooled_report)
+        self._mock_transport.services.Report.assert_called_with(dummy_request)
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_not_spool_reports_that_are_sent(self, dummy_thread_class):
+        dummy_request = _make_dummy_report_request(self.PROJECT_ID,
+                                                   self.SERVICE_NAME)
+        self._subject.report(dummy_request)
+        self._subject.stop()
+        expect(self._mock_transport.services.Report.called).to(be_true)
+        expect(self._spool.appended).to(equal(0))
+
+
 class TestNoSchedulerThread(unittest.TestCase):
     SERVICE_NAME = u'no-scheduler-thread'
     PROJECT_ID = SERVICE_NAME + u'.project'
@@ -16,7 +16,7 @@ from __future__ import absolute_import
 
 import sys
 import unittest
-from expects import expect, equal, raise_error
+from expects import be, expect, equal, raise_error
 from google.cloud import servicecontrol as sc_messages
 
 from endpoints_management.control import distribution
@@ -197,6 +197,13 @@ class TestMerge(unittest.TestCase):
             expect(d2.maximum).to(equal(_HIGH_SAMPLE))
             expect(d2.minimum).to(equal(_LOW_SAMPLE))
 
+    def test_should_merge_into_an_empty_distribution(self):
+        for d1, _, _ in self.merge_triples:
+            empty = distribution.create_from_layout(
+                distribution.bucket_layout(d1))
+            distribution.merge(d1, empty)
+            expect(empty).to(equal(d1))
+
     def test_should_merge_bucket_counts_correctly(self):
         for d1, d2, _ in self.merge_triples:
             d1_start = list(d1.bucket_counts)
@@ -204,3 +211,265 @@ class TestMerge(unittest.TestCase):
             want = [x + y for (x,y) in zip(d1_start, d2_start)]
             distribution.merge(d1, d2)
             expect(d2.bucket_counts).to(equal(want))
+
+
+class TestBucketLayout(unittest.TestCase):
+
+    def test_should_be_none_if_no_buckets_are_set(self):
+        expect(distribution.bucket_layout(sc_messages.Distribution())).to(
+            equal(None))
+
+    def test_should_match_for_distributions_with_the_same_buckets(self):
+        for make_dist in (_make_explicit_dist,
+                          _make_linear_dist,
+                          _make_exponential_dist):
+            expect(distribution.bucket_layout(make_dist())).to(
+                equal(distribution.bucket_layout(make_dist())))
+
+    def test_should_differ_for_distributions_with_different_buckets(self):
+        layouts = set(distribution.bucket_layout(d) for d in (
+            _make_explicit_dist(),
+            _make_linear_dist(),
+            _make_exponential_dist(),
+            distribution.create_exponential(4, 2, 0.1)))
+        expect(len(layouts)).to(equal(4))
+
+    def test_should_be_the_same_instance_for_the_same_buckets(self):
+        expect(distribution.bucket_layout(_make_exponential_dist())).to(
+            be(distribution.exponential_layout(3, 2, 0.1)))
+        expect(distribution.bucket_layout(_make_linear_dist())).to(
+            be(distribution.linear_layout(3, 0.2, 0.1)))
+        expect(distribution.bucket_layout(_make_explicit_dist())).to(
+            be(distribution.explicit_layout([0.7, 0.5, 0.3, 0.1])))
+
+    def test_should_fail_to_obtain_layouts_from_bad_args(self):
+        bad_layouts = (
+            lambda: distribution.exponential_layout(0, 1.1, 0.1),
+            lambda: distribution.exponential_layout(1, 0.9, 0.1),
+            lambda: distribution.exponential_layout(1, 1.1, -0.1),
+            lambda: distribution.linear_layout(0, 0.2, 0.1),
+            lambda: distribution.linear_layout(1, -0.2, 0.1),
+            lambda: distribution.explicit_layout([0.0, 0.1, 0.1]),
+        )
+        for testf in bad_layouts:
+            expect(testf).to(raise_error(ValueError))
+
+    def test_should_find_the_buckets_of_samples_on_the_bounds(self):
+        layout = distribution.exponential_layout(8, 10.0, 1.0)
+        for i in range(9):
+            expect(layout.bucket_index(10.0 ** i)).to(equal(i + 1 if i else 0))
+        layout = distribution.linear_layout(3, 0.25, 0.5)
+        for i in range(4):
+            expect(layout.bucket_index(0.5 + 0.25 * i)).to(equal(i + 1))
+        layout = distribution.explicit_layout([0.1, 0.3, 0.5])
+        for i, bound in enumerate(layout.bounds):
+            expect(layout.bucket_index(bound)).to(equal(i + 1))
+
+    def test_should_create_empty_distributions_from_layouts(self):
+        for make_dist in (_make_explicit_dist,
+                          _make_linear_dist,
+                          _make_exponential_dist):
+            want = make_dist()
+            got = distribution.create_from_layout(
+                distribution.bucket_layout(want))
+            expect(got).to(equal(want))
+
+    def test_should_fail_to_create_from_unknown_layouts(self):
+        testf = lambda: distribution.create_from_layout(None)
+        expect(testf).to(raise_error(ValueError))
+
+
+class TestAccumulator(unittest.TestCase):
+    MAKE_DIST_FUNCS = (_make_explicit_dist,
+                       _make_linear_dist,
+                       _make_exponential_dist)
+
+    def _make_accumulator(self, make_dist_func):
+        return distribution.Accumulator(
+            distribution.bucket_layout(make_dist_func()))
+
+    def test_should_fail_if_no_buckets_are_set(self):
+        testf = lambda: distribution.Accumulator(None)
+        expect(testf).to(raise_error(ValueError))
+
+    def test_should_add_samples_as_add_sample_does(self):
+        for make_dist_func in self.MAKE_DIST_FUNCS:
+            for t in _TEST_SAMPLES_AND_BUCKETS:
+                want = make_dist_func()
+                for s in t[u'samples']:
+                    distribution.add_sample(s, want)
+                acc = self._make_accumulator(make_dist_func)
+                acc.add_samples(t[u'samples'])
+                expect(acc.to_proto()).to(equal(want))
+
+    def test_should_add_one_sample_as_add_sample_does(self):
+        for make_dist_func in self.MAKE_DIST_FUNCS:
+            want = make_dist_func()
+            distribution.add_sample(_LOW_SAMPLE, want)
+            acc = self._make_accumulator(make_dist_func)
+            acc.add_sample(_LOW_SAMPLE)
+            expect(acc.to_proto()).to(equal(want))
+
+    def test_should_merge_as_merge_does(self):
+        for make_dist_func in self.MAKE_DIST_FUNCS:
+            prior = make_dist_func()
+            want = make_dist_func()
+            for s in (_LOW_SAMPLE, _HIGH_SAMPLE):
+                distribution.add_sample(s, prior)
+            distribution.add_sample(_OVERFLOW_SAMPLE, want)
+            acc = distribution.Accumulator.from_proto(want)
+            acc.merge(prior)
+            distribution.merge(prior, want)
+            expect(acc.to_proto()).to(equal(want))
+
+    def test_should_merge_other_accumulators(self):
+        for make_dist_func in self.MAKE_DIST_FUNCS:
+            prior = make_dist_func()
+            want = make_dist_func()
+            distribution.add_sample(_LOW_SAMPLE, prior)
+            distribution.add_sample(_HIGH_SAMPLE, want)
+            acc = distribution.Accumulator.from_proto(want)
+            acc.merge(distribution.Accumulator.from_proto(prior))
+            distribution.merge(prior, want)
+            expect(acc.to_proto()).to(equal(want))
+
+    def test_should_merge_into_an_empty_accumulator(self):
+        for make_dist_func in self.MAKE_DIST_FUNCS:
+            prior = make_dist_func()
+            distribution.add_sample(_HIGH_SAMPLE, prior)
+            acc = self._make_accumulator(make_dist_func)
+            acc.merge(prior)
+            expect(acc.to_proto()).to(equal(prior))
+
+    def test_should_fail_to_merge_dissimilar_bucket_options(self):
+        acc = self._make_accumulator(_make_explicit_dist)
+        for make_dist_func in (_make_linear_dist, _make_exponential_dist):
+            testf = lambda: acc.merge(make_dist_func())
+            expect(testf).to(raise_error(ValueError))
+
+    def test_should_fail_to_merge_dissimilar_bucket_counts(self):
+        acc = self._make_accumulator(_make_exponential_dist)
+        dist = _make_exponential_dist()
+        dist.bucket_counts.append(0)
+        testf = lambda: acc.merge(dist)
+        expect(testf).to(raise_error(ValueError))
+
+
+class TestQuantiles(unittest.TestCase):
+
+    def test_should_fail_if_no_buckets_are_set(self):
+        testf = lambda: distribution.quantiles(sc_messages.Distribution(),
+                                               (0.5,))
+        expect(testf).to(raise_error(ValueError))
+
+    def test_should_fail_on_bad_quantiles(self):
+        dist = distribution.create_linear(4, 1.0, 0.0)
+        distribution.add_sample(1.5, dist)
+        for q in (-0.1, 1.1):
+            testf = lambda: distribution.quantiles(dist, (q,))
+            expect(testf).to(raise_error(ValueError))
+
+    def test_should_be_none_without_samples(self):
+        dist = distribution.create_linear(4, 1.0, 0.0)
+        expect(distribution.quantiles(dist, (0.5, 0.9))).to(
+            equal([None, None]))
+
+    def test_should_interpolate_within_buckets(self):
+        acc = distribution.Accumulator(distribution.linear_layout(4, 1.0, 0.0))
+        acc.add_samples([0.0, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 4.0])
+        got = distribution.quantiles(acc, (0.0, 0.5, 1.0))
+        expect(got).to(equal([0.0, 2.0, 4.0]))
+
+    def test_should_bound_quantiles_by_the_minimum_and_maximum(self):
+        for make_dist in (lambda: distribution.create_exponential(8, 10.0, 1e-6),
+                          lambda: distribution.create_explicit([0.1, 1.0])):
+            dist = make_dist()
+            for s in (0.02, 0.03, 0.05):
+                distribution.add_sample(s, dist)
+            for value in distribution.quantiles(dist, (0.0, 0.5, 0.99, 1.0)):
+                expect(0.02 <= value <= 0.05).to(equal(True))
+
+
+class TestSketch(unittest.TestCase):
+    LAYOUT = distribution.exponential_layout(8, 10.0, 1e-6)
+    SAMPLES = [0.001 * (1.1 ** i) for i in range(100)]
+
+    def _expect_within_accuracy(self, got, want, accuracy):
+        expect(abs(got - want) <= accuracy * want).to(equal(True))
+
+    def test_should_fail_on_bad_args(self):
+        bad_sketches = (
+            lambda: distribution.Sketch(None),
+            lambda: distribution.Sketch(self.LAYOUT, relative_accuracy=0.0),
+            lambda: distribution.Sketch(self.LAYOUT, relative_accuracy=1.0),
+            lambda: distribution.Sketch(self.LAYOUT, max_num_buckets=0),
+        )
+        for testf in bad_sketches:
+            expect(testf).to(raise_error(ValueError))
+
+    def test_should_estimate_quantiles_within_its_accuracy(self):
+        sketch = distribution.Sketch(self.LAYOUT, relative_accuracy=0.01)
+        sketch.add_samples(self.SAMPLES)
+        qs = (0.0, 0.25, 0.5, 0.99, 1.0)
+        for q, got in zip(qs, sketch.quantiles(qs)):
+            want = self.SAMPLES[int(q * (len(self.SAMPLES) - 1))]
+            self._expect_within_accuracy(got, want, 0.01)
+
+    def test_should_have_the_exact_statistics(self):
+        want = distribution.Accumulator(self.LAYOUT)
+        want.add_samples(self.SAMPLES)
+        sketch = distribution.Sketch(self.LAYOUT)
+        sketch.add_samples(self.SAMPLES)
+        got = sketch.to_proto()
+        expect(got.count).to(equal(want.count))
+        expect(got.mean).to(equal(want.mean))
+        expect(got.minimum).to(equal(want.minimum))
+        expect(got.maximum).to(equal(want.maximum))
+        expect(sum(got.bucket_counts)).to(equal(len(self.SAMPLES)))
+
+    def test_should_merge_other_sketches(self):
+        half = len(self.SAMPLES) // 2
+        want = distribution.Sketch(self.LAYOUT)
+        want.add_samples(self.SAMPLES)
+        sketch = distribution.Sketch(self.LAYOUT)
+        sketch.add_samples(self.SAMPLES[:half])
+        other = distribution.Sketch(self.LAYOUT)
+        other.add_samples(self.SAMPLES[half:])
+        sketch.merge(other)
+        expect(sketch.bins).to(equal(want.bins))
+        expect(sketch.count).to(equal(want.count))
+
+    def test_should_merge_single_sample_distributions_exactly(self):
+        sketch = distribution.Sketch(self.LAYOUT, relative_accuracy=0.01)
+        for s in self.SAMPLES:
+            dist = distribution.create_from_layout(self.LAYOUT)
+            distribution.add_sample(s, dist)
+            sketch.merge(dist)
+        got = sketch.quantiles((0.5,))[0]
+        self._expect_within_accuracy(got, self.SAMPLES[49], 0.01)
+
+    def test_should_fail_to_merge_dissimilar_sketches(self):
+        sketch = distribution.Sketch(self.LAYOUT, relative_accuracy=0.01)
+        others = (
+            distribution.Sketch(self.LAYOUT, relative_accuracy=0.02),
+            distribution.Sketch(distribution.exponential_layout(8, 10.0, 1.0)),
+            _make_linear_dist(),
+        )
+        for other in others:
+            testf = lambda: sketch.merge(other)
+            expect(testf).to(raise_error(ValueError))
+
+    def test_should_bound_the_number_of_buckets(self):
+        sketch = distribution.Sketch(self.LAYOUT, max_num_buckets=10)
+        sketch.add_samples(self.SAMPLES)
+        expect(len(sketch.bins)).to(equal(10))
+        expect(sum(sketch.bins.values())).to(equal(len(self.SAMPLES)))
+        got = sketch.quantiles((1.0,))[0]
+        self._expect_within_accuracy(got, self.SAMPLES[-1],
+                                     sketch.relative_accuracy)
+
+    def test_should_count_samples_that_are_not_positive_as_zero(self):
+        sketch = distribution.Sketch(self.LAYOUT)
+        sketch.add_samples([0.0, 0.0, 0.5])
+        expect(sketch.zero_count).to(equal(2))
+        expect(sketch.quantiles((0.0, 0.5))).to(equal([0.0, 0.0]))
@@ -0,0 +1,103 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import datetime
+import unittest
+from expects import be_none, equal, expect, raise_error
+
+from endpoints_management.control import latency
+
+
+_SELECTOR = u'a.method.selector'
+_OTHER_SELECTOR = u'another.method.selector'
+
+
+def _ms(n):
+    return datetime.timedelta(milliseconds=n)
+
+
+class TestMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.timer = _DateTimeTimer()
+        self.monitor = latency.Monitor(window=datetime.timedelta(seconds=6),
+                                       num_slots=3,
+                                       timer=self.timer)
+
+    def test_should_fail_if_there_are_no_slots(self):
+        testf = lambda: latency.Monitor(num_slots=0)
+        expect(testf).to(raise_error(ValueError))
+
+    def test_should_have_an_empty_snapshot_initially(self):
+        expect(self.monitor.snapshot()).to(equal({}))
+
+    def test_should_summarize_each_method(self):
+        for n in (10, 20, 30):
+            self.monitor.record(_SELECTOR, _ms(n), _ms(n // 2))
+        self.monitor.record(_OTHER_SELECTOR, _ms(40), None)
+        got = self.monitor.snapshot()
+        expect(sorted(got.keys())).to(equal([_SELECTOR, _OTHER_SELECTOR]))
+        total = got[_SELECTOR].total
+        expect(total.count).to(equal(3))
+        expect(total.minimum).to(equal(0.01))
+        expect(total.maximum).to(equal(0.03))
+        expect(sorted(total.quantiles.keys())).to(
+            equal(list(latency.Monitor.DEFAULT_QUANTILES)))
+        expect(got[_SELECTOR].backend.count).to(equal(3))
+        expect(got[_OTHER_SELECTOR].total.count).to(equal(1))
+        expect(got[_OTHER_SELECTOR].backend.count).to(equal(0))
+        expect(got[_OTHER_SELECTOR].backend.quantiles[0.5]).to(be_none)
+
+    def test_should_discard_latencies_older_than_the_window(self):
+        self.monitor.record(_SELECTOR, _ms(10), _ms(5))
+        for _ in range(4):
+            self.timer.tick()
+        self.monitor.record(_SELECTOR, _ms(20), _ms(5))
+        expect(self.monitor.snapshot()[_SELECTOR].total.count).to(equal(2))
+        for _ in range(3):
+            self.timer.tick()
+        got = self.monitor.snapshot()[_SELECTOR].total
+        expect(got.count).to(equal(1))
+        expect(got.minimum).to(equal(0.02))
+
+
+class TestSketchedMonitor(TestMonitor):
+
+    def setUp(self):
+        self.timer = _DateTimeTimer()
+        self.monitor = latency.Monitor(window=datetime.timedelta(seconds=6),
+                                       num_slots=3,
+                                       relative_accuracy=0.01,
+                                       timer=self.timer)
+
+    def test_should_estimate_quantiles_within_the_accuracy(self):
+        for n in range(1, 101):
+            self.monitor.record(_SELECTOR, _ms(n), None)
+        got = self.monitor.snapshot()[_SELECTOR].total.quantiles[0.5]
+        expect(abs(got - 0.05) <= 0.01 * 0.05 + 0.001).to(equal(True))
+
+class _DateTimeTimer(object):
+    def __init__(self, auto=False):
+        self.auto = auto
+        self.time = datetime.datetime.utcfromtimestamp(0)
+
+    def __call__(self):
+        if self.auto:
+            self.tick()
+        return self.time
+
+    def tick(self):
+        self.time += datetime.timedelta(seconds=1)
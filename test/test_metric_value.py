@@ -21,7 +21,6 @@ import unittest
 from expects import equal, expect, raise_error
 
 from google.cloud import servicecontrol as sc_messages
-from google.protobuf import timestamp_pb2
 from google.type import money_pb2
 from endpoints_management.control import (distribution, timestamp,
                                           metric_value)
@@ -68,8 +67,8 @@ class TestSign(TestUpdateHash):
 
 class TestMerge(unittest.TestCase):
     A_FLOAT_VALUE = 1.0
-    EARLY = timestamp_pb2.Timestamp().FromJsonString(timestamp.to_rfc3339(datetime.datetime(1970, 1, 1, 10, 0, 0)))
-    LATER = timestamp_pb2.Timestamp().FromJsonString(timestamp.to_rfc3339(datetime.datetime(1990, 1, 1, 10, 0, 0)))
+    EARLY = timestamp.to_timestamp_pb(datetime.datetime(1970, 1, 1, 10, 0, 0))
+    LATER = timestamp.to_timestamp_pb(datetime.datetime(1990, 1, 1, 10, 0, 0))
     TEST_LABELS = {
         u'key1': u'value1',
         u'key2': u'value2',
@@ -16,18 +16,18 @@ from __future__ import absolute_import
 
 import datetime
 import unittest
-from expects import be_none, expect, equal, raise_error
+from expects import be_none, be_within, expect, equal, raise_error
 
 from google.cloud import servicecontrol as sc_messages
-from google.protobuf import timestamp_pb2
-from endpoints_management.control import (metric_value, operation, timestamp)
+from endpoints_management.control import (distribution, metric_descriptor,
+                                          metric_value, operation, timestamp)
 from endpoints_management.control import MetricKind
 
 _A_FLOAT_VALUE = 1.1
-_REALLY_EARLY = timestamp_pb2.Timestamp().FromJsonString(timestamp.to_rfc3339(datetime.datetime(1970, 1, 1, 0, 0, 0)))
-_EARLY = timestamp_pb2.Timestamp().FromJsonString(timestamp.to_rfc3339(datetime.datetime(1980, 1, 1, 10, 0, 0)))
-_LATER = timestamp_pb2.Timestamp().FromJsonString(timestamp.to_rfc3339(datetime.datetime(1980, 2, 2, 10, 0, 0)))
-_LATER_STILL = timestamp_pb2.Timestamp().FromJsonString(timestamp.to_rfc3339(datetime.datetime(1981, 2, 2, 10, 0, 0)))
+_REALLY_EARLY = timestamp.to_timestamp_pb(datetime.datetime(1970, 1, 1, 0, 0, 0))
+_EARLY = timestamp.to_timestamp_pb(datetime.datetime(1980, 1, 1, 10, 0, 0))
+_LATER = timestamp.to_timestamp_pb(datetime.datetime(1980, 2, 2, 10, 0, 0))
+_LATER_STILL = timestamp.to_timestamp_pb(datetime.datetime(1981, 2, 2, 10, 0, 0))
 
 _TEST_LABELS = {
     u'key1': u'value1',
@@ -35,263 +35,266 @@ _TEST_LABELS = {
 }
 
 # in tests, the description field is not currently used, but should be filled
-_TESTS = [
-    {
-        u'description': u'update the start time to that of the earliest',
-        u'kinds': None,
-        u'initial': sc_messages.Operation(
-            start_time=_EARLY,
-            end_time=_LATER
-        ),
-        u'ops': [
-            sc_messages.Operation(
-                start_time=_REALLY_EARLY,
-                end_time=_LATER
-            ),
-            sc_messages.Operation(
-                start_time=_LATER,
-                end_time=_LATER
-            ),
-        ],
-        u'want': sc_messages.Operation(start_time=_REALLY_EARLY, end_time=_LATER)
-    },
-    {
-        u'description': u'update the end time to that of the latest',
-        u'kinds': None,
-        u'initial': sc_messages.Operation(
-            start_time=_EARLY,
-            end_time=_LATER
-        ),
-        u'ops': [
-            sc_messages.Operation(
+def _make_tests():
+    # the aggregators update the operations they are given, so each test
+    # uses its own
+    return [
+        {
+            u'description': u'update the start time to that of the earliest',
+            u'kinds': None,
+            u'initial': sc_messages.Operation(
                 start_time=_EARLY,
                 end_time=_LATER
             ),
-            sc_messages.Operation(
+            u'ops': [
+                sc_messages.Operation(
+                    start_time=_REALLY_EARLY,
+                    end_time=_LATER
+                ),
+                sc_messages.Operation(
+                    start_time=_LATER,
+                    end_time=_LATER
+                ),
+            ],
+            u'want': sc_messages.Operation(start_time=_REALLY_EARLY, end_time=_LATER)
+        },
+        {
+            u'description': u'update the end time to that of the latest',
+            u'kinds': None,
+            u'initial': sc_messages.Operation(
                 start_time=_EARLY,
-                end_time=_LATER_STILL
+                end_time=_LATER
             ),
-        ],
-        u'want': sc_messages.Operation(start_time=_EARLY, end_time=_LATER_STILL)
-    },
-    {
-        u'description': u'combine the log entries',
-        u'kinds': None,
-        u'initial': sc_messages.Operation(
-            start_time=_EARLY,
-            end_time=_LATER,
-            log_entries=[sc_messages.LogEntry(text_payload=u'initial')]
-        ),
-        u'ops': [
-            sc_messages.Operation(
+            u'ops': [
+                sc_messages.Operation(
+                    start_time=_EARLY,
+                    end_time=_LATER
+                ),
+                sc_messages.Operation(
+                    start_time=_EARLY,
+                    end_time=_LATER_STILL
+                ),
+            ],
+            u'want': sc_messages.Operation(start_time=_EARLY, end_time=_LATER_STILL)
+        },
+        {
+            u'description': u'combine the log entries',
+            u'kinds': None,
+            u'initial': sc_messages.Operation(
                 start_time=_EARLY,
                 end_time=_LATER,
-                log_entries=[sc_messages.LogEntry(text_payload=u'agg1')]
+                log_entries=[sc_messages.LogEntry(text_payload=u'initial')]
             ),
-            sc_messages.Operation(
+            u'ops': [
+                sc_messages.Operation(
+                    start_time=_EARLY,
+                    end_time=_LATER,
+                    log_entries=[sc_messages.LogEntry(text_payload=u'agg1')]
+                ),
+                sc_messages.Operation(
+                    start_time=_EARLY,
+                    end_time=_LATER,
+                    log_entries=[sc_messages.LogEntry(text_payload=u'agg2')]
+                ),
+            ],
+            u'want': sc_messages.Operation(
                 start_time=_EARLY,
                 end_time=_LATER,
-                log_entries=[sc_messages.LogEntry(text_payload=u'agg2')]
-            ),
-        ],
-        u'want': sc_messages.Operation(
-            start_time=_EARLY,
-            end_time=_LATER,
-            log_entries=[
-                sc_messages.LogEntry(text_payload=u'initial'),
-                sc_messages.LogEntry(text_payload=u'agg1'),
-                sc_messages.LogEntry(text_payload=u'agg2')
-            ]
-        )
-    },
-    {
-        u'description': u'combines the metric value using the default kind',
-        u'kinds': None,
-        u'initial': sc_messages.Operation(
-            start_time=_EARLY,
-            end_time=_LATER,
-            metric_value_sets = [
-                sc_messages.MetricValueSet(
-                    metric_name=u'some_floats',
-                    metric_values=[
-                        metric_value.create(
-                            labels=_TEST_LABELS,
-                            double_value=_A_FLOAT_VALUE,
-                            end_time=_EARLY
-                        ),
-                    ]
-                ),
-                sc_messages.MetricValueSet(
-                    metric_name=u'other_floats',
-                    metric_values=[
-                        metric_value.create(
-                            labels=_TEST_LABELS,
-                            double_value=_A_FLOAT_VALUE,
-                            end_time=_EARLY
-                        ),
-                    ]
-                )
-            ]
-        ),
-        u'ops': [
-            sc_messages.Operation(
+                log_entries=[
+                    sc_messages.LogEntry(text_payload=u'initial'),
+                    sc_messages.LogEntry(text_payload=u'agg1'),
+                    sc_messages.LogEntry(text_payload=u'agg2')
+                ]
+            )
+        },
+        {
+            u'description': u'combines the metric value using the default kind',
+            u'kinds': None,
+            u'initial': sc_messages.Operation(
                 start_time=_EARLY,
                 end_time=_LATER,
-                metric_value_sets= [
+                metric_value_sets = [
                     sc_messages.MetricValueSet(
                         metric_name=u'some_floats',
                         metric_values=[
                             metric_value.create(
                                 labels=_TEST_LABELS,
                                 double_value=_A_FLOAT_VALUE,
-                                end_time=_LATER
+                                end_time=_EARLY
                             ),
                         ]
                     ),
-                ]
-            ),
-            sc_messages.Operation(
-                start_time=_EARLY,
-                end_time=_LATER,
-                metric_value_sets= [
                     sc_messages.MetricValueSet(
                         metric_name=u'other_floats',
                         metric_values=[
                             metric_value.create(
                                 labels=_TEST_LABELS,
                                 double_value=_A_FLOAT_VALUE,
-                                end_time=_LATER_STILL
+                                end_time=_EARLY
                             ),
                         ]
                     )
                 ]
-
             ),
-        ],
-        u'want': sc_messages.Operation(
-            start_time=_EARLY,
-            end_time=_LATER,
-            metric_value_sets= [
-                sc_messages.MetricValueSet(
-                    metric_name=u'other_floats',
-                    metric_values=[
-                        metric_value.create(
-                            labels=_TEST_LABELS,
-                            double_value=_A_FLOAT_VALUE * 2,
-                            end_time=_LATER_STILL
+            u'ops': [
+                sc_messages.Operation(
+                    start_time=_EARLY,
+                    end_time=_LATER,
+                    metric_value_sets= [
+                        sc_messages.MetricValueSet(
+                            metric_name=u'some_floats',
+                            metric_values=[
+                                metric_value.create(
+                                    labels=_TEST_LABELS,
+                                    double_value=_A_FLOAT_VALUE,
+                                    end_time=_LATER
+                                ),
+                            ]
                         ),
                     ]
                 ),
-                sc_messages.MetricValueSet(
-                    metric_name=u'some_floats',
-                    metric_values=[
-                        metric_value.create(
-                            labels=_TEST_LABELS,
-                            double_value=_A_FLOAT_VALUE * 2,
-                            end_time=_LATER
-                        ),
-                    ]
-                )
-            ]
-        )
-    },
-    {
-        u'description': u'combines a metric value using a kind that is not DELTA',
-        u'kinds': {u'some_floats': MetricKind.GAUGE },
-        u'initial': sc_messages.Operation(
-            start_time=_EARLY,
-            end_time=_LATER,
-            metric_value_sets=[
-                sc_messages.MetricValueSet(
-                    metric_name=u'some_floats',
-                    metric_values=[
-                        metric_value.create(
-                            labels=_TEST_LABELS,
-                            double_value=_A_FLOAT_VALUE,
-                            end_time=_EARLY,
-                        ),
+                sc_messages.Operation(
+                    start_time=_EARLY,
+                    end_time=_LATER,
+                    metric_value_sets= [
+                        sc_messages.MetricValueSet(
+                            metric_name=u'other_floats',
+                            metric_values=[
+                                metric_value.create(
+                                    labels=_TEST_LABELS,
+                                    double_value=_A_FLOAT_VALUE,
+                                    end_time=_LATER_STILL
+                                ),
+                            ]
+                        )
                     ]
+
                 ),
-                sc_messages.MetricValueSet(
-                    metric_name=u'other_floats',
-                    metric_values=[
-                        metric_value.create(
-                            labels=_TEST_LABELS,
-                            double_value=_A_FLOAT_VALUE,
-                            end_time=_EARLY
-                        ),
-                    ]
-                )
-            ]
-        ),
-        u'ops': [
-            sc_messages.Operation(
+            ],
+            u'want': sc_messages.Operation(
                 start_time=_EARLY,
                 end_time=_LATER,
                 metric_value_sets= [
+                    sc_messages.MetricValueSet(
+                        metric_name=u'other_floats',
+                        metric_values=[
+                            metric_value.create(
+                                labels=_TEST_LABELS,
+                                double_value=_A_FLOAT_VALUE * 2,
+                                end_time=_LATER_STILL
+                            ),
+                        ]
+                    ),
                     sc_messages.MetricValueSet(
                         metric_name=u'some_floats',
                         metric_values=[
                             metric_value.create(
                                 labels=_TEST_LABELS,
-                                double_value=_A_FLOAT_VALUE,
+                                double_value=_A_FLOAT_VALUE * 2,
                                 end_time=_LATER
                             ),
                         ]
-                    ),
+                    )
                 ]
-            ),
-            sc_messages.Operation(
+            )
+        },
+        {
+            u'description': u'combines a metric value using a kind that is not DELTA',
+            u'kinds': {u'some_floats': MetricKind.GAUGE },
+            u'initial': sc_messages.Operation(
                 start_time=_EARLY,
                 end_time=_LATER,
                 metric_value_sets=[
+                    sc_messages.MetricValueSet(
+                        metric_name=u'some_floats',
+                        metric_values=[
+                            metric_value.create(
+                                labels=_TEST_LABELS,
+                                double_value=_A_FLOAT_VALUE,
+                                end_time=_EARLY,
+                            ),
+                        ]
+                    ),
                     sc_messages.MetricValueSet(
                         metric_name=u'other_floats',
                         metric_values=[
                             metric_value.create(
                                 labels=_TEST_LABELS,
                                 double_value=_A_FLOAT_VALUE,
-                                end_time=_LATER_STILL
+                                end_time=_EARLY
                             ),
                         ]
                     )
                 ]
-
             ),
-        ],
-        u'want': sc_messages.Operation(
-            start_time=_EARLY,
-            end_time=_LATER,
-            metric_value_sets=[
-                sc_messages.MetricValueSet(
-                    metric_name=u'other_floats',
-                    metric_values=[
-                        metric_value.create(
-                            labels=_TEST_LABELS,
-                            double_value=_A_FLOAT_VALUE * 2,
-                            end_time=_LATER_STILL
+            u'ops': [
+                sc_messages.Operation(
+                    start_time=_EARLY,
+                    end_time=_LATER,
+                    metric_value_sets= [
+                        sc_messages.MetricValueSet(
+                            metric_name=u'some_floats',
+                            metric_values=[
+                                metric_value.create(
+                                    labels=_TEST_LABELS,
+                                    double_value=_A_FLOAT_VALUE,
+                                    end_time=_LATER
+                                ),
+                            ]
                         ),
                     ]
                 ),
-                sc_messages.MetricValueSet(
-                    metric_name=u'some_floats',
-                    metric_values=[
-                        metric_value.create(
-                            labels=_TEST_LABELS,
-                            double_value=_A_FLOAT_VALUE,
-                            end_time=_LATER
-                        ),
+                sc_messages.Operation(
+                    start_time=_EARLY,
+                    end_time=_LATER,
+                    metric_value_sets=[
+                        sc_messages.MetricValueSet(
+                            metric_name=u'other_floats',
+                            metric_values=[
+                                metric_value.create(
+                                    labels=_TEST_LABELS,
+                                    double_value=_A_FLOAT_VALUE,
+                                    end_time=_LATER_STILL
+                                ),
+                            ]
+                        )
                     ]
-                )
-            ]
-        )
-    }
-]
+
+                ),
+            ],
+            u'want': sc_messages.Operation(
+                start_time=_EARLY,
+                end_time=_LATER,
+                metric_value_sets=[
+                    sc_messages.MetricValueSet(
+                        metric_name=u'other_floats',
+                        metric_values=[
+                            metric_value.create(
+                                labels=_TEST_LABELS,
+                                double_value=_A_FLOAT_VALUE * 2,
+                                end_time=_LATER_STILL
+                            ),
+                        ]
+                    ),
+                    sc_messages.MetricValueSet(
+                        metric_name=u'some_floats',
+                        metric_values=[
+                            metric_value.create(
+                                labels=_TEST_LABELS,
+                                double_value=_A_FLOAT_VALUE,
+                                end_time=_LATER
+                            ),
+                        ]
+                    )
+                ]
+            )
+        }
+    ]
 
 class TestOperationAggregation(unittest.TestCase):
 
     def test_should_aggregate_as_expected(self):
-        for t in _TESTS:
+        for t in _make_tests():
             desc = t[u'description']
             initial = t[u'initial']
             want = t[u'want']
@@ -305,6 +308,141 @@ class TestOperationAggregation(unittest.TestCase):
                 raise AssertionError(u'Failed to {0}\n{1}'.format(desc, e))
 
 
+class TestColumnarOperationAggregation(unittest.TestCase):
+
+    def test_should_aggregate_as_expected(self):
+        for t in _make_tests():
+            desc = t[u'description']
+            initial = t[u'initial']
+            want = t[u'want']
+            agg = operation.ColumnarAggregator(initial, kinds=t[u'kinds'])
+            for o in t[u'ops']:
+                agg.add(o)
+                got = agg.as_operation()
+            try:
+                expect(got).to(equal(want))
+            except AssertionError as e:
+                raise AssertionError(u'Failed to {0}\n{1}'.format(desc, e))
+
+    def test_should_sum_int64_values_by_signature(self):
+        other_labels = {u'key1': u'another_value'}
+        agg = operation.ColumnarAggregator(_make_int64_op(2, _TEST_LABELS))
+        agg.add(_make_int64_op(3, _TEST_LABELS))
+        agg.add(_make_int64_op(5, other_labels))
+        got = agg.as_operation().metric_value_sets[0].metric_values
+        expect([(dict(mv.labels), mv.int64_value) for mv in got]).to(equal([
+            (_TEST_LABELS, 5),
+            (other_labels, 5),
+        ]))
+
+    def test_should_merge_distributions_like_distribution_merge(self):
+        samples = [0.11, 0.5, 1e5]
+        want = _make_exponential_dist()
+        distribution.add_sample(samples[0], want)
+        ops = []
+        for i, s in enumerate(samples):
+            dist = _make_exponential_dist()
+            distribution.add_sample(s, dist)
+            if i:
+                distribution.merge(dist, want)
+            ops.append(_make_distribution_op(dist))
+        agg = operation.ColumnarAggregator(ops[0])
+        for op in ops[1:]:
+            agg.add(op)
+        got = agg.as_operation().metric_value_sets[0].metric_values
+        expect(len(got)).to(equal(1))
+        got = got[0].distribution_value
+        expect(got.count).to(equal(want.count))
+        expect(got.mean).to(equal(want.mean))
+        expect(got.minimum).to(equal(want.minimum))
+        expect(got.maximum).to(equal(want.maximum))
+        expect(got.sum_of_squared_deviation).to(
+            equal(want.sum_of_squared_deviation))
+        expect(got.bucket_counts).to(equal(want.bucket_counts))
+        expect(got.exponential_buckets).to(equal(want.exponential_buckets))
+
+    def test_should_fail_to_merge_distributions_with_other_buckets(self):
+        dist = distribution.create_exponential(4, 2, 0.1)
+        distribution.add_sample(0.11, dist)
+        agg = operation.ColumnarAggregator(
+            _make_distribution_op(_make_exponential_dist()))
+        testf = lambda: agg.add(_make_distribution_op(dist))
+        expect(testf).to(raise_error(ValueError))
+
+    def test_should_merge_latency_distributions_into_sketches(self):
+        layout = metric_descriptor.TIME_DISTRIBUTION_LAYOUT
+        samples = [0.001 * (1.1 ** i) for i in range(100)]
+        ops = []
+        for s in samples:
+            dist = distribution.create_from_layout(layout)
+            distribution.add_sample(s, dist)
+            ops.append(_make_distribution_op(dist))
+        want = distribution.Sketch(layout, relative_accuracy=0.01)
+        want.add_samples(samples)
+        agg = operation.ColumnarAggregator(ops[0],
+                                           latency_sketch_accuracy=0.01)
+        for op in ops[1:]:
+            agg.add(op)
+        got = agg.as_operation().metric_value_sets[0].metric_values
+        expect(len(got)).to(equal(1))
+        got = got[0].distribution_value
+        want = want.to_proto()
+        expect(got.count).to(equal(want.count))
+        expect(got.minimum).to(equal(want.minimum))
+        expect(got.maximum).to(equal(want.maximum))
+        expect(got.bucket_counts).to(equal(want.bucket_counts))
+        expect(got.exponential_buckets).to(equal(want.exponential_buckets))
+        # the float statistics may differ in the order they were summed
+        for got_value, want_value in (
+                (got.mean, want.mean),
+                (got.sum_of_squared_deviation, want.sum_of_squared_deviation)):
+            tolerance = 1e-9 * abs(want_value)
+            expect(got_value).to(be_within(want_value - tolerance,
+                                           want_value + tolerance))
+
+
+def _make_exponential_dist():
+    return distribution.create_exponential(3, 2, 0.1)
+
+
+def _make_distribution_op(dist):
+    return sc_messages.Operation(
+        start_time=_EARLY,
+        end_time=_LATER,
+        metric_value_sets=[
+            sc_messages.MetricValueSet(
+                metric_name=u'a_distribution',
+                metric_values=[
+                    metric_value.create(
+                        labels=_TEST_LABELS,
+                        distribution_value=dist,
+                        end_time=_LATER
+                    ),
+                ]
+            ),
+        ]
+    )
+
+
+def _make_int64_op(value, labels):
+    return sc_messages.Operation(
+        start_time=_EARLY,
+        end_time=_LATER,
+        metric_value_sets=[
+            sc_messages.MetricValueSet(
+                metric_name=u'some_ints',
+                metric_values=[
+                    metric_value.create(
+                        labels=labels,
+                        int64_value=value,
+                        end_time=_LATER
+                    ),
+                ]
+            ),
+        ]
+    )
+
+
 _INFO_TESTS = [
     (operation.Info(
         referer=u'a_referer',
@@ -0,0 +1,104 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import unittest
+
+from expects import be_false, be_none, be_true, equal, expect
+
+from endpoints_management.control import path_regex, path_trie
+
+
+class TestPathTrie(unittest.TestCase):
+
+    def setUp(self):
+        self._trie = path_trie.PathTrie()
+
+    def test_should_match_literal_templates(self):
+        expect(self._trie.insert(u'shelves', u'list')).to(be_true)
+        expect(self._trie.lookup(u'shelves')).to(equal(u'list'))
+        expect(self._trie.lookup(u'shelves/')).to(equal(u'list'))
+        expect(self._trie.lookup(u'books')).to(be_none)
+
+    def test_should_match_variable_segments(self):
+        self._trie.insert(u'shelves/{shelf}/books', u'books')
+        expect(self._trie.lookup(u'shelves/88/books')).to(equal(u'books'))
+        expect(self._trie.lookup(u'shelves//books')).to(equal(u'books'))
+        expect(self._trie.lookup(u'shelves/88')).to(be_none)
+        expect(self._trie.lookup(u'shelves/8[8/books')).to(be_none)
+
+    def test_should_prefer_literals_to_variables(self):
+        self._trie.insert(u'shelves/{shelf}', u'get')
+        self._trie.insert(u'shelves/special', u'special')
+        expect(self._trie.lookup(u'shelves/special')).to(equal(u'special'))
+        expect(self._trie.lookup(u'shelves/other')).to(equal(u'get'))
+
+    def test_should_backtrack_from_literals_to_variables(self):
+        self._trie.insert(u'shelves/special', u'special')
+        self._trie.insert(u'shelves/{shelf}/books', u'books')
+        expect(self._trie.lookup(u'shelves/special/books')).to(equal(u'books'))
+
+    def test_should_match_verbs(self):
+        self._trie.insert(u'shelves/{shelf}', u'get')
+        self._trie.insert(u'shelves/{shelf}:lock', u'lock')
+        self._trie.insert(u'v1/foo:bar', u'bar')
+        expect(self._trie.lookup(u'shelves/88:lock')).to(equal(u'lock'))
+        expect(self._trie.lookup(u'shelves/a:b:lock')).to(equal(u'lock'))
+        expect(self._trie.lookup(u'shelves/88:unlock')).to(equal(u'get'))
+        expect(self._trie.lookup(u'v1/foo:bar')).to(equal(u'bar'))
+        expect(self._trie.lookup(u'v1/foo')).to(be_none)
+
+    def test_should_prefer_verbs_whatever_the_insertion_order(self):
+        for templates in ((u'shelves/{shelf}', u'shelves/{shelf}:lock'),
+                          (u'shelves/{shelf}:lock', u'shelves/{shelf}')):
+            trie = path_trie.PathTrie()
+            for template in templates:
+                trie.insert(template, template)
+            expect(trie.lookup(u'shelves/88:lock')).to(
+                equal(u'shelves/{shelf}:lock'))
+            expect(trie.lookup(u'shelves/88')).to(equal(u'shelves/{shelf}'))
+
+    def test_should_keep_the_first_value_inserted(self):
+        self._trie.insert(u'{x}', u'first')
+        self._trie.insert(u'{y}', u'second')
+        expect(self._trie.lookup(u'anything')).to(equal(u'first'))
+
+    def test_should_reject_templates_with_regex_syntax(self):
+        expect(self._trie.insert(u'a/b.c', u'dot')).to(be_false)
+        expect(self._trie.insert(u'a/*', u'star')).to(be_false)
+        expect(self._trie.insert(u'{a}:x/b', u'verb')).to(be_false)
+        expect(len(self._trie)).to(equal(0))
+
+    def test_should_agree_with_path_regex(self):
+        templates = (
+            u'shelves',
+            u'shelves/{shelf}',
+            u'shelves/{shelf}/books',
+            u'shelves/{shelf}:lock',
+            u'{x}',
+            u'x/',
+        )
+        paths = (
+            u'', u'shelves', u'shelves/', u'shelves/88', u'shelves/88/books',
+            u'shelves/88:lock', u'shelves/:lock', u'shelves//books',
+            u'anything', u'x', u'x/', u'x//', u'shelves/8?8',
+        )
+        for t in templates:
+            trie = path_trie.PathTrie()
+            trie.insert(t, t)
+            regex = path_regex.compile_path_pattern(t)
+            for p in paths:
+                want = t if regex.match(p) else None
+                expect(trie.lookup(p)).to(equal(want))
@@ -200,6 +200,27 @@ class TestCachingAggregator(unittest.TestCase):
         agg.add_response(req, real_response)
         expect(agg.allocate_quota(req)).to(equal(real_response))
 
+    def test_should_aggregate_the_costs_of_infos(self):
+        info = _make_test_info(self.SERVICE_NAME, self.FAKE_OPERATION_ID)
+        agg = self.agg
+        expect(agg.allocate_quota(info)).not_to(be_none)
+        expect(len(agg.flush())).to(equal(1))  # the request made on the miss
+        agg.add_response(info.as_allocate_quota_request(),
+                         sc_messages.AllocateQuotaResponse(
+                             operation_id=self.FAKE_OPERATION_ID))
+        with mock.patch.object(quota_request.Info,
+                               u'as_allocate_quota_request') as as_request:
+            agg.allocate_quota(info)
+            agg.allocate_quota(info)
+            expect(as_request.called).to(be_false)
+
+        self.timer.tick()  # now past the flush interval
+        flushed_reqs = agg.flush()
+        expect(len(flushed_reqs)).to(equal(1))
+        quota_metrics = flushed_reqs[0].allocate_operation.quota_metrics
+        expect(quota_metrics[0].metric_name).to(equal(u'a_metric'))
+        expect(quota_metrics[0].metric_values[0].int64_value).to(equal(4))
+
     def test_should_update_temp_response_with_actual(self):
         req = _make_test_request(self.SERVICE_NAME, self.FAKE_OPERATION_ID)
         temp_response = sc_messages.AllocateQuotaResponse(
@@ -367,6 +388,15 @@ def _make_test_request(service_name, operation_id=None, importance=None):
     return sc_messages.AllocateQuotaRequest(service_name=service_name, allocate_operation=op)
 
 
+def _make_test_info(service_name, operation_id):
+    return quota_request.Info(
+        consumer_project_id=_TEST_CONSUMER_ID,
+        operation_id=operation_id,
+        operation_name=_TEST_OP_NAME,
+        quota_info={u'a_metric': 2},
+        service_name=service_name)
+
+
 _WANTED_USER_AGENT = label_descriptor.USER_AGENT
 _WANTED_SERVICE_AGENT = label_descriptor.SERVICE_AGENT
 _START_OF_EPOCH = timestamp.to_rfc3339(datetime.datetime(1970, 1, 1, 0, 0, 0))
@@ -454,6 +484,17 @@ class TestInfo(unittest.TestCase):
             testf = lambda: info.as_allocate_quota_request(timer=timer)
             expect(testf).to(raise_error(ValueError))
 
+    def test_should_sign_like_the_quota_request(self):
+        for info, _ in _INFO_TESTS[1:]:
+            for quota_info in (None, {u'a_metric': 1, u'b_metric': 2}):
+                info = info._replace(quota_info=quota_info)
+                expect(info.signature()).to(equal(
+                    quota_request.sign(info.as_allocate_quota_request())))
+
+    def test_should_fail_to_sign_without_a_consumer(self):
+        info, _ = _INFO_TESTS[0]
+        expect(info.signature).to(raise_error(ValueError))
+
 
 class TestConvertResponse(unittest.TestCase):
     PROJECT_ID = u'test_convert_response'
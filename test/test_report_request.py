@@ -18,11 +18,11 @@ import datetime
 import time
 import unittest
 from operator import attrgetter
-from expects import be_none, equal, expect, raise_error
+from expects import be, be_none, equal, expect, raise_error
 
 from google.cloud import servicecontrol as sc_messages
 from google.logging.type import log_severity_pb2
-from google.protobuf import struct_pb2, timestamp_pb2
+from google.protobuf import struct_pb2
 from google.protobuf.json_format import ParseDict, MessageToDict
 
 from endpoints_management.control import (caches, label_descriptor,
@@ -73,17 +73,54 @@ class TestReportingRules(unittest.TestCase):
         expect(rules.metrics).to(equal(self.WANTED_METRICS))
         expect(rules.labels).to(equal(self.WANTED_LABELS))
 
+    def test_should_reuse_the_compiled_function(self):
+        rules = self.subject_cls(metrics=self.WANTED_METRICS,
+                                 labels=self.WANTED_LABELS)
+        expect(rules.compile()).to(be(rules.compile()))
+
+    def test_compiled_function_should_update_like_the_known_values(self):
+        # pylint: disable=no-member
+        rules = self.subject_cls(
+            metrics=list(metric_descriptor.KnownMetrics.__members__.values()),
+            labels=list(label_descriptor.KnownLabels.__members__.values()))
+        update_operation = rules.compile()
+        for api_key_valid in (True, False):
+            for consumer_project_number in (0, 1234):
+                info = report_request.Info(
+                    api_key=u'an_api_key',
+                    api_key_valid=api_key_valid,
+                    consumer_project_number=consumer_project_number,
+                    method=u'GET',
+                    operation_id=u'an_op_id',
+                    operation_name=u'an_op_name',
+                    request_size=_TEST_SIZE,
+                    request_time=_TEST_LATENCY,
+                    response_code=404,
+                    response_size=_TEST_SIZE,
+                    service_name=_TEST_SERVICE_NAME)
+                got = sc_messages.Operation()
+                update_operation(info, got)
+                want = sc_messages.Operation()
+                labels = {}
+                for known_label in rules.labels:
+                    known_label.do_labels_update(info, labels)
+                labels[label_descriptor.KnownLabels.SCC_PLATFORM.label_name] = (
+                    info.platform.friendly_string())
+                want.labels = labels
+                for known_metric in rules.metrics:
+                    known_metric.do_operation_update(info, want)
+                expect(got).to(equal(want))
+
 
 _TEST_CONSUMER_ID = u'testConsumerID'
 _TEST_OP1_NAME = u'testOp1'
 _TEST_OP2_NAME = u'testOp2'
 _WANTED_USER_AGENT = label_descriptor.USER_AGENT
 _START_OF_EPOCH = datetime.datetime.utcfromtimestamp(0)
-_START_OF_EPOCH_TIMESTAMP = timestamp.to_rfc3339(_START_OF_EPOCH)
 _TEST_SERVICE_NAME = u'a_service_name'
 _TEST_SIZE=1
 _TEST_LATENCY=datetime.timedelta(seconds=7)
-_EPOCH_TIMESTAMP_PB = timestamp_pb2.Timestamp().FromJsonString(_START_OF_EPOCH_TIMESTAMP)
+_EPOCH_TIMESTAMP_PB = timestamp.to_timestamp_pb(_START_OF_EPOCH)
 
 _EXPECTED_OK_LOG_ENTRY = sc_messages.LogEntry(
     name = u'endpoints-log',
@@ -373,6 +410,30 @@ class TestInfo(unittest.TestCase):
             expect(got.operations[0]).to(equal(want))
 
 
+class TestStructPayload(unittest.TestCase):
+    PAYLOAD = {
+        u'http_response_code': 404,
+        u'request_latency_in_ms': 7000.0,
+        u'timestamp': time.mktime(_START_OF_EPOCH.timetuple()),
+        u'error_cause': u'internal',
+        u'url': [u'http', u'a_host', u'/a/path', u'', u'q=1', u''],
+        u'nested': {u'flag': True, u'missing': None, u'items': [1, u'two']},
+    }
+
+    def test_should_match_the_json_format_payload(self):
+        got = report_request._struct_payload_from(self.PAYLOAD)
+        want = ParseDict(self.PAYLOAD, struct_pb2.Struct())
+        expect(got.SerializeToString(deterministic=True)).to(
+            equal(want.SerializeToString(deterministic=True)))
+
+    def test_should_fail_on_unsupported_values(self):
+        testf = lambda: report_request._struct_payload_from({u'a': object()})
+        expect(testf).to(raise_error(ValueError))
+        # like json_format, only lists are converted to list values
+        testf = lambda: report_request._struct_payload_from({u'a': (1, 2)})
+        expect(testf).to(raise_error(ValueError))
+
+
 class TestAggregatorReport(unittest.TestCase):
     SERVICE_NAME = u'service.report'
 
@@ -473,6 +534,15 @@ class TestCachingAggregator(unittest.TestCase):
         flushed_ops = flushed_reqs[0].operations
         expect(len(flushed_ops)).to(equal(2)) # many requests, but only two ops
 
+    def test_should_batch_operations_into_report_requests(self):
+        max_ops = report_request.Aggregator.MAX_OPERATION_COUNT
+        ops = [sc_messages.Operation(operation_name=name)
+               for name in _make_op_names(max_ops + 1)]
+        reqs = self.agg.as_report_requests(ops)
+        expect([len(req.operations) for req in reqs]).to(
+            equal([max_ops, 1]))
+        expect(reqs[0].service_name).to(equal(self.SERVICE_NAME))
+
     def test_may_clear_aggregated_operations(self):
         n = 261 # arbitrary
         agg = self.agg
@@ -490,6 +560,126 @@ class TestCachingAggregator(unittest.TestCase):
         expect(len(flushed_reqs)).to(equal(0))  # but there is nothing
 
 
+class TestShardedCachingAggregator(TestCachingAggregator):
+    SERVICE_NAME = u'service.with_sharded_cache'
+
+    def setUp(self):
+        self.timer = _DateTimeTimer()
+        self.flush_interval = datetime.timedelta(seconds=1)
+        options = caches.ReportOptions(flush_interval=self.flush_interval,
+                                       num_shards=4)
+        self.agg = report_request.Aggregator(
+            self.SERVICE_NAME, options, timer=self.timer)
+
+
+class TestOverBudgetAggregator(unittest.TestCase):
+    SERVICE_NAME = u'service.over_budget'
+
+    def setUp(self):
+        self.timer = _DateTimeTimer()
+
+    def _make_aggregator(self, policy, num_entries=2, max_pending=2):
+        options = caches.ReportOptions(num_entries=num_entries,
+                                       max_pending=max_pending,
+                                       overflow_policy=policy)
+        return report_request.Aggregator(
+            self.SERVICE_NAME, options, timer=self.timer)
+
+    def _flush_op_names(self, agg):
+        self.timer.tick()
+        self.timer.tick()  # ... and is now past the flush_interval
+        return sorted(op.operation_name
+                      for req in agg.flush() for op in req.operations)
+
+    def test_should_not_drop_anything_without_a_budget(self):
+        agg = self._make_aggregator(caches.OverflowPolicy.DROP_NEWEST,
+                                    max_pending=None)
+        for i in range(5):
+            agg.report(_make_test_request(self.SERVICE_NAME, n=1, start=i))
+        expect(self._flush_op_names(agg)).to(
+            equal(sorted(_make_op_names(5))))
+        expect(sum(agg.overflows.values())).to(equal(0))
+
+    def test_should_drop_the_oldest_operations(self):
+        agg = self._make_aggregator(caches.OverflowPolicy.DROP_OLDEST)
+        for i in range(5):
+            agg.report(_make_test_request(self.SERVICE_NAME, n=1, start=i))
+        expect(agg.overflows[caches.OverflowPolicy.DROP_OLDEST]).to(equal(1))
+        expect(self._flush_op_names(agg)).to(
+            equal(sorted(_make_op_names(4, start=1))))
+
+    def test_should_drop_the_newest_operations(self):
+        agg = self._make_aggregator(caches.OverflowPolicy.DROP_NEWEST)
+        for i in range(5):
+            agg.report(_make_test_request(self.SERVICE_NAME, n=1, start=i))
+        # merging with a cached operation is still allowed
+        agg.report(_make_test_request(self.SERVICE_NAME, n=1, start=3))
+        expect(agg.overflows[caches.OverflowPolicy.DROP_NEWEST]).to(equal(1))
+        expect(self._flush_op_names(agg)).to(
+            equal(sorted(_make_op_names(4))))
+
+    def test_should_keep_expired_operations_while_the_cache_has_room(self):
+        for policy in caches.OverflowPolicy:
+            agg = self._make_aggregator(policy, num_entries=100, max_pending=1)
+            for i in range(3):
+                agg.report(_make_test_request(self.SERVICE_NAME, n=1, start=i))
+            self.timer.tick()
+            self.timer.tick()  # ... the operations have expired, unflushed
+            for i in range(3, 6):
+                agg.report(_make_test_request(self.SERVICE_NAME, n=1, start=i))
+            expect(sum(agg.overflows.values())).to(equal(0))
+            expect(self._flush_op_names(agg)).to(
+                equal(sorted(_make_op_names(6))))
+
+    def test_should_collapse_the_newest_operations(self):
+        agg = self._make_aggregator(caches.OverflowPolicy.COLLAPSE,
+                                    num_entries=1, max_pending=1)
+        credential_id = label_descriptor.KnownLabels.CREDENTIAL_ID.label_name
+        for i in range(10):
+            op = sc_messages.Operation(
+                consumer_id=u'api_key:key%d' % (i,),
+                operation_name=u'testOp',
+                importance=sc_messages.Operation.Importance.LOW,
+                labels={credential_id: u'apiKey:key%d' % (i,),
+                        u'key1': u'a low cardinality label'})
+            agg.report(sc_messages.ReportRequest(
+                service_name=self.SERVICE_NAME, operations=[op]))
+        overflows = agg.overflows
+        expect(overflows[caches.OverflowPolicy.COLLAPSE]).to(equal(8))
+        # collapsing does not evict the pending operations
+        expect(overflows[caches.OverflowPolicy.DROP_OLDEST]).to(equal(0))
+
+        self.timer.tick()
+        self.timer.tick()
+        flushed_ops = [op for req in agg.flush() for op in req.operations]
+        expect(sorted(op.consumer_id for op in flushed_ops)).to(
+            equal([u'', u'api_key:key0', u'api_key:key1']))
+        collapsed = [op for op in flushed_ops if not op.consumer_id][0]
+        expect(dict(collapsed.labels)).to(
+            equal({u'key1': u'a low cardinality label'}))
+
+    def test_should_drop_the_newest_operations_that_do_not_collapse(self):
+        agg = self._make_aggregator(caches.OverflowPolicy.COLLAPSE,
+                                    num_entries=1, max_pending=1)
+        for i in range(5):
+            agg.report(_make_test_request(self.SERVICE_NAME, n=1, start=i))
+        # the first collapsed operation takes the whole collapsed budget
+        overflows = agg.overflows
+        expect(overflows[caches.OverflowPolicy.COLLAPSE]).to(equal(1))
+        expect(overflows[caches.OverflowPolicy.DROP_NEWEST]).to(equal(2))
+        expect(overflows[caches.OverflowPolicy.DROP_OLDEST]).to(equal(0))
+        expect(self._flush_op_names(agg)).to(
+            equal(sorted(_make_op_names(3))))
+
+    def test_should_clear_the_collapsed_operations(self):
+        agg = self._make_aggregator(caches.OverflowPolicy.COLLAPSE,
+                                    num_entries=1, max_pending=1)
+        for i in range(3):
+            agg.report(_make_test_request(self.SERVICE_NAME, n=1, start=i))
+        expect(len(agg.clear())).to(equal(2))
+        expect(self._flush_op_names(agg)).to(equal([]))
+
+
 class _DateTimeTimer(object):
     def __init__(self, auto=False):
         self.auto = auto
@@ -811,3 +811,84 @@ class TestMethodRegistryCustomMethodConfig(_JsonServiceBase, unittest.TestCase):
         info = registry.lookup(u'POST', url)
         assert info is not None
         assert info.selector == 'Bookstore.CreateBook'
+
+
+_LITERAL_PRECEDENCE_CONFIG_TEST = u"""
+{
+    "name": "literal-precedence",
+    "http": {
+        "rules": [{
+            "selector": "Shelves.GetShelf",
+            "get": "/shelves/{shelf}"
+        },{
+            "selector": "Shelves.GetDefaultShelf",
+            "get": "/shelves/default"
+        },{
+            "selector": "Shelves.GetVersionedShelf",
+            "get": "/v1.0/shelves/{shelf}"
+        }]
+    }
+}
+"""
+
+class TestMethodRegistryLiteralPrecedence(_JsonServiceBase, unittest.TestCase):
+    _INPUT = _LITERAL_PRECEDENCE_CONFIG_TEST
+
+    def test_should_prefer_literal_segments(self):
+        registry = self._get_registry()
+        info = registry.lookup(u'GET', u'/shelves/default')
+        expect(info.selector).to(equal(u'Shelves.GetDefaultShelf'))
+        info = registry.lookup(u'GET', u'/shelves/88')
+        expect(info.selector).to(equal(u'Shelves.GetShelf'))
+
+    def test_should_fall_back_to_regex_templates(self):
+        registry = self._get_registry()
+        info = registry.lookup(u'GET', u'/v1.0/shelves/88')
+        expect(info.selector).to(equal(u'Shelves.GetVersionedShelf'))
+        expect(registry.lookup(u'GET', u'/v1.0/shelves/88/books')).to(be_none)
+
+
+class TestMethodRegistryLookupCache(_JsonServiceBase, unittest.TestCase):
+    _INPUT = _BOOKSTORE_CONFIG_TEST
+
+    def _get_registry(self):
+        return service.MethodRegistry(self._subject, lookup_cache_size=100)
+
+    def test_should_not_cache_by_default(self):
+        registry = service.MethodRegistry(self._subject)
+        registry.lookup(u'GET', u'/shelves')
+        registry.lookup(u'GET', u'/shelves')
+        expect(registry.lookup_cache_misses).to(equal(0))
+        expect(registry.lookup_cache_hits).to(equal(0))
+
+    def test_should_count_hits_and_misses(self):
+        registry = self._get_registry()
+        first = registry.lookup(u'GET', u'/shelves/88/books')
+        expect(registry.lookup_cache_misses).to(equal(1))
+        expect(registry.lookup_cache_hits).to(equal(0))
+        second = registry.lookup(u'get', u'shelves/88/books')
+        expect(second).to(equal(first))
+        expect(registry.lookup_cache_hits).to(equal(1))
+
+    def test_should_cache_unknown_paths(self):
+        registry = self._get_registry()
+        expect(registry.lookup(u'GET', u'/unknown')).to(be_none)
+        expect(registry.lookup(u'GET', u'/unknown')).to(be_none)
+        expect(registry.lookup_cache_misses).to(equal(1))
+        expect(registry.lookup_cache_hits).to(equal(1))
+
+    def test_should_bound_the_cache(self):
+        registry = service.MethodRegistry(self._subject, lookup_cache_size=1)
+        registry.lookup(u'GET', u'/shelves')
+        registry.lookup(u'GET', u'/shelves/88/books')
+        registry.lookup(u'GET', u'/shelves')
+        expect(registry.lookup_cache_misses).to(equal(3))
+        expect(registry.lookup_cache_hits).to(equal(0))
+
+    def test_should_not_cache_when_disabled(self):
+        registry = service.MethodRegistry(self._subject, lookup_cache_size=0)
+        info = registry.lookup(u'GET', u'/shelves')
+        expect(info.selector).to(equal(u'Bookstore.ListShelves'))
+        registry.lookup(u'GET', u'/shelves')
+        expect(registry.lookup_cache_misses).to(equal(0))
+        expect(registry.lookup_cache_hits).to(equal(0))
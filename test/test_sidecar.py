@@ -0,0 +1,164 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from apitools.base.py import exceptions
+from expects import be_none, equal, expect, raise_error
+
+from google.cloud import servicecontrol as sc_messages
+
+from endpoints_management.control import sidecar
+
+_SERVICE_NAME = u'service.with_a_sidecar'
+_OPERATION_ID = u'an_op_id'
+
+
+def _make_check_request():
+    return sc_messages.CheckRequest(
+        service_name=_SERVICE_NAME,
+        operation=sc_messages.Operation(operation_id=_OPERATION_ID))
+
+
+def _make_quota_request():
+    return sc_messages.AllocateQuotaRequest(
+        service_name=_SERVICE_NAME,
+        allocate_operation=sc_messages.QuotaOperation(
+            operation_id=_OPERATION_ID))
+
+
+def _make_report_request():
+    return sc_messages.ReportRequest(
+        service_name=_SERVICE_NAME,
+        operations=[sc_messages.Operation(operation_id=_OPERATION_ID)])
+
+
+class TestSidecar(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, u'sidecar.sock')
+        self.control_client = mock.MagicMock()
+        self.server = sidecar.Server(self.path, self.control_client)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.transport = sidecar.transport_func(self.path)()
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def test_should_forward_checks_and_return_their_responses(self):
+        req = _make_check_request()
+        resp = sc_messages.CheckResponse(operation_id=_OPERATION_ID)
+        self.control_client.check.return_value = resp
+        expect(self.transport.services.Check(req)).to(equal(resp))
+        self.control_client.check.assert_called_once_with(req)
+
+    def test_should_return_none_when_the_daemon_has_no_check_response(self):
+        self.control_client.check.return_value = None
+        expect(self.transport.services.Check(_make_check_request())).to(
+            be_none)
+
+    def test_should_forward_quota_requests_and_return_their_responses(self):
+        req = _make_quota_request()
+        resp = sc_messages.AllocateQuotaResponse(operation_id=_OPERATION_ID)
+        self.control_client.allocate_quota.return_value = resp
+        expect(self.transport.services.AllocateQuota(req)).to(equal(resp))
+        self.control_client.allocate_quota.assert_called_once_with(req)
+
+    def test_should_return_empty_responses(self):
+        self.control_client.check.return_value = sc_messages.CheckResponse()
+        expect(self.transport.services.Check(_make_check_request())).to(
+            equal(sc_messages.CheckResponse()))
+
+    def test_should_return_none_if_the_response_cannot_be_sent(self):
+        self.control_client.check.return_value = object()
+        expect(self.transport.services.Check(_make_check_request())).to(
+            be_none)
+        # the connection is still served
+        self.control_client.check.return_value = sc_messages.CheckResponse()
+        expect(self.transport.services.Check(_make_check_request())).to(
+            equal(sc_messages.CheckResponse()))
+
+    def test_should_forward_reports_without_waiting_for_them(self):
+        self.control_client.check.return_value = sc_messages.CheckResponse()
+        req = _make_report_request()
+        self.transport.services.Report(req)
+        self.transport.services.Report(req)
+        # a later call is answered only once the reports are handled
+        self.transport.services.Check(_make_check_request())
+        expect(self.control_client.report.call_count).to(equal(2))
+        self.control_client.report.assert_called_with(req)
+
+    def test_should_keep_serving_after_the_client_fails(self):
+        self.control_client.check.side_effect = ValueError(u'a failure')
+        expect(self.transport.services.Check(_make_check_request())).to(
+            be_none)
+        self.control_client.check.side_effect = None
+        self.control_client.check.return_value = sc_messages.CheckResponse()
+        expect(self.transport.services.Check(_make_check_request())).to(
+            equal(sc_messages.CheckResponse()))
+
+    def test_should_drop_connections_that_send_bad_frames(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        try:
+            sock.sendall(sidecar._HEADER.pack(99, 0))
+            sock.settimeout(sidecar.DEFAULT_TIMEOUT)
+            expect(sock.recv(1)).to(equal(b''))
+        finally:
+            sock.close()
+        expect(self.control_client.method_calls).to(equal([]))
+
+
+class TestSidecarTransport(unittest.TestCase):
+
+    def test_should_raise_transport_errors_if_there_is_no_daemon(self):
+        path = os.path.join(tempfile.gettempdir(),
+                            u'no-sidecar-%d-%f' % (os.getpid(), time.time()))
+        transport = sidecar.transport_func(path)()
+        testf = lambda: transport.services.Check(_make_check_request())
+        expect(testf).to(raise_error(exceptions.CommunicationError))
+
+    def test_should_give_each_thread_its_own_transport(self):
+        create_transport = sidecar.transport_func(u'a_path')
+        transports = []
+        thread = threading.Thread(
+            target=lambda: transports.append(create_transport()))
+        thread.start()
+        thread.join()
+        expect(create_transport() is create_transport()).to(equal(True))
+        expect(transports[0] is create_transport()).to(equal(False))
+
+
+class TestLoadClient(unittest.TestCase):
+
+    def test_should_not_cache_or_aggregate(self):
+        control_client = sidecar.load_client(_SERVICE_NAME, u'a_path')
+        expect(control_client._check_aggregator.flush_interval).to(be_none)
+        expect(control_client._quota_aggregator.flush_interval).to(be_none)
+        expect(control_client._report_aggregator.flush_interval).to(be_none)
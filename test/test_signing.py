@@ -40,3 +40,37 @@ class TestAddDictToHash(unittest.TestCase):
         signing.add_dict_to_hash(got_hash, same_dict)
         got = got_hash.digest()
         expect(got).to(equal(want))
+
+
+class TestSign(unittest.TestCase):
+
+    def tearDown(self):
+        signing.set_signer()
+
+    def test_should_match_hashing_the_parts_one_at_a_time(self):
+        signing.set_signer(signing.MD5)
+        md5 = hashlib.md5()
+        md5.update(b'first')
+        md5.update(b'\x00')
+        md5.update(b'second')
+        expect(signing.sign([u'first', u'second'])).to(equal(md5.digest()))
+
+    def test_should_use_the_signer_that_is_set(self):
+        signing.set_signer(hashlib.sha1)
+        want = hashlib.sha1(b'first\x00second').digest()
+        expect(signing.sign([u'first', u'second'])).to(equal(want))
+        expect(signing.empty_signature()).to(equal(hashlib.sha1().digest()))
+
+    def test_should_restore_the_default_signer(self):
+        signing.set_signer(hashlib.sha1)
+        signing.set_signer()
+        want = signing.DEFAULT_SIGNER(b'first').digest()
+        expect(signing.sign([u'first'])).to(equal(want))
+
+    def test_should_sign_operations_regardless_of_label_order(self):
+        a_dict = {u'key1': u'value1', u'key2': u'value2'}
+        reversed_dict = dict(reversed(list(a_dict.items())))
+        want = signing.sign(signing.operation_parts(u'op', u'consumer', a_dict))
+        got = signing.sign(
+            signing.operation_parts(u'op', u'consumer', reversed_dict))
+        expect(got).to(equal(want))
@@ -0,0 +1,160 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from expects import be_false, be_true, equal, expect, raise_error
+
+from endpoints_management.control import spool
+
+
+class _Sender(object):
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.sent = []
+
+    def __call__(self, payload):
+        if self.failures:
+            self.failures -= 1
+            raise IOError(u'could not send')
+        self.sent.append(payload)
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, u'spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_should_fail_on_bad_options(self):
+        testf = lambda: spool.Spool(self.path, segment_bytes=0)
+        expect(testf).to(raise_error(ValueError))
+        testf = lambda: spool.Spool(self.path, max_attempts=0)
+        expect(testf).to(raise_error(ValueError))
+
+    def test_should_replay_records_in_order(self):
+        subject = spool.Spool(self.path, segment_bytes=20)
+        payloads = [(u'record %d' % (i,)).encode(u'ascii') for i in range(5)]
+        for p in payloads:
+            subject.append(p)
+        expect(len(os.listdir(self.path))).to(equal(3))
+        sender = _Sender()
+        expect(subject.replay(sender)).to(be_true)
+        expect(sender.sent).to(equal(payloads))
+        expect(subject.replayed).to(equal(5))
+        expect(subject.size).to(equal(0))
+        expect(os.listdir(self.path)).to(equal([]))
+
+    def test_should_resume_after_a_failure(self):
+        subject = spool.Spool(self.path)
+        payloads = [b'first', b'second', b'third']
+        for p in payloads:
+            subject.append(p)
+        sender = _Sender()
+        expect(subject.replay(lambda p: sender(p) if p != b'second'
+                              else 1 / 0)).to(be_false)
+        expect(sender.sent).to(equal([b'first']))
+        subject.append(b'fourth')
+        expect(subject.replay(sender)).to(be_true)
+        expect(sender.sent).to(equal(payloads + [b'fourth']))
+
+    def test_should_drop_records_that_fail_too_often(self):
+        subject = spool.Spool(self.path, max_attempts=2)
+        subject.append(b'first')
+        subject.append(b'second')
+        sender = _Sender(failures=2)
+        expect(subject.replay(sender)).to(be_false)
+        expect(subject.replay(sender)).to(be_true)
+        expect(sender.sent).to(equal([b'second']))
+        expect(subject.dropped).to(equal(1))
+
+    def test_should_evict_the_oldest_segments(self):
+        subject = spool.Spool(self.path, max_bytes=40, segment_bytes=10)
+        for i in range(5):
+            subject.append((u'record %d' % (i,)).encode(u'ascii'))
+        expect(subject.size).to(equal(32))
+        expect(subject.evicted_bytes).to(equal(48))
+        sender = _Sender()
+        subject.replay(sender)
+        expect(sender.sent).to(equal([b'record 3', b'record 4']))
+
+    def test_should_replay_the_segments_of_an_earlier_spool(self):
+        earlier = spool.Spool(self.path)
+        earlier.append(b'first')
+        earlier.close()
+        subject = spool.Spool(self.path)
+        expect(subject.size).to(equal(earlier.size))
+        subject.append(b'second')
+        expect(len(os.listdir(self.path))).to(equal(2))
+        sender = _Sender()
+        subject.replay(sender)
+        expect(sender.sent).to(equal([b'first', b'second']))
+
+    def test_should_not_replay_records_twice_after_a_restart(self):
+        earlier = spool.Spool(self.path)
+        for p in (b'first', b'second', b'third'):
+            earlier.append(p)
+        sender = _Sender()
+        earlier.replay(lambda p: sender(p) if p != b'third' else 1 / 0)
+        expect(sender.sent).to(equal([b'first', b'second']))
+        earlier.close()
+
+        subject = spool.Spool(self.path)
+        expect(subject.replay(sender)).to(be_true)
+        expect(sender.sent).to(equal([b'first', b'second', b'third']))
+        expect(os.listdir(self.path)).to(equal([]))
+
+        # a later segment with the same number is replayed from its start
+        subject.append(b'fourth')
+        expect(spool.Spool(self.path).replay(sender)).to(be_true)
+        expect(sender.sent[-1]).to(equal(b'fourth'))
+
+    def test_should_ignore_torn_records(self):
+        earlier = spool.Spool(self.path)
+        earlier.append(b'first')
+        earlier.append(b'second')
+        earlier.close()
+        name = os.listdir(self.path)[0]
+        with open(os.path.join(self.path, name), u'r+b') as f:
+            f.truncate(earlier.size - 1)
+        sender = _Sender()
+        expect(spool.Spool(self.path).replay(sender)).to(be_true)
+        expect(sender.sent).to(equal([b'first']))
+        expect(os.listdir(self.path)).to(equal([]))
+
+    def test_should_ignore_corrupt_records(self):
+        earlier = spool.Spool(self.path)
+        earlier.append(b'first')
+        earlier.close()
+        name = os.listdir(self.path)[0]
+        with open(os.path.join(self.path, name), u'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b'X')
+        sender = _Sender()
+        expect(spool.Spool(self.path).replay(sender)).to(be_true)
+        expect(sender.sent).to(equal([]))
+
+    def test_should_replay_nothing_when_empty(self):
+        subject = spool.Spool(self.path)
+        sender = _Sender()
+        expect(subject.replay(sender)).to(be_true)
+        expect(sender.sent).to(equal([]))
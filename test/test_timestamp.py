@@ -17,7 +17,8 @@ from __future__ import absolute_import
 import datetime
 
 import unittest
-from expects import be_below_or_equal, expect, equal, raise_error
+from expects import (be_below_or_equal, be_false, be_true, expect, equal,
+                     raise_error)
 
 from endpoints_management.control import timestamp
 
@@ -39,6 +40,60 @@ class TestToRfc3339(unittest.TestCase):
         expect(testf).to(raise_error(ValueError))
 
 
+class TestToTimestampPb(unittest.TestCase):
+    A_LONG_TIME_AGO = datetime.datetime(1971, 12, 31, 21, 0, 20, 21000)
+    BEFORE_THE_EPOCH = datetime.datetime(1969, 12, 31, 23, 59, 59, 500000)
+    TESTS = [
+        (A_LONG_TIME_AGO, (63061220, 21000000)),
+        (A_LONG_TIME_AGO - datetime.datetime(1970, 1, 1), (63061220, 21000000)),
+        (BEFORE_THE_EPOCH, (-1, 500000000)),
+        (63061220.25, (63061220, 250000000)),
+        (-0.5, (-1, 500000000)),
+        (10, (10, 0)),
+    ]
+
+    def test_should_convert_correctly(self):
+        for t in self.TESTS:
+            got = timestamp.to_timestamp_pb(t[0])
+            expect((got.seconds, got.nanos)).to(equal(t[1]))
+
+    def test_should_match_the_rfc3339_conversion(self):
+        got = timestamp.to_timestamp_pb(self.A_LONG_TIME_AGO)
+        expect(got.ToJsonString()).to(
+            equal(timestamp.to_rfc3339(self.A_LONG_TIME_AGO)))
+
+    def test_should_fail_on_invalid_input(self):
+        testf = lambda: timestamp.to_timestamp_pb(u'this will not work')
+        expect(testf).to(raise_error(ValueError))
+
+
+class TestStamp(unittest.TestCase):
+    A_LONG_TIME_AGO = datetime.datetime(1971, 12, 31, 21, 0, 20, 21000)
+
+    def setUp(self):
+        timestamp.reset_stamp()
+
+    def tearDown(self):
+        timestamp.reset_stamp()
+
+    def test_should_convert_like_to_timestamp_pb(self):
+        expect(timestamp.stamp(self.A_LONG_TIME_AGO)).to(
+            equal(timestamp.to_timestamp_pb(self.A_LONG_TIME_AGO)))
+
+    def test_should_reuse_the_timestamp_of_the_same_instant(self):
+        first = timestamp.stamp(self.A_LONG_TIME_AGO)
+        expect(timestamp.stamp(self.A_LONG_TIME_AGO) is first).to(be_true)
+        later = self.A_LONG_TIME_AGO + datetime.timedelta(microseconds=1)
+        expect(timestamp.stamp(later) is first).to(be_false)
+
+    def test_should_convert_afresh_after_a_reset(self):
+        first = timestamp.stamp(self.A_LONG_TIME_AGO)
+        timestamp.reset_stamp()
+        again = timestamp.stamp(self.A_LONG_TIME_AGO)
+        expect(again is first).to(be_false)
+        expect(again).to(equal(first))
+
+
 class TestFromRfc3339(unittest.TestCase):
     TOLERANCE = 10000  # 1e-5 * 1e9
     TESTS = [
@@ -98,7 +153,17 @@ class TestCompare(unittest.TestCase):
          0),
         (datetime.datetime(1996, 11, 20, 0, 39, 57, 0),
          datetime.datetime(1996, 10, 20, 0, 39, 57, 0),
-         1)
+         1),
+        # Timestamp messages
+        (timestamp.to_timestamp_pb(63061220.25),
+         timestamp.to_timestamp_pb(63061220.5),
+         -1),
+        (timestamp.to_timestamp_pb(63061220.25),
+         timestamp.to_timestamp_pb(63061220.25),
+         0),
+        (timestamp.to_timestamp_pb(63061221),
+         timestamp.to_timestamp_pb(63061220.5),
+         1),
     ]
 
     def test_should_compare_correctly(self):
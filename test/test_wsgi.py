@@ -27,8 +27,8 @@ from google.protobuf.json_format import Parse
 
 from endpoints_management.auth import suppliers
 from endpoints_management.auth import tokens
-from endpoints_management.control import (client, report_request, service,
-                                          wsgi)
+from endpoints_management.control import (client, latency, report_request,
+                                          service, wsgi)
 
 
 def _dummy_start_response(status, response_headers, exc_info=None):
@@ -45,6 +45,25 @@ class _DummyWsgiApp(object):
         return _DUMMY_RESPONSE
 
 
+_STREAMED_CHUNKS = (b'first chunk', b'second chunk', b'last chunk')
+
+
+class _StreamingWsgiApp(object):
+    def __init__(self):
+        self.closed = False
+
+    def __call__(self, environ, dummy_start_response):
+        dummy_start_response("200 OK", [])
+        return self._chunks()
+
+    def _chunks(self):
+        try:
+            for chunk in _STREAMED_CHUNKS:
+                yield chunk
+        finally:
+            self.closed = True
+
+
 class TestEnvironmentMiddleware(unittest.TestCase):
 
     def test_should_add_service_et_al_to_environment(self):
@@ -153,6 +172,119 @@ class TestMiddleware(unittest.TestCase):
         expect(control_client.report.called).to(be_true)
         expect(control_client.allocate_quota.called).to(be_false)
 
+    def test_should_stream_responses_and_report_when_exhausted(self):
+        control_client = mock.MagicMock(spec=client.Client)
+        given = {
+            u'wsgi.url_scheme': u'http',
+            u'PATH_INFO': u'/any',
+            u'REMOTE_ADDR': u'192.168.0.3',
+            u'HTTP_HOST': u'localhost',
+            u'HTTP_REFERER': u'example.myreferer.com',
+            u'REQUEST_METHOD': u'GET'}
+        control_client.check.return_value = sc_messages.CheckResponse(
+            operation_id=u'fake_operation_id')
+        with_control = wsgi.Middleware(_StreamingWsgiApp(), self.PROJECT_ID,
+                                       control_client, stream_responses=True)
+        wrapped = wsgi.EnvironmentMiddleware(with_control,
+                                             service.Loaders.SIMPLE.load())
+        result = wrapped(given, _dummy_start_response)
+        expect(control_client.report.called).to(be_false)
+        expect(next(result)).to(equal(_STREAMED_CHUNKS[0]))
+        expect(control_client.report.called).to(be_false)
+        expect(b''.join(result)).to(equal(b''.join(_STREAMED_CHUNKS[1:])))
+        expect(control_client.report.call_count).to(equal(1))
+        result.close()
+        expect(control_client.report.call_count).to(equal(1))
+
+    def test_should_report_streamed_responses_when_closed(self):
+        control_client = mock.MagicMock(spec=client.Client)
+        given = {
+            u'wsgi.url_scheme': u'http',
+            u'PATH_INFO': u'/any',
+            u'REMOTE_ADDR': u'192.168.0.3',
+            u'HTTP_HOST': u'localhost',
+            u'REQUEST_METHOD': u'GET'}
+        control_client.check.return_value = sc_messages.CheckResponse(
+            operation_id=u'fake_operation_id')
+        app = _StreamingWsgiApp()
+        with_control = wsgi.Middleware(app, self.PROJECT_ID,
+                                       control_client, stream_responses=True)
+        wrapped = wsgi.EnvironmentMiddleware(with_control,
+                                             service.Loaders.SIMPLE.load())
+        result = wrapped(given, _dummy_start_response)
+        next(result)
+        result.close()
+        expect(app.closed).to(be_true)
+        expect(control_client.report.call_count).to(equal(1))
+
+    def test_should_record_latencies_on_the_latency_monitor(self):
+        wrappee = _DummyWsgiApp()
+        control_client = mock.MagicMock(spec=client.Client)
+        given = {
+            u'wsgi.url_scheme': u'http',
+            u'PATH_INFO': u'/any',
+            u'REMOTE_ADDR': u'192.168.0.3',
+            u'HTTP_HOST': u'localhost',
+            u'REQUEST_METHOD': u'GET'}
+        control_client.check.return_value = sc_messages.CheckResponse(
+            operation_id=u'fake_operation_id')
+        monitor = latency.Monitor()
+        with_control = wsgi.Middleware(wrappee, self.PROJECT_ID,
+                                       control_client,
+                                       latency_monitor=monitor)
+        wrapped = wsgi.EnvironmentMiddleware(with_control,
+                                             service.Loaders.SIMPLE.load())
+        wrapped(given, _dummy_start_response)
+        wrapped(given, _dummy_start_response)
+        snapshot = monitor.snapshot()
+        expect(len(snapshot)).to(equal(1))
+        latencies = list(snapshot.values())[0]
+        expect(latencies.total.count).to(equal(2))
+        expect(latencies.backend.count).to(equal(2))
+
+    def test_should_record_latencies_when_added_with_add_all(self):
+        control_client = mock.MagicMock(spec=client.Client)
+        given = {
+            u'wsgi.url_scheme': u'http',
+            u'PATH_INFO': u'/any',
+            u'REMOTE_ADDR': u'192.168.0.3',
+            u'HTTP_HOST': u'localhost',
+            u'REQUEST_METHOD': u'GET'}
+        control_client.check.return_value = sc_messages.CheckResponse(
+            operation_id=u'fake_operation_id')
+        monitor = latency.Monitor()
+        wrapped = wsgi.add_all(_DummyWsgiApp(),
+                               self.PROJECT_ID,
+                               control_client,
+                               loader=service.Loaders.SIMPLE,
+                               latency_monitor=monitor)
+        wrapped(given, _dummy_start_response)
+        snapshot = monitor.snapshot()
+        expect(len(snapshot)).to(equal(1))
+        expect(list(snapshot.values())[0].total.count).to(equal(1))
+
+    def test_should_defer_reports_to_the_client(self):
+        wrappee = _DummyWsgiApp()
+        control_client = mock.MagicMock(spec=client.Client)
+        given = {
+            u'wsgi.url_scheme': u'http',
+            u'PATH_INFO': u'/any',
+            u'REMOTE_ADDR': u'192.168.0.3',
+            u'HTTP_HOST': u'localhost',
+            u'REQUEST_METHOD': u'GET'}
+        control_client.check.return_value = sc_messages.CheckResponse(
+            operation_id=u'fake_operation_id')
+        with_control = wsgi.Middleware(wrappee, self.PROJECT_ID,
+                                       control_client, defer_reports=True)
+        wrapped = wsgi.EnvironmentMiddleware(with_control,
+                                             service.Loaders.SIMPLE.load())
+        wrapped(given, _dummy_start_response)
+        expect(control_client.report.called).to(be_false)
+        expect(control_client.report_info.called).to(be_true)
+        info, rules, _ = control_client.report_info.call_args[0]
+        expect(info.response_size).to(equal(len(_DUMMY_RESPONSE[0])))
+        expect(rules).to(equal(given[wsgi.EnvironmentMiddleware.REPORTING_RULES]))
+
     def test_load_service_failed_retrying(self):
         control_client = mock.MagicMock(spec=client.Client)
 
@@ -333,7 +465,7 @@ class TestMiddlewareWithParams(unittest.TestCase):
         wrapped(given, _dummy_start_response)
         expect(control_client.check.called).to(be_true)
         req = control_client.check.call_args[0][0]
-        expect(req.operation.consumer_id).to(
+        expect(req.consumer_id).to(
             equal(u'project:middleware-with-params'))
         expect(control_client.report.called).to(be_true)
         expect(control_client.allocate_quota.called).to(be_false)
@@ -356,11 +488,11 @@ class TestMiddlewareWithParams(unittest.TestCase):
                                loader=service.Loaders.ENVIRONMENT)
         control_client.check.return_value = dummy_response
         control_client.allocate_quota.side_effect = lambda req: sc_messages.AllocateQuotaResponse(
-            operation_id=req.allocate_operation.operation_id)
+            operation_id=req.operation_id)
         wrapped(given, _dummy_start_response)
         expect(control_client.check.called).to(be_true)
         req = control_client.check.call_args[0][0]
-        expect(req.operation.consumer_id).to(
+        expect(req.consumer_id).to(
             equal(u'project:middleware-with-params'))
         expect(control_client.report.called).to(be_true)
         expect(control_client.allocate_quota.called).to(be_true)
@@ -386,7 +518,7 @@ class TestMiddlewareWithParams(unittest.TestCase):
         wrapped(given, _dummy_start_response)
         expect(control_client.check.called).to(be_true)
         check_req = control_client.check.call_args[0][0]
-        expect(check_req.operation.consumer_id).to(
+        expect(check_req.consumer_id).to(
             equal(u'api_key:my-query-value'))
         expect(control_client.report.called).to(be_true)
         report_req = control_client.report.call_args[0][0]
@@ -416,7 +548,7 @@ class TestMiddlewareWithParams(unittest.TestCase):
         expect(control_client.check.called).to(be_true)
         check_request = control_client.check.call_args_list[0].check_request
         check_req = control_client.check.call_args[0][0]
-        expect(check_req.operation.consumer_id).to(
+        expect(check_req.consumer_id).to(
             equal(u'api_key:my-header-value'))
         expect(control_client.report.called).to(be_true)
         report_req = control_client.report.call_args[0][0]
@@ -447,7 +579,7 @@ class TestMiddlewareWithParams(unittest.TestCase):
             expect(control_client.check.called).to(be_true)
             check_request = control_client.check.call_args_list[0].check_request
             check_req = control_client.check.call_args[0][0]
-            expect(check_req.operation.consumer_id).to(
+            expect(check_req.consumer_id).to(
                 equal(u'api_key:my-default-api-key-value'))
             expect(control_client.report.called).to(be_true)
             report_req = control_client.report.call_args[0][0]